@@ -0,0 +1,300 @@
+import asyncio
+import collections
+import hmac
+import json
+import os
+import queue
+import secrets
+import socket
+import tempfile
+import threading
+import time
+
+from protocol import Frame, FrameReader, MessageFormatError, read_control_frame
+
+# 管理连接（GUI <-> 引擎进程，只监听本机地址）上的消息，使用 v2 帧格式，消息体为 JSON 或文本
+ADMIN_LOG = 1  # 引擎 -> GUI：{"lines": [日志, ...], "skipped": 这段时间没有发送的行数}
+ADMIN_STATE = 2  # 引擎 -> GUI：状态快照 {"users": [...], "commands": 命令数, "blobs": {...}, ...}
+ADMIN_RESULT = 3  # 引擎 -> GUI：命令的结果 {"ok": 是否成功, "message": 说明}
+ADMIN_KICK = 4  # GUI -> 引擎：踢出用户，消息体为用户名
+ADMIN_BROADCAST = 5  # GUI -> 引擎：系统广播，消息体为内容
+ADMIN_STOP = 6  # GUI -> 引擎：停止服务器
+ADMIN_HELLO = 7  # GUI -> 引擎：连接后的第一帧，消息体为管理令牌，令牌不对时引擎断开连接
+
+DEFAULT_ADMIN_PORT = 8893
+LOG_INTERVAL = 0.2  # 日志批量发送的间隔（秒）
+MAX_LOG_LINES = 50  # 每批最多发送的行数，超过时只发最新的（采样），其余计入 skipped
+LOG_BUFFER_LINES = 1000  # 等待发送的日志行上限
+STATE_INTERVAL = 1.0  # 状态快照的间隔（秒）
+# 发给某个 GUI 的数据积压超过该值时不再发送日志和快照，直到它读走，
+# 卡住的 GUI 只会错过日志，不会拖慢引擎
+ADMIN_HIGH_WATER = 256 * 1024
+STARTUP_WAIT = 5  # GUI 连接刚启动的引擎时等待它开始监听的时间（秒）
+CONNECT_TIMEOUT = 5
+HELLO_TIMEOUT = 5  # 连接后等待管理令牌的时间（秒）
+TOKEN_SIZE = 16
+
+
+def admin_token_path(port):
+    """管理令牌文件：引擎每次启动时生成，只有运行服务器的用户可以读取"""
+    return os.path.join(tempfile.gettempdir(), f"chatroom-admin-{port}.token")
+
+
+def read_admin_token(port, wait=0):
+    """读取本机引擎的管理令牌，引擎刚启动还没写出时在 wait 秒内重试"""
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            with open(admin_token_path(port), encoding="ascii") as f:
+                return bytes.fromhex(f.read().strip())
+        except FileNotFoundError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+
+
+class AdminServer:
+    """引擎的本机管理端口
+
+    与引擎运行在同一个事件循环中。日志行先放进有上限的缓冲，定时成批发给已连接的管理界面，
+    每批只发最新的若干行；状态快照（在线用户和统计）按固定间隔发送。管理界面发来的
+    踢人、广播和停止命令在事件循环中执行。管理界面慢或卡住时只会少收日志，不影响消息转发。
+    本机的其他用户也能连接管理端口，所以连接后必须先发送管理令牌（保存在只有本用户可读的
+    admin_token_path() 文件中），令牌正确后才发送日志、接受命令。
+    """
+
+    def __init__(self, engine, host="127.0.0.1", port=DEFAULT_ADMIN_PORT):
+        self.engine = engine
+        self.host = host
+        self.port = port  # 0 表示由系统分配，启动后更新为实际端口
+        self.server = None
+        self.token = secrets.token_bytes(TOKEN_SIZE)
+        self.token_path = None
+        self.connections = {}  # 所有管理连接：StreamWriter -> 处理该连接的任务
+        self.writers = set()  # 已通过令牌验证的管理界面
+        self.lines = collections.deque(maxlen=LOG_BUFFER_LINES)
+        self.skipped = 0  # 还没报告的、被采样丢掉的行数
+        self.started = time.time()
+        self._task = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, reuse_address=True)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.token_path = admin_token_path(self.port)
+        self.write_token()
+        self._task = asyncio.get_running_loop().create_task(self.publish())
+
+    def write_token(self):
+        try:
+            os.unlink(self.token_path)  # 旧文件的权限可能更宽，重新创建
+        except FileNotFoundError:
+            pass
+        fd = os.open(self.token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w", encoding="ascii") as f:
+            f.write(self.token.hex())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        # 关闭连接后等处理任务读到连接结束自行退出
+        tasks = list(self.connections.values())
+        for writer in self.connections:
+            writer.close()
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+        self.connections.clear()
+        self.writers.clear()
+        if self.token_path is not None:
+            try:
+                os.unlink(self.token_path)
+            except OSError:
+                pass
+
+    def add_log(self, message):
+        """记录一行日志（没有管理界面连接时直接丢弃）"""
+        if not self.writers:
+            return
+        if len(self.lines) == self.lines.maxlen:
+            self.skipped += 1
+        self.lines.append(message)
+
+    async def handle_connection(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
+        try:
+            try:
+                hello = await asyncio.wait_for(read_control_frame(reader), HELLO_TIMEOUT)
+            except asyncio.TimeoutError:
+                hello = None
+            if (hello is None or hello.msg_type != ADMIN_HELLO
+                    or not hmac.compare_digest(bytes(hello.body), self.token)):
+                self.engine.log(f"管理连接 {writer.get_extra_info('peername')} 令牌不正确，已断开")
+                return
+            self.writers.add(writer)
+            self.send(writer, ADMIN_STATE, self.state())
+            while True:
+                frame = await read_control_frame(reader)
+                if frame is None:
+                    break
+                self.handle_command(writer, frame)
+        except (ConnectionError, OSError, MessageFormatError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            self.writers.discard(writer)
+            writer.close()
+
+    def handle_command(self, writer, frame):
+        engine = self.engine
+        if frame.msg_type == ADMIN_KICK:
+            username = frame.text()
+            if engine.kick_user(username):
+                self.send(writer, ADMIN_RESULT, {"ok": True, "message": f"已踢出用户: {username}"})
+            else:
+                self.send(writer, ADMIN_RESULT,
+                          {"ok": False, "message": f"用户 {username} 不在线或不在本服务器上"})
+        elif frame.msg_type == ADMIN_BROADCAST:
+            message = frame.text()
+            engine.system_broadcast(message)
+            self.send(writer, ADMIN_RESULT, {"ok": True, "message": f"系统广播: {message}"})
+        elif frame.msg_type == ADMIN_STOP:
+            engine.log("管理界面要求停止服务器")
+            engine.stop()
+
+    def send(self, writer, msg_type, value):
+        writer.write(Frame(msg_type, json.dumps(value).encode()).encode())
+
+    def broadcast(self, msg_type, value):
+        """发给所有积压不多的管理界面，返回是否至少发给了一个"""
+        data = None
+        for writer in self.writers:
+            if writer.transport.get_write_buffer_size() > ADMIN_HIGH_WATER:
+                continue
+            if data is None:
+                data = Frame(msg_type, json.dumps(value).encode()).encode()
+            writer.write(data)
+        return data is not None
+
+    async def publish(self):
+        next_state = 0.0
+        while True:
+            await asyncio.sleep(LOG_INTERVAL)
+            if not self.writers:
+                self.lines.clear()
+                self.skipped = 0
+                continue
+            if self.lines:
+                batch = list(self.lines)
+                self.lines.clear()
+                skipped = self.skipped + max(0, len(batch) - MAX_LOG_LINES)
+                batch = batch[-MAX_LOG_LINES:]
+                if self.broadcast(ADMIN_LOG, {"lines": batch, "skipped": skipped}):
+                    self.skipped = 0
+                else:
+                    self.skipped = skipped + len(batch)
+            now = time.monotonic()
+            if now >= next_state:
+                next_state = now + STATE_INTERVAL
+                self.broadcast(ADMIN_STATE, self.state())
+
+    def state(self):
+        engine = self.engine
+        commands = engine.command_stats()
+        return {"host": engine.host, "port": engine.port,
+                "uptime": time.time() - self.started,
+                "users": engine.online_users(),
+                "remote_users": len(engine.remote_ids),
+                "commands": sum(item["count"] for item in commands),
+                "errors": sum(item["errors"] for item in commands),
+                "video": engine.video_stats(),
+                "blobs": engine.blob_stats(),
+                "downloads": engine.download_stats(),
+                "media": engine.media_stats()}
+
+
+class AdminClient:
+    """管理界面一侧的连接
+
+    后台线程读取引擎发来的消息，放进 events 队列（("log", lines, skipped) / ("state", dict) /
+    ("result", dict) / ("closed", 原因)），由界面线程定时取出，界面线程不会被网络阻塞，
+    网络线程也不直接操作界面。token 为 None 时从本机的令牌文件读取。
+    """
+
+    def __init__(self, host, port, token=None, wait=0):
+        self.events = queue.Queue()
+        deadline = time.monotonic() + wait
+        self.sock = self.connect(host, port, wait)
+        try:
+            if token is None:
+                token = read_admin_token(port, max(0.0, deadline - time.monotonic()))
+            self.sock.sendall(Frame(ADMIN_HELLO, token).encode())
+        except OSError:
+            self.sock.close()
+            raise
+        self.reader = FrameReader(self.sock)
+        self.lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @staticmethod
+    def connect(host, port, wait):
+        """连接管理端口，引擎刚启动还没开始监听时在 wait 秒内重试"""
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                return socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+            except ConnectionRefusedError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+    def run(self):
+        reason = "服务器已关闭管理连接"
+        accepted = False  # 令牌正确时引擎先发一个状态快照
+        self.sock.settimeout(None)
+        try:
+            while True:
+                payload = self.reader.read_frame()
+                if payload is None:
+                    if not accepted:
+                        reason = "服务器拒绝了管理连接（管理令牌不正确）"
+                    break
+                accepted = True
+                frame = Frame.decode(payload)
+                value = json.loads(frame.text())
+                if frame.msg_type == ADMIN_LOG:
+                    self.events.put(("log", value["lines"], value["skipped"]))
+                elif frame.msg_type == ADMIN_STATE:
+                    self.events.put(("state", value))
+                elif frame.msg_type == ADMIN_RESULT:
+                    self.events.put(("result", value))
+        except (OSError, ValueError, KeyError, MessageFormatError) as e:
+            if not self.closed:
+                reason = f"管理连接出错: {e}"
+        self.closed = True
+        self.events.put(("closed", reason))
+
+    def send(self, msg_type, text=""):
+        with self.lock:
+            self.sock.sendall(Frame(msg_type, text.encode()).encode())
+
+    def kick(self, username):
+        self.send(ADMIN_KICK, username)
+
+    def broadcast(self, message):
+        self.send(ADMIN_BROADCAST, message)
+
+    def stop_server(self):
+        self.send(ADMIN_STOP)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
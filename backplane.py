@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import struct
+
+from protocol import (LENGTH_PREFIX, FRAME_HEADER, DEFAULT_MAX_FRAME_SIZE, Frame,
+                      MessageFormatError)
+
+# 节点（聊天服务器进程）之间的发布订阅总线。用户ID的高 8 位是节点号，各节点分配的用户ID互不重复，
+# 所以最多 256 个节点，每个节点进程最多分配 2^24 - 1 个用户ID
+NODE_SHIFT = 24
+MAX_NODES = 256
+
+# 节点 <-> 消息代理（broker）连接上的消息，使用 v2 帧格式；房间ID为节点号
+BUS_HELLO = 1  # 节点 -> 代理：收到 BUS_CHALLENGE 后发送，消息体为 HMAC-SHA256(共享密钥, 随机数)
+BUS_PRESENCE = 2  # 节点的全部在线用户 JSON [[用户ID, 用户名], ...]，连上代理时发送；
+                  # 代理转发给其他节点，节点断开时代理以空列表通知其他节点
+BUS_BROADCAST = 3  # 广播消息（pack_bus_message），转发给其他所有节点
+BUS_DIRECT = 4  # 发给一个用户的消息（pack_bus_message），用户ID为目标用户，代理按目录只转发给他所在的节点
+BUS_USER_ONLINE = 5  # 用户上线（订阅发给他的消息），用户ID为该用户，消息体为用户名
+BUS_USER_OFFLINE = 6  # 用户下线（取消订阅），用户ID为该用户
+BUS_CHALLENGE = 7  # 代理 -> 节点：连接建立后先发送，消息体为随机数
+
+BUS_META_LENGTH = struct.Struct('!H')
+# 总线帧 = 消息元数据 + 一条完整的下行帧，所以上限比客户端的单帧上限略大
+MAX_BUS_FRAME = DEFAULT_MAX_FRAME_SIZE + 64 * 1024
+DEFAULT_BROKER_PORT = 8892
+RECONNECT_INTERVAL = 1  # 与代理的连接断开后的重连间隔（秒）
+# 转发给某个节点的数据积压超过该值时丢弃发给它的消息，一个卡住的节点不拖累其他节点
+BROKER_HIGH_WATER = 16 * 1024 * 1024
+HELLO_TIMEOUT = 5  # 代理等待节点握手的时间（秒）
+NONCE_SIZE = 16
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def pack_bus_message(frame, name=None, text=None):
+    """总线上的一条下行消息：元数据长度(2) + JSON [发送者用户名, 旧版文本] + 帧头 + 消息体
+
+    接收的节点据此重建 OutboundMessage，按各自客户端的协议编码。
+    """
+    meta = json.dumps([name, text]).encode() if name is not None or text is not None else b''
+    return b''.join((BUS_META_LENGTH.pack(len(meta)), meta,
+                     FRAME_HEADER.pack(frame.msg_type, frame.flags, frame.room,
+                                       frame.user, frame.seq),
+                     frame.body))
+
+
+def unpack_bus_message(body):
+    """解析总线消息，返回 (帧, 发送者用户名, 旧版文本)"""
+    body = memoryview(body)
+    if len(body) < BUS_META_LENGTH.size:
+        raise MessageFormatError("总线消息不完整")
+    meta_end = BUS_META_LENGTH.size + BUS_META_LENGTH.unpack_from(body)[0]
+    name = text = None
+    if meta_end > BUS_META_LENGTH.size:
+        try:
+            name, text = json.loads(str(body[BUS_META_LENGTH.size:meta_end], 'utf-8'))
+        except ValueError:
+            raise MessageFormatError("总线消息格式不正确")
+    return Frame.decode(body[meta_end:]), name, text
+
+
+def unpack_presence(body):
+    """解析在线用户列表，返回 {用户ID: 用户名}"""
+    try:
+        return {int(user_id): str(name) for user_id, name in json.loads(str(body, 'utf-8'))}
+    except (ValueError, TypeError):
+        raise MessageFormatError("在线用户列表格式不正确")
+
+
+def parse_address(text):
+    """"host:port" 为 TCP 地址，返回 (host, port)；其他按 Unix 域套接字路径原样返回"""
+    host, sep, port = text.rpartition(":")
+    if sep and host and port.isdigit():
+        return host, int(port)
+    return text
+
+
+def bus_auth(secret, nonce):
+    """节点握手的认证码，没有共享密钥时为空"""
+    if not secret:
+        return b''
+    return hmac.new(secret, nonce, hashlib.sha256).digest()
+
+
+def read_secret(path):
+    """从文件读取共享密钥（去掉首尾空白），文件为空时抛出 ValueError"""
+    with open(path, 'rb') as f:
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError(f"密钥文件 {path} 为空")
+    return secret
+
+
+async def read_bus_frame(reader):
+    """从总线连接读取一帧，连接关闭时返回 None"""
+    try:
+        header = await reader.readexactly(LENGTH_PREFIX.size)
+        length = LENGTH_PREFIX.unpack(header)[0]
+        if length > MAX_BUS_FRAME:
+            raise MessageFormatError(f"总线帧长度 {length} 超过上限")
+        return Frame.decode(await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+async def open_bus_connection(address):
+    if isinstance(address, tuple):
+        return await asyncio.open_connection(*address)
+    return await asyncio.open_unix_connection(address)
+
+
+class Broker:
+    """消息代理：节点之间的发布订阅中心
+
+    单独的进程，监听 TCP 地址 (host, port) 或 Unix 域套接字路径。每个节点订阅广播，
+    并通过用户上线 / 下线订阅和取消订阅发给自己用户的消息。代理维护全局的用户目录
+    （用户ID -> 节点），私聊按目录只转发给目标用户所在的节点，发送方不需要知道对方在哪个节点。
+    节点（重新）连上时先把其他节点的在线用户发给它；节点断开时通知其他节点它的用户已全部下线。
+    代理只看帧头，不解析转发的消息内容。
+
+    总线上的节点可以冒充任何用户发消息，所以给出 secret（共享密钥）时节点必须先通过
+    质询：代理发送随机数，节点回复 HMAC-SHA256(secret, 随机数)，不对时断开。没有密钥时
+    只应监听本机地址或权限为 0600 的 Unix 域套接字。
+    """
+
+    def __init__(self, address, on_log=None, secret=None):
+        self.address = address
+        self.on_log = on_log
+        self.secret = secret
+        self.server = None
+        self.nodes = {}  # 节点号 -> 连接的 StreamWriter
+        self.users = {}  # 节点号 -> {用户ID: 用户名}
+        self.directory = {}  # 用户ID -> 节点号
+        self.forwarded = 0
+        self.dropped = 0
+
+    async def start(self):
+        if isinstance(self.address, tuple):
+            self.server = await asyncio.start_server(
+                self.handle_node, self.address[0], self.address[1], reuse_address=True)
+            self.address = self.server.sockets[0].getsockname()[:2]
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)  # 上次异常退出留下的套接字文件
+            self.server = await asyncio.start_unix_server(self.handle_node, self.address)
+            os.chmod(self.address, 0o600)  # 只有运行代理的用户可以连接
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in self.nodes.values():
+            writer.close()
+        self.nodes.clear()
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def log(self, message):
+        if self.on_log:
+            self.on_log(message)
+
+    async def handle_node(self, reader, writer):
+        node = None
+        try:
+            nonce = secrets.token_bytes(NONCE_SIZE)
+            writer.write(Frame(BUS_CHALLENGE, nonce).encode())
+            try:
+                hello = await asyncio.wait_for(read_bus_frame(reader), HELLO_TIMEOUT)
+            except asyncio.TimeoutError:
+                hello = None
+            if hello is None or hello.msg_type != BUS_HELLO:
+                return
+            if self.secret and not hmac.compare_digest(bytes(hello.body),
+                                                       bus_auth(self.secret, nonce)):
+                self.log(f"节点 {hello.room} 的共享密钥不正确，已断开: "
+                         f"{writer.get_extra_info('peername')}")
+                return
+            node = hello.room
+            old = self.nodes.get(node)
+            if old is not None:
+                old.close()
+            self.nodes[node] = writer
+            for other, users in self.users.items():
+                if other != node:
+                    writer.write(Frame(BUS_PRESENCE, json.dumps(list(users.items())).encode(),
+                                       room=other).encode())
+            self.log(f"节点 {node} 已连接")
+            while True:
+                frame = await read_bus_frame(reader)
+                if frame is None:
+                    break
+                if frame.msg_type == BUS_BROADCAST:
+                    self.forward_all(node, frame)
+                elif frame.msg_type == BUS_DIRECT:
+                    target = self.nodes.get(self.directory.get(frame.user))
+                    if target is not None:
+                        self.forward(target, frame.encode())
+                elif frame.msg_type == BUS_USER_ONLINE:
+                    self.users.setdefault(node, {})[frame.user] = frame.text()
+                    self.directory[frame.user] = node
+                    self.forward_all(node, frame)
+                elif frame.msg_type == BUS_USER_OFFLINE:
+                    self.users.get(node, {}).pop(frame.user, None)
+                    if self.directory.get(frame.user) == node:
+                        del self.directory[frame.user]
+                    self.forward_all(node, frame)
+                elif frame.msg_type == BUS_PRESENCE:
+                    self.set_users(node, unpack_presence(frame.body))
+                    self.forward_all(node, frame)
+        except (ConnectionError, OSError, MessageFormatError) as e:
+            self.log(f"节点 {node} 的连接出错: {e}")
+        finally:
+            writer.close()
+            if node is not None and self.nodes.get(node) is writer:
+                del self.nodes[node]
+                self.set_users(node, {})
+                self.forward_all(node, Frame(BUS_PRESENCE, b'[]'))
+                self.log(f"节点 {node} 已断开，通知其他节点它的用户已下线")
+
+    def set_users(self, node, users):
+        """替换节点的全部在线用户，同步更新目录"""
+        for user_id in self.users.pop(node, {}):
+            if self.directory.get(user_id) == node:
+                del self.directory[user_id]
+        if users:
+            self.users[node] = users
+            for user_id in users:
+                self.directory[user_id] = node
+
+    def forward_all(self, node, frame):
+        """转发给来源节点以外的所有节点，帧头的房间ID改为来源节点（只编码一次）"""
+        data = Frame(frame.msg_type, frame.body, room=node, user=frame.user).encode()
+        for other, writer in self.nodes.items():
+            if other != node:
+                self.forward(writer, data)
+
+    def forward(self, writer, data):
+        if writer.transport.get_write_buffer_size() > BROKER_HIGH_WATER:
+            self.dropped += 1
+            return
+        writer.write(data)
+        self.forwarded += 1
+
+    def stats(self):
+        return {"nodes": len(self.nodes), "users": len(self.directory),
+                "forwarded": self.forwarded, "dropped": self.dropped}
+
+
+class Backplane:
+    """节点之间的发布订阅接口（可替换实现）
+
+    聊天服务器引擎通过 attach() 注册为监听者，之后发布广播、用户上线 / 下线和发给某个用户的消息；
+    收到其他节点的事件时在引擎的事件循环中回调监听者：
+      backplane_connected()                         连上（或重新连上）总线，应重新发布在线用户
+      backplane_disconnected()                      与总线断开，其他节点的用户视为下线
+      remote_presence(node, users)                  节点 node 的全部在线用户 {用户ID: 用户名}
+      remote_user_online(node, user_id, name)
+      remote_user_offline(node, user_id)
+      remote_broadcast(frame, name, text)           其他节点的广播
+      remote_direct(user_id, frame, name, text)     发给本节点用户 user_id 的消息
+    """
+
+    listener = None
+    node = 0
+
+    def attach(self, listener, node):
+        self.listener = listener
+        self.node = node
+
+    @property
+    def connected(self):
+        raise NotImplementedError
+
+    def start(self):
+        """在事件循环中开始连接"""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def presence(self, users):
+        """发布本节点的全部在线用户 [(用户ID, 用户名), ...]"""
+        raise NotImplementedError
+
+    def user_online(self, user_id, name):
+        raise NotImplementedError
+
+    def user_offline(self, user_id):
+        raise NotImplementedError
+
+    def broadcast(self, frame, name=None, text=None):
+        """把一条下行消息广播给其他节点的所有客户端"""
+        raise NotImplementedError
+
+    def direct(self, user_id, frame, name=None, text=None):
+        """把一条下行消息发给其他节点上的用户 user_id"""
+        raise NotImplementedError
+
+
+class BrokerBackplane(Backplane):
+    """经消息代理（Broker）实现的总线，地址为 (host, port) 或 Unix 域套接字路径
+
+    连接断开后定时重连，每次连上后回调 backplane_connected()，由引擎重新发布在线用户。
+    secret 为与代理约定的共享密钥，用于回答代理的质询。
+    """
+
+    def __init__(self, address, on_log=None, secret=None):
+        self.address = address
+        self.on_log = on_log
+        self.secret = secret
+        self.writer = None
+        self._task = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def log(self, message):
+        if self.on_log:
+            self.on_log(message)
+
+    async def run(self):
+        reported = False  # 同一次断开只记录一次日志
+        while True:
+            try:
+                reader, writer = await open_bus_connection(self.address)
+            except OSError as e:
+                if not reported:
+                    self.log(f"无法连接消息代理 {self.address}: {e}，只能与本节点的用户聊天")
+                    reported = True
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            try:
+                challenge = await read_bus_frame(reader)
+                if challenge is None or challenge.msg_type != BUS_CHALLENGE:
+                    raise MessageFormatError("消息代理握手失败")
+                writer.write(Frame(BUS_HELLO, bus_auth(self.secret, bytes(challenge.body)),
+                                   room=self.node).encode())
+                self.writer = writer
+                reported = False
+                self.log("已连接消息代理")
+                self.listener.backplane_connected()
+                while True:
+                    frame = await read_bus_frame(reader)
+                    if frame is None:
+                        break
+                    try:
+                        self.dispatch(frame)
+                    except MessageFormatError as e:
+                        self.log(f"总线消息格式不正确: {e}")
+            except (ConnectionError, OSError, MessageFormatError) as e:
+                self.log(f"消息代理连接出错: {e}")
+            finally:
+                writer.close()
+                if self.writer is writer:
+                    self.writer = None
+                    self.log("与消息代理的连接已断开，只能与本节点的用户聊天")
+                    self.listener.backplane_disconnected()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    def dispatch(self, frame):
+        listener = self.listener
+        if frame.msg_type == BUS_BROADCAST:
+            listener.remote_broadcast(*unpack_bus_message(frame.body))
+        elif frame.msg_type == BUS_DIRECT:
+            listener.remote_direct(frame.user, *unpack_bus_message(frame.body))
+        elif frame.msg_type == BUS_USER_ONLINE:
+            listener.remote_user_online(frame.room, frame.user, frame.text())
+        elif frame.msg_type == BUS_USER_OFFLINE:
+            listener.remote_user_offline(frame.room, frame.user)
+        elif frame.msg_type == BUS_PRESENCE:
+            listener.remote_presence(frame.room, unpack_presence(frame.body))
+
+    def send(self, msg_type, body=b'', user=0):
+        if self.writer is not None:
+            self.writer.write(Frame(msg_type, body, room=self.node, user=user).encode())
+
+    def presence(self, users):
+        self.send(BUS_PRESENCE, json.dumps(users).encode())
+
+    def user_online(self, user_id, name):
+        self.send(BUS_USER_ONLINE, name.encode(), user_id)
+
+    def user_offline(self, user_id):
+        self.send(BUS_USER_OFFLINE, b'', user_id)
+
+    def broadcast(self, frame, name=None, text=None):
+        self.send(BUS_BROADCAST, pack_bus_message(frame, name, text))
+
+    def direct(self, user_id, frame, name=None, text=None):
+        self.send(BUS_DIRECT, pack_bus_message(frame, name, text), user_id)
+
+
+def run_broker(address, on_log=print, secret=None):
+    """运行消息代理直到进程结束（可作为 multiprocessing.Process 的入口）"""
+    async def serve():
+        broker = Broker(address, on_log, secret)
+        await broker.start()
+        broker.log(f"消息代理已启动: {broker.address}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await broker.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="集群模式的消息代理（节点之间转发广播、私聊和在线用户）")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=DEFAULT_BROKER_PORT, help="监听端口")
+    parser.add_argument("--unix", help="改为监听 Unix 域套接字路径（权限 0600，只有本用户可以连接）")
+    parser.add_argument("--secret-file", help="共享密钥文件，各节点用 server.py --broker-secret-file 指定同一文件")
+    args = parser.parse_args()
+    secret = None
+    if args.secret_file:
+        try:
+            secret = read_secret(args.secret_file)
+        except (OSError, ValueError) as e:
+            parser.error(f"无法读取共享密钥: {e}")
+    elif not args.unix and args.host not in LOOPBACK_HOSTS:
+        # 能连上代理的人可以冒充任何用户发消息，监听外部地址时必须认证节点
+        parser.error("监听非本机地址时必须用 --secret-file 指定共享密钥，并且只在可信网络中开放端口")
+    run_broker(args.unix or (args.host, args.port), secret=secret)
+
+
+if __name__ == "__main__":
+    main()
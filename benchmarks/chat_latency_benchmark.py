@@ -0,0 +1,216 @@
+"""文件和视频负载下的聊天延迟：单连接 vs 数据连接（bulk_channel）
+
+接收方同时收一个大文件（私聊发送，服务器从文件仓库分块发出）和一路视频，
+另一个客户端每隔 --interval 秒给它发一条私聊，消息中带发送时间，接收方记录收到的延迟。
+  single  不声明 bulk_channel，聊天、文件块和视频帧排在同一条连接上
+  bulk    声明 bulk_channel，文件和视频走数据连接，聊天连接只有聊天和信令
+
+接收方按 --rate 限速读取承载文件和视频的连接（模拟较慢的下行链路），聊天连接不限速；
+单连接时聊天也在这条限速的连接上。服务器在子进程中运行。
+
+用法: python benchmarks/chat_latency_benchmark.py [--size MB] [--rate MB/s] [--duration 秒]
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import (  # noqa: E402
+    FrameReader, Frame, encode_frame, encode_hello, pack_file_body, pack_file_have,
+    unpack_file_offer, unpack_file_complete, chunk_count, empty_chunk_bitmap,
+    full_chunk_bitmap, CAP_BINARY_MEDIA, CAP_BULK_CHANNEL, FLAG_PRIVATE,
+    MSG_WELCOME, MSG_PRIVATE, MSG_FILE, MSG_FILE_OFFER,
+    MSG_FILE_COMPLETE, MSG_FILE_HAVE, MSG_VIDEO_DATA)
+
+VIDEO_FRAME_SIZE = 30 * 1024
+VIDEO_FPS = 30
+SOCKET_BUFFER = 64 * 1024  # 限速连接的接收缓冲，避免内核缓冲吸收掉积压
+
+
+def serve(args):
+    """子进程：启动引擎，收到 quit 后退出"""
+    from chat_engine import ChatEngine
+
+    engine = ChatEngine("127.0.0.1", 0, blob_dir=args.store, download_port=None)
+    engine.start()
+    print(json.dumps({"port": engine.server.sockets[0].getsockname()[1]}), flush=True)
+    sys.stdin.readline()
+    engine.stop()
+
+
+class Client:
+    """测试客户端：握手后记录自己的用户ID，bulk=True 时连上数据连接"""
+
+    def __init__(self, port, name, bulk):
+        self.port = port
+        self.sock = self.connect()
+        caps = [CAP_BINARY_MEDIA] + ([CAP_BULK_CHANNEL] if bulk else [])
+        self.sock.sendall(encode_frame(encode_hello(name, caps)))
+        self.reader = FrameReader(self.sock)
+        self.lock = threading.Lock()
+        self.bulk_sock = self.bulk_reader = None
+        self.bulk_lock = threading.Lock()
+        self.transfers = {}  # 传输ID -> 块数（文件请求和完成消息可能从不同连接收到）
+        while True:
+            frame = Frame.decode(self.reader.read_frame())
+            if frame.msg_type == MSG_WELCOME:
+                self.user_id = frame.user
+                token = json.loads(frame.text()).get("bulk_token")
+                break
+        if bulk and token:
+            self.bulk_sock = self.connect()
+            self.bulk_sock.sendall(encode_frame(encode_hello(name, [], bulk_token=token)))
+            self.bulk_reader = FrameReader(self.bulk_sock)
+
+    def connect(self):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        sock.connect(("127.0.0.1", self.port))
+        return sock
+
+    def send(self, msg_type, body=b'', flags=0, user=0, bulk=False):
+        sock, lock = (self.bulk_sock, self.bulk_lock) if bulk and self.bulk_sock else \
+            (self.sock, self.lock)
+        with lock:
+            sock.sendall(Frame(msg_type, body, flags, user=user).encode())
+
+    def close(self):
+        for sock in (self.sock, self.bulk_sock):
+            if sock is not None:
+                sock.close()
+
+
+def receive(client, reader, rate, latencies, received, stop):
+    """读取一条连接：rate 不为 None 时按该速度限速；回复文件请求，记录私聊的延迟"""
+    while not stop.is_set():
+        try:
+            payload = reader.read_frame()
+        except OSError:
+            return
+        if payload is None:
+            return
+        now = time.perf_counter()
+        if rate:
+            time.sleep(len(payload) / rate)
+        received[0] += len(payload)
+        frame = Frame.decode(payload)
+        if frame.msg_type == MSG_PRIVATE:
+            latencies.append(now - float(frame.text()))
+        elif frame.msg_type == MSG_FILE_OFFER:
+            transfer_id, _, size, _, chunk_size = unpack_file_offer(frame.body)
+            count = chunk_count(size, chunk_size)
+            client.transfers[transfer_id] = count
+            client.send(MSG_FILE_HAVE, pack_file_have(transfer_id, empty_chunk_bitmap(count)),
+                        user=frame.user)
+        elif frame.msg_type == MSG_FILE_COMPLETE:
+            transfer_id, _ = unpack_file_complete(frame.body)
+            client.send(MSG_FILE_HAVE, pack_file_have(
+                transfer_id, full_chunk_bitmap(client.transfers.get(transfer_id, 0))),
+                user=frame.user)
+
+
+def run(port, bulk, args):
+    receiver = Client(port, "receiver", bulk)
+    loader = Client(port, "loader", bulk)
+    chatter = Client(port, "chatter", False)
+    time.sleep(0.3)
+    stop = threading.Event()
+    latencies = []
+    received = [0]
+    rate = args.rate * 1024 * 1024
+    threads = []
+    if receiver.bulk_reader is not None:
+        threads.append(threading.Thread(target=receive, args=(
+            receiver, receiver.reader, None, latencies, received, stop)))
+        threads.append(threading.Thread(target=receive, args=(
+            receiver, receiver.bulk_reader, rate, latencies, received, stop)))
+    else:
+        threads.append(threading.Thread(target=receive, args=(
+            receiver, receiver.reader, rate, latencies, received, stop)))
+    for reader in (loader.reader, chatter.reader):
+        threads.append(threading.Thread(target=receive, args=(
+            None, reader, None, [], [0], stop)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # 负载：一个大文件 + 一路视频
+    data = os.urandom(args.size * 1024 * 1024)
+    loader.send(MSG_FILE, pack_file_body("payload.bin", data), FLAG_PRIVATE,
+                receiver.user_id, bulk=True)
+    video = os.urandom(VIDEO_FRAME_SIZE)
+
+    def send_video():
+        while not stop.is_set():
+            loader.send(MSG_VIDEO_DATA, video, user=receiver.user_id, bulk=True)
+            time.sleep(1 / VIDEO_FPS)
+
+    video_thread = threading.Thread(target=send_video, daemon=True)
+    video_thread.start()
+
+    sent = 0
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        chatter.send(MSG_PRIVATE, repr(time.perf_counter()).encode(),
+                     user=receiver.user_id)
+        sent += 1
+        time.sleep(args.interval)
+    time.sleep(1.0)  # 给最后几条消息一点时间
+    stop.set()
+    for client in (receiver, loader, chatter):
+        client.close()
+    return sent, sorted(latencies), received[0]
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=20, help="文件大小（MB）")
+    parser.add_argument("--rate", type=float, default=4.0, help="接收方数据下行速度（MB/s）")
+    parser.add_argument("--duration", type=float, default=8.0, help="发送聊天消息的时长（秒）")
+    parser.add_argument("--interval", type=float, default=0.02, help="聊天消息间隔（秒）")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--store", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    print(f"文件 {args.size}MB + 视频 {VIDEO_FRAME_SIZE // 1024}KB x {VIDEO_FPS}fps，"
+          f"下行限速 {args.rate}MB/s，聊天每 {args.interval * 1000:.0f}ms 一条")
+    print(f"{'':>6} | {'收到/发出':>10} | {'p50':>8} {'p99':>8} {'max':>8} | {'收到数据':>8}")
+    for name, bulk in (("single", False), ("bulk", True)):
+        store = tempfile.mkdtemp(prefix="latency_bench_")
+        server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve", "--store", store],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        try:
+            port = json.loads(server.stdout.readline())["port"]
+            sent, latencies, received = run(port, bulk, args)
+        finally:
+            server.stdin.write("quit\n")
+            server.stdin.flush()
+            server.wait()
+            shutil.rmtree(store, ignore_errors=True)
+        print(f"{name:>6} | {len(latencies):>4}/{sent:<5} | "
+              f"{percentile(latencies, 0.5) * 1000:>6.1f}ms "
+              f"{percentile(latencies, 0.99) * 1000:>6.1f}ms "
+              f"{(latencies[-1] if latencies else float('nan')) * 1000:>6.1f}ms | "
+              f"{received / 1024 / 1024:>6.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""文件下载吞吐量对比：旧版 base64 整帧转发 vs 下载端口（sendfile）
+
+两种方式都由一个发送方把同一个文件发给 N 个客户端：
+  relay     旧版文本协议，发送方发一条 /FILE|，服务器把 base64 文本整条转发给每个接收方
+  sendfile  文件已在服务器的文件仓库中，N 个客户端同时凭票据从下载端口获取
+
+服务器在子进程中运行，结果包括总吞吐量和服务器进程消耗的 CPU 时间。
+
+用法: python benchmarks/download_benchmark.py [--size MB] [--clients N]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import FrameReader, FILE_CHUNK_SIZE, send_message  # noqa: E402
+from file_transfer import IncomingTransfer  # noqa: E402
+
+
+def serve(args):
+    """子进程：启动引擎，把测试文件放进仓库并签发票据，收到 quit 后报告 CPU 时间"""
+    from chat_engine import ChatEngine
+
+    with open(args.file, 'rb') as f:
+        data = f.read()
+    engine = ChatEngine("127.0.0.1", 0, blob_dir=args.store, download_port=0,
+                        max_frame_size=len(data) * 2 + 1024,
+                        outbound_high_watermark=len(data) * 2 + 1024)
+    sha256 = asyncio.run(engine.blobs.put_bytes(data))
+    del data
+    engine.start()
+    tickets = [engine.call_in_loop(engine.downloads.issue_ticket, sha256,
+                                   os.path.getsize(args.file)).hex()
+               for _ in range(args.clients)]
+    print(json.dumps({"port": engine.server.sockets[0].getsockname()[1],
+                      "download_port": engine.downloads.port,
+                      "sha256": sha256, "tickets": tickets}), flush=True)
+    start = time.process_time()
+    sys.stdin.readline()
+    print(json.dumps({"cpu": time.process_time() - start}), flush=True)
+    engine.stop()
+
+
+def start_server(path, store, clients):
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--file", path,
+         "--store", store, "--clients", str(clients)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    return server, json.loads(server.stdout.readline())
+
+
+def stop_server(server):
+    server.stdin.write("quit\n")
+    server.stdin.flush()
+    cpu = json.loads(server.stdout.readline())["cpu"]
+    server.wait()
+    return cpu
+
+
+def run_relay(path, info, clients):
+    """旧版客户端：发送方发一条 /FILE|，等所有接收方收到"""
+    with open(path, 'rb') as f:
+        message = "/FILE|" + os.path.basename(path) + "|" + str(os.path.getsize(path)) + \
+            "|" + base64.b64encode(f.read()).decode('ascii')
+    receivers = []
+    for i in range(clients):
+        sock = socket.create_connection(("127.0.0.1", info["port"]))
+        send_message(sock, f"recv{i}")
+        receivers.append((sock, FrameReader(sock)))
+    sender = socket.create_connection(("127.0.0.1", info["port"]))
+    send_message(sender, "sender")
+    time.sleep(0.5)
+    for _, reader in receivers:
+        reader.sock.settimeout(0.2)
+        try:
+            while reader.read_frame() is not None:
+                pass  # 丢弃上线通知和用户列表
+        except socket.timeout:
+            pass
+        reader.sock.settimeout(None)
+
+    received = []
+
+    def receive(reader):
+        while True:
+            text = reader.read_message()
+            # 旧版客户端收到的是 "发送者：/FILE|文件名|大小|base64"
+            if text is None or text.find("/FILE|", 0, 64) >= 0:
+                received.append(text is not None)
+                return
+
+    threads = [threading.Thread(target=receive, args=(reader,)) for _, reader in receivers]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    send_message(sender, message)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    for sock, _ in receivers:
+        sock.close()
+    sender.close()
+    return elapsed, all(received) and len(received) == clients
+
+
+def run_sendfile(path, info, clients, directory):
+    """每个客户端用自己的票据并发下载同一个文件"""
+    size = os.path.getsize(path)
+    results = []
+
+    def download(i, ticket):
+        target = os.path.join(directory, str(i))
+        os.makedirs(target)
+        transfer = IncomingTransfer("sender", i, os.path.basename(path), size,
+                                    info["sha256"], FILE_CHUNK_SIZE, target)
+        transfer.download("127.0.0.1", info["download_port"], bytes.fromhex(ticket))
+        results.append(transfer.finish(bytes.fromhex(info["sha256"])))
+
+    threads = [threading.Thread(target=download, args=(i, ticket))
+               for i, ticket in enumerate(info["tickets"])]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return elapsed, all(results) and len(results) == clients
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=20, help="文件大小（MB）")
+    parser.add_argument("--clients", type=int, default=8, help="接收方数量")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--file", help=argparse.SUPPRESS)
+    parser.add_argument("--store", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    directory = tempfile.mkdtemp(prefix="download_bench_")
+    try:
+        path = os.path.join(directory, "payload.bin")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(args.size * 1024 * 1024))
+        total = args.size * args.clients
+        print(f"文件 {args.size}MB，接收方 {args.clients} 个，共 {total}MB")
+        for name in ("relay", "sendfile"):
+            store = os.path.join(directory, name + "_store")
+            server, info = start_server(path, store, args.clients)
+            try:
+                if name == "relay":
+                    elapsed, ok = run_relay(path, info, args.clients)
+                else:
+                    elapsed, ok = run_sendfile(path, info, args.clients,
+                                               os.path.join(directory, name))
+            finally:
+                cpu = stop_server(server)
+            print(f"{name:>9}: {elapsed:7.3f}s  {total / elapsed:8.1f} MB/s  "
+                  f"服务器 CPU {cpu:6.3f}s  {'OK' if ok else '失败'}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
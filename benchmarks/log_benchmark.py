@@ -0,0 +1,82 @@
+"""服务器日志的 CPU 占用：逐行 print / 写文件与 LogPipeline 成批写出对比
+
+以 --rate 条/秒的速度产生 --duration 秒日志（模拟引擎每处理一条聊天消息记一行），
+统计整个进程（含后台写出线程）的 CPU 时间占墙钟时间的比例，以及不记日志时的基准。
+控制台输出写到 --stream 指定的文件（默认 /dev/null，在终端中运行时可以用 /dev/tty 看终端本身的开销）。
+
+用法: python benchmarks/log_benchmark.py [--rate 10000] [--duration 3]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_pipeline import LogPipeline  # noqa: E402
+
+
+def produce(log, rate, duration):
+    """按固定速度调用 log()，返回 CPU 时间 / 墙钟时间"""
+    batch = max(1, int(rate / 1000))  # 每毫秒产生一批，避免 sleep 的精度影响速度
+    interval = batch / rate
+    cpu = time.process_time()
+    start = time.perf_counter()
+    due = start
+    count = 0
+    while True:
+        now = time.perf_counter()
+        if now - start >= duration:
+            break
+        for _ in range(batch):
+            if log is not None:
+                log(f"user{count % 100}：第 {count} 条消息")
+            count += 1
+        due += interval
+        time.sleep(max(0.0, due - time.perf_counter()))
+    return cpu, start
+
+
+def measure(name, rate, duration, log=None, close=None):
+    cpu, start = produce(log, rate, duration)
+    if close is not None:
+        close()  # 成批写出的剩余日志也计入
+    used = time.process_time() - cpu
+    wall = time.perf_counter() - start
+    print(f"{name:<24} | CPU {used / wall:>6.1%} | 每条 {used / (rate * duration) * 1e6:>6.2f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=10000, help="每秒日志条数")
+    parser.add_argument("--duration", type=float, default=3.0, help="时长（秒）")
+    parser.add_argument("--stream", default=os.devnull, help="控制台输出写到的文件")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "server.log")
+    print(f"{args.rate:.0f} 条/秒，{args.duration:.0f} 秒")
+    measure("不记日志", args.rate, args.duration)
+
+    with open(args.stream, "w", encoding="utf-8") as stream:
+        measure("逐行 print(flush)", args.rate, args.duration,
+                lambda message: print(message, file=stream, flush=True))
+        with open(path, "a", encoding="utf-8") as f:
+            def write_line(message):
+                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}\n")
+                f.flush()
+            measure("逐行写文件(flush)", args.rate, args.duration, write_line)
+
+        logs = LogPipeline(path, stream).start()
+        measure("LogPipeline 控制台+文件", args.rate, args.duration, logs.emit, logs.close)
+        logs = LogPipeline(path).start()
+        measure("LogPipeline 文件", args.rate, args.duration, logs.emit, logs.close)
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
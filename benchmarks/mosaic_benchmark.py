@@ -0,0 +1,109 @@
+"""多人视频：逐路转发 vs 服务器合成画面（MCU）的开销对比
+
+对每种参与者人数 N，用合成的摄像头画面（640x480，JPEG 质量 35，与客户端相同）比较每个周期：
+  forward  每个客户端下载 N-1 路 JPEG，解码 N-1 次
+  mosaic   服务器解码 N 路、合成并编码一次，每个客户端只下载和解码一路合成画面
+
+不经过网络，只测量编解码和合成的 CPU 时间以及每个客户端的下行数据量。需要 OpenCV 和 NumPy。
+
+用法: python benchmarks/mosaic_benchmark.py [--participants 4 8 12 16] [--ticks 50]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mosaic  # noqa: E402
+from mosaic import MosaicMixer, MOSAIC_FPS  # noqa: E402
+
+CAMERA_SIZE = (640, 480)
+CAMERA_QUALITY = 35
+
+
+def camera_frames(count, ticks):
+    """生成 count 路、每路 ticks 帧的 JPEG：渐变背景 + 移动的色块 + 少量噪声"""
+    cv2, np = mosaic.cv2, mosaic.np
+    width, height = CAMERA_SIZE
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    streams = []
+    for i in range(count):
+        background = np.dstack([(x + y * 0.5 + i * 20) % 256,
+                                np.broadcast_to((y + i * 40) % 256, (height, width)),
+                                np.broadcast_to(x[::-1], (height, width))]).astype(np.uint8)
+        frames = []
+        for t in range(ticks):
+            image = background.copy()
+            cx = int(width / 2 + width / 3 * np.sin(t / 7 + i))
+            cy = int(height / 2 + height / 4 * np.cos(t / 5 + i))
+            cv2.circle(image, (cx, cy), 80, (40 * i % 256, 200, 90), -1)
+            noise = rng.integers(0, 12, image.shape, dtype=np.uint8)
+            image = cv2.add(image, noise)
+            _, encoded = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), CAMERA_QUALITY])
+            frames.append(encoded.tobytes())
+        streams.append(frames)
+    return streams
+
+
+def decode(jpeg_data):
+    cv2, np = mosaic.cv2, mosaic.np
+    return cv2.imdecode(np.frombuffer(jpeg_data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def run(participants, ticks):
+    streams = camera_frames(participants, ticks)
+
+    # forward：以第 0 个参与者为观察者，解码其余 N-1 路
+    downlink = 0
+    started = time.perf_counter()
+    for t in range(ticks):
+        for stream in streams[1:]:
+            downlink += len(stream[t])
+            decode(stream[t])
+    forward_client = (time.perf_counter() - started) / ticks
+    forward_downlink = downlink / ticks
+
+    # mosaic：服务器每周期合成一次，客户端解码一路
+    mixer = MosaicMixer()
+    members = list(range(participants))
+    server_time = client_time = downlink = 0
+    for t in range(ticks):
+        pending = {i: streams[i][t] for i in members}
+        started = time.perf_counter()
+        data = mixer.compose(pending, members)
+        server_time += time.perf_counter() - started
+        downlink += len(data)
+        started = time.perf_counter()
+        decode(data)
+        client_time += time.perf_counter() - started
+    return {"forward_client_ms": forward_client * 1000,
+            "forward_kb": forward_downlink / 1024,
+            "mosaic_server_ms": server_time / ticks * 1000,
+            "mosaic_client_ms": client_time / ticks * 1000,
+            "mosaic_kb": downlink / ticks / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, nargs="+", default=[4, 8, 12, 16],
+                        help="参与者人数")
+    parser.add_argument("--ticks", type=int, default=50, help="每种人数测量的周期数")
+    args = parser.parse_args()
+    if not mosaic.available():
+        sys.exit("需要安装 opencv-python 和 numpy")
+
+    print(f"每周期 = 一帧（{MOSAIC_FPS}fps），客户端时间为每个客户端的解码时间")
+    print(f"{'人数':>4} | {'转发: 客户端解码':>14} {'下行':>9} | "
+          f"{'合成: 服务器':>10} {'客户端解码':>10} {'下行':>9}")
+    for count in args.participants:
+        r = run(count, args.ticks)
+        print(f"{count:>4} | {r['forward_client_ms']:>12.2f}ms {r['forward_kb']:>7.1f}KB | "
+              f"{r['mosaic_server_ms']:>10.2f}ms {r['mosaic_client_ms']:>8.2f}ms "
+              f"{r['mosaic_kb']:>7.1f}KB")
+
+
+if __name__ == "__main__":
+    main()
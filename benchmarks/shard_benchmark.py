@@ -0,0 +1,160 @@
+"""多进程分片服务器的群聊吞吐量：分片进程数 1, 2, 4 ... 对比
+
+每种分片数启动一次 sharding.launch()，--clients 个 v2 客户端（分布在 --procs 个负载进程中）
+全部接收群聊，其中 --senders 个每秒各发 --rate 条，每条消息带发送时间。
+统计 --duration 秒内服务器送达的消息数（每条群聊送达 clients-1 次）和送达延迟。
+负载进程本身也占 CPU，分片数不应超过 CPU 核数减去负载进程数，否则测的是 CPU 争用。
+
+用法: python benchmarks/shard_benchmark.py [--workers 1 2 4] [--clients 64] [--rate 200]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sharding  # noqa: E402
+from protocol import (  # noqa: E402
+    FrameReader, Frame, encode_frame, encode_hello, CAP_BINARY_MEDIA, MSG_WELCOME, MSG_CHAT)
+
+STARTUP_DELAY = 1.5  # 等待所有分片开始监听并连上总线（秒）
+GRACE = 1.0  # 停止发送后继续接收的时间（秒）
+LATENCY_SAMPLE = 50  # 每个客户端每隔多少条记录一次延迟
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def receive(reader, start, end, received, latencies):
+    while True:
+        try:
+            payload = reader.read_frame()
+        except OSError:
+            break
+        if payload is None:
+            break
+        now = time.time()
+        frame = Frame.decode(payload)
+        if frame.msg_type != MSG_CHAT:
+            continue
+        sent_at = float(frame.text())
+        if start <= sent_at < end:
+            received[0] += 1
+            if received[0] % LATENCY_SAMPLE == 0:
+                latencies.append(now - sent_at)
+
+
+def send(sock, rate, start, end, sent):
+    time.sleep(max(0.0, start - time.time()))
+    interval = 1.0 / rate
+    due = start
+    count = 0
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        sock.sendall(Frame(MSG_CHAT, repr(now).encode()).encode())
+        count += 1
+        due += interval
+        time.sleep(max(0.0, due - time.time()))
+    sent.append(count)
+
+
+def load(port, names, senders, rate, start, end, results):
+    """负载进程：names 中的客户端都接收，前 senders 个同时发送群聊"""
+    socks = []
+    for name in names:
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall(encode_frame(encode_hello(name, [CAP_BINARY_MEDIA])))
+        reader = FrameReader(sock)
+        while Frame.decode(reader.read_frame()).msg_type != MSG_WELCOME:
+            pass
+        socks.append((sock, reader))
+    counts = [[0] for _ in socks]
+    latencies, sent = [], []
+    threads = []
+    for (sock, reader), received in zip(socks, counts):
+        threads.append(threading.Thread(
+            target=receive, args=(reader, start, end, received, latencies), daemon=True))
+    for sock, _ in socks[:senders]:
+        threads.append(threading.Thread(
+            target=send, args=(sock, rate, start, end, sent), daemon=True))
+    for thread in threads:
+        thread.start()
+    time.sleep(max(0.0, end + GRACE - time.time()))
+    results.put((sum(received[0] for received in counts), sum(sent), latencies))
+    for sock, _ in socks:
+        sock.close()
+
+
+def run(workers, args):
+    port = free_port()
+    processes = sharding.launch("127.0.0.1", port, workers, quiet=True)
+    try:
+        time.sleep(STARTUP_DELAY)
+        results = multiprocessing.Queue()
+        start = time.time() + 2.0 + args.clients * 0.01  # 留出所有客户端登录的时间
+        end = start + args.duration
+        loaders = []
+        for index in range(args.procs):
+            names = [f"c{i}" for i in range(index, args.clients, args.procs)]
+            senders = len(range(index, args.senders, args.procs))
+            loader = multiprocessing.Process(
+                target=load, args=(port, names, senders, args.rate, start, end, results))
+            loader.start()
+            loaders.append(loader)
+        received = sent = 0
+        latencies = []
+        for _ in loaders:
+            r, s, l = results.get()
+            received += r
+            sent += s
+            latencies.extend(l)
+        for loader in loaders:
+            loader.join()
+    finally:
+        for process in processes:
+            process.terminate()
+    latencies.sort()
+    return sent, received, latencies
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="分片进程数")
+    parser.add_argument("--clients", type=int, default=64, help="客户端数")
+    parser.add_argument("--senders", type=int, default=16, help="发送群聊的客户端数")
+    parser.add_argument("--rate", type=float, default=100, help="每个发送者每秒的消息数")
+    parser.add_argument("--duration", type=float, default=5.0, help="发送时长（秒）")
+    parser.add_argument("--procs", type=int, default=2, help="负载进程数")
+    args = parser.parse_args()
+    if not sharding.supported():
+        sys.exit("当前系统不支持 SO_REUSEPORT")
+
+    offered = args.senders * args.rate * (args.clients - 1)
+    print(f"{args.clients} 个客户端，{args.senders} 个发送者各 {args.rate:.0f} 条/秒，"
+          f"应送达 {offered:.0f} 条/秒，CPU 核数 {os.cpu_count()}")
+    print(f"{'分片':>4} | {'发出':>7} | {'送达 条/秒':>10} {'送达率':>7} | {'p50':>8} {'p99':>8}")
+    for workers in args.workers:
+        sent, received, latencies = run(workers, args)
+        expected = sent * (args.clients - 1)
+        print(f"{workers:>4} | {sent:>7} | {received / args.duration:>10.0f} "
+              f"{received / expected if expected else 0:>7.1%} | "
+              f"{percentile(latencies, 0.5) * 1000:>6.1f}ms {percentile(latencies, 0.99) * 1000:>6.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import asyncio
+import collections
+import contextlib
+import hashlib
+import os
+import re
+
+from file_transfer import IncomingTransfer, TransferError, cleanup_stale_parts
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 文件仓库默认上限 1GB
+_SHA256_HEX = re.compile(r'[0-9a-f]{64}')
+
+
+def _sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    """服务器端按 SHA-256 寻址的文件仓库
+
+    完整的文件保存在 objects/<SHA-256>，上传中的文件按块保存在 uploads/ 中（断线后可续传）。
+    同一内容只存一份：客户端提供的 SHA-256 已在仓库中时不需要再上传。
+    总大小超过上限时按最近使用顺序淘汰，正在发给接收方的文件不会被淘汰。
+    计算摘要和写文件的协程方法在线程池中执行，不阻塞事件循环；同一文件的这些操作按提交顺序执行。
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(directory, "objects")
+        self.uploads_dir = os.path.join(directory, "uploads")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        cleanup_stale_parts(self.uploads_dir)
+
+        self.blobs = collections.OrderedDict()  # SHA-256 -> 大小，最久未使用的在前
+        self.total_bytes = 0
+        self.hits = 0  # 因内容已存在而省去上传的次数
+        self._pins = collections.Counter()  # 正在发送的文件 -> 引用数
+        self._uploads = {}  # SHA-256 -> [IncomingTransfer, 引用数]
+        self._io = {}  # SHA-256 -> 该文件最近一次磁盘操作结束时完成的 Future
+        self._load()
+
+    def _load(self):
+        """按修改时间（即最近使用时间）恢复淘汰顺序"""
+        entries = []
+        for name in os.listdir(self.objects_dir):
+            if not _SHA256_HEX.fullmatch(name):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.objects_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.blobs[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def __contains__(self, sha256):
+        return sha256 in self.blobs
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def path(self, sha256):
+        return os.path.join(self.objects_dir, sha256)
+
+    def touch(self, sha256):
+        """标记为最近使用，同时更新文件修改时间，重启后顺序不变"""
+        self.blobs.move_to_end(sha256)
+        try:
+            os.utime(self.path(sha256))
+        except OSError:
+            pass
+
+    def open(self, sha256):
+        """打开文件用于发送，关闭前调用 unpin()，期间不会被淘汰"""
+        f = open(self.path(sha256), 'rb')
+        self._pins[sha256] += 1
+        self.touch(sha256)
+        return f
+
+    def unpin(self, sha256):
+        self._pins[sha256] -= 1
+        if self._pins[sha256] <= 0:
+            del self._pins[sha256]
+            self._evict()
+
+    def open_upload(self, sender, filename, size, sha256, chunk_size):
+        """开始或加入一次上传，相同内容的多个上传共享同一个未完成文件"""
+        entry = self._uploads.get(sha256)
+        if entry is None:
+            if size > self.max_bytes:
+                raise TransferError("文件超过服务器存储上限")
+            upload = IncomingTransfer(sender, 0, filename, size, sha256, chunk_size,
+                                      self.uploads_dir)
+            entry = self._uploads[sha256] = [upload, 0]
+        elif entry[0].size != size or entry[0].chunk_size != chunk_size:
+            raise TransferError("相同文件正在以不同的分块方式上传")
+        entry[1] += 1
+        return entry[0]
+
+    def release_upload(self, sha256):
+        """上传结束或中断，最后一个引用释放时保存已收到的块以便续传"""
+        entry = self._uploads.get(sha256)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._uploads[sha256]
+            if sha256 in self._io:
+                # 还有写入在线程池中进行，等它们结束后再保存
+                asyncio.get_running_loop().create_task(self._suspend(entry[0]))
+            else:
+                entry[0].suspend()
+
+    async def _suspend(self, upload):
+        async with self._turn(upload.sha256):
+            upload.suspend()
+
+    @contextlib.asynccontextmanager
+    async def _turn(self, sha256):
+        """等同一文件之前的磁盘操作结束，退出时让下一个操作开始"""
+        previous = self._io.get(sha256)
+        done = self._io[sha256] = asyncio.get_running_loop().create_future()
+        try:
+            if previous is not None:
+                await previous
+            yield
+        finally:
+            done.set_result(None)
+            if self._io.get(sha256) is done:
+                del self._io[sha256]
+
+    async def write_chunk(self, upload, offset, crc, data):
+        """把上传的一块写入未完成文件（CRC 不一致的块不记录）"""
+        async with self._turn(upload.sha256):
+            if upload.sha256 in self.blobs:
+                return  # 相同内容的另一次上传已经完成
+            await asyncio.get_running_loop().run_in_executor(
+                None, upload.write, offset, crc, data)
+
+    async def finish_upload(self, upload, digest):
+        """块齐全且校验通过时存入仓库并返回 True，缺块返回 False"""
+        async with self._turn(upload.sha256):
+            if upload.sha256 in self.blobs:
+                return True
+            if not await asyncio.get_running_loop().run_in_executor(
+                    None, upload.finish, digest, self.path(upload.sha256)):
+                return False
+            self._add(upload.sha256, upload.size)
+            return True
+
+    async def put_bytes(self, data):
+        """存入一个完整的文件（整条发送的文件），返回 SHA-256"""
+        loop = asyncio.get_running_loop()
+        sha256 = await loop.run_in_executor(None, _sha256_hex, data)
+        async with self._turn(sha256):
+            if sha256 in self.blobs:
+                self.hits += 1
+                self.touch(sha256)
+                return sha256
+            if len(data) > self.max_bytes:
+                raise TransferError("文件超过服务器存储上限")
+            await loop.run_in_executor(None, self._write_blob, sha256, data)
+            self._add(sha256, len(data))
+        return sha256
+
+    def _write_blob(self, sha256, data):
+        temp_path = os.path.join(self.uploads_dir, sha256 + ".tmp")
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.path(sha256))
+
+    def _add(self, sha256, size):
+        if sha256 not in self.blobs:
+            self.total_bytes += size
+        self.blobs[sha256] = size
+        self.blobs.move_to_end(sha256)
+        self._evict()
+
+    def _evict(self):
+        """从最久未使用的开始删除，直到总大小不超过上限"""
+        for sha256 in list(self.blobs):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if sha256 in self._pins:
+                continue
+            self.total_bytes -= self.blobs.pop(sha256)
+            try:
+                os.remove(self.path(sha256))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"count": len(self.blobs), "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes, "hits": self.hits}
@@ -0,0 +1,1868 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+import secrets
+import threading
+import time
+import concurrent.futures
+
+from protocol import (
+    DEFAULT_MAX_FRAME_SIZE, FrameBuffer, FrameTooLargeError, Frame, FRAME_HEADER,
+    MessageFormatError, encode_frame_parts, decode_hello, unpack_file_body,
+    file_transfer_id, pack_file_offer, unpack_file_offer, file_offer_thumbnail,
+    pack_file_ticket, pack_file_chunk, pack_media_relay, MEDIA_TOKEN_SIZE,
+    unpack_udp_endpoint, pack_udp_candidates,
+    unpack_file_chunk, pack_file_complete, unpack_file_complete, pack_file_cancel,
+    pack_file_ack, pack_file_have, unpack_file_have, chunk_count,
+    empty_chunk_bitmap, full_chunk_bitmap, bitmap_has, FILE_CHUNK_SIZE,
+    PROTOCOL_VERSION, CAP_BINARY_MEDIA, CAP_FILE_DOWNLOAD, CAP_MEDIA_RELAY,
+    CAP_BULK_CHANNEL, CAP_FRAGMENTS, BULK_MESSAGE_TYPES, FLAG_MORE,
+    FLAG_PRIVATE, FLAG_OFFLINE,
+    MSG_WELCOME, MSG_QUIT, MSG_CHAT, MSG_PRIVATE, MSG_SYSTEM, MSG_USERLIST,
+    MSG_REQUEST_USERLIST, MSG_FILE, MSG_FILE_OFFER, MSG_FILE_CHUNK,
+    MSG_FILE_COMPLETE, MSG_FILE_CANCEL, MSG_FILE_ACK, MSG_FILE_HAVE,
+    MSG_FILE_ANNOUNCE, MSG_FILE_FETCH, MSG_FILE_TICKET,
+    MSG_VIDEO_CALL_REQUEST,
+    MSG_VIDEO_CALL_INVITE, MSG_VIDEO_CALL_ACCEPT, MSG_VIDEO_CALL_START,
+    MSG_VIDEO_CALL_REJECT, MSG_VIDEO_CALL_REJECTED, MSG_VIDEO_CALL_END,
+    MSG_VIDEO_CALL_ENDED, MSG_VIDEO_DATA, MSG_UDP_PORT, MSG_MULTI_VIDEO_INVITE,
+    MSG_MULTI_VIDEO_JOIN, MSG_MULTI_VIDEO_LEAVE, MSG_MULTI_VIDEO_DATA,
+    MSG_MULTI_VIDEO_REFRESH, MSG_CAMERA_STATUS, MSG_MULTI_VIDEO_ROSTER, MSG_MEDIA_RELAY,
+    MSG_MULTI_VIDEO_MODE, VIDEO_MODE_FORWARD, VIDEO_MODE_MOSAIC, MAX_CONTROL_FRAME)
+from text_compat import (Base64Body, binary_body, parse_text_message,
+                         render_text_message)
+from blob_store import BlobStore, DEFAULT_MAX_BYTES
+from download_server import DownloadServer
+from admin_control import AdminServer
+from media_relay import (RelayLink, CTRL_JOIN, CTRL_LEAVE, CTRL_ATTACH, CTRL_DETACH,
+                         CTRL_FRAME, CTRL_MODE)
+from file_transfer import TransferError, MAX_RESEND_ROUNDS
+from backplane import NODE_SHIFT, MAX_NODES
+
+
+# 慢客户端处理策略（出站积压超过高水位时生效，回落到低水位以下时解除）
+POLICY_DROP = "drop"  # 丢弃新消息
+POLICY_DISCONNECT = "disconnect"  # 直接断开该客户端
+POLICY_DEGRADE = "degrade"  # 只丢弃可丢弃的消息，聊天和信令照常排队（视频帧在视频槽中，不受影响）
+SLOW_CONSUMER_POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_DEGRADE)
+
+# 每个会话出站队列的默认高/低水位（字节）
+DEFAULT_OUTBOUND_HIGH_WATERMARK = 4 * 1024 * 1024
+DEFAULT_OUTBOUND_LOW_WATERMARK = 1024 * 1024
+
+# 交给 transport 的内核发送缓冲之外的用户态缓冲上限，超过后写协程暂停
+TRANSPORT_HIGH_WATER = 64 * 1024
+TRANSPORT_LOW_WATER = 16 * 1024
+
+# 每个接收者每路视频的默认最高帧率，客户端可以在握手时要求更低的帧率（video_fps）
+DEFAULT_VIDEO_FPS = 15
+MAX_VIDEO_SLOTS = 256  # 每个会话保留的视频槽上限，超过时清理已发出、没有新帧的槽
+
+# 服务器支持的能力，握手时与客户端声明的能力取交集
+SERVER_CAPS = frozenset([CAP_BINARY_MEDIA, CAP_BULK_CHANNEL, CAP_FRAGMENTS])
+
+# 会话使用的协议版本
+TEXT_PROTOCOL = 1  # 旧版文本协议，经 text_compat 转换
+BINARY_PROTOCOL = PROTOCOL_VERSION
+
+# 每个会话同时进行的分块文件上传上限
+MAX_FILE_TRANSFERS = 16
+
+# 可以点击下载的群发文件的记录上限，超过时丢弃最早的
+MAX_SHARED_FILES = 4096
+
+# 合成画面在旧版客户端中显示的发送者名称（v2 帧中发送者用户ID为 0）
+MOSAIC_NAME = "会议画面"
+
+# 文件仓库的默认目录
+DEFAULT_BLOB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_files")
+
+_CLOSE = object()  # 出站队列中的关闭标记：之前的消息写完后关闭连接
+
+
+class OutboundMessage:
+    """一条下行消息
+
+    内部以 v2 帧表示，按接收方的协议版本各编码一次并缓存，
+    同一条广播无论有多少接收者，每种协议最多只编码一次。
+    转发的消息体是接收缓冲区的 memoryview，编码时直接拼在新帧头后面，不经过解码；
+    因此 OutboundMessage 只能在处理这一帧的调用内使用。
+    """
+
+    __slots__ = ('frame', 'name', 'text', '_binary', '_legacy')
+
+    def __init__(self, frame, name=None, text=None):
+        self.frame = frame
+        self.name = name  # 帧中发送者的用户名，渲染旧版文本时使用
+        self.text = text  # 旧版文本（不能由帧直接渲染时显式给出）
+        self._binary = None
+        self._legacy = None
+
+    def encoded_for(self, session):
+        """返回适合该会话协议的已编码帧，旧协议中没有对应消息时返回 None"""
+        if session.version == BINARY_PROTOCOL:
+            if self._binary is None:
+                self._binary = self._encode_binary()
+            return self._binary or None
+        if self._legacy is None:
+            if self.text is not None:
+                parts = (self.text.encode(),)
+            else:
+                parts = render_text_message(self.frame, self.name)
+            self._legacy = encode_frame_parts(parts) if parts is not None else b''
+        return self._legacy or None
+
+    def _encode_binary(self):
+        frame = self.frame
+        try:
+            body = binary_body(frame)
+        except MessageFormatError:
+            return b''  # 旧版客户端发来的数据无法解码，不转发给 v2 客户端
+        if body is not frame.body:
+            frame = Frame(frame.msg_type, body, frame.flags,
+                          frame.room, frame.user, frame.seq)
+        return frame.encode()
+
+
+def system_message(text):
+    """系统消息（两种协议的内容相同）"""
+    return OutboundMessage(Frame(MSG_SYSTEM, text.encode()), text=text)
+
+
+class VideoSlot:
+    """一个接收者的一路视频（按发送者和房间区分）：只保存最新的一帧"""
+
+    __slots__ = ('frame', 'last_sent')
+
+    def __init__(self):
+        self.frame = None  # 还没写出的最新一帧（已编码），写出后为 None
+        self.last_sent = float('-inf')  # 上一帧写出的时间（事件循环时钟）
+
+
+class ClientSession:
+    """单个客户端连接的会话状态
+
+    每个会话有一个有界的出站队列，由独立的写协程负责写出。广播只把帧放进各自的队列，
+    不会因为某个客户端的 TCP 窗口满了而阻塞其他人的消息。
+    视频帧不进出站队列，而是放进每路视频的单帧槽，新帧直接覆盖还没写出的旧帧；
+    写协程在出站队列写完、transport 可写时才取出每路最新的一帧，并按帧率上限发送，
+    接收方网络慢时看到的是降低的帧率而不是越来越旧的画面。
+
+    客户端连上数据连接后，数据连接也是一个 ClientSession（owner 指向聊天连接的会话，
+    不在 SessionRegistry 中），视频和文件数据经聊天连接会话的 bulk 发出。
+    """
+
+    def __init__(self, engine, transport):
+        self.engine = engine
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.username = None
+        self.user_id = 0  # 登录后分配，v2 帧头中用它代替用户名
+        self.version = None  # 协议版本，由第一帧（握手）决定
+        self.caps = frozenset()  # 协商后的能力
+
+        # 出站队列
+        self.outbound = collections.deque()
+        self.queued_bytes = 0
+        self.congested = False  # 积压超过高水位后置位，回落到低水位以下才清除
+        self.dropped_frames = 0
+        self.closing = False
+        # 等本会话的积压写出后继续发送的文件（FileDelivery）
+        self.waiting_transfers = set()
+        self.rooms = set()  # 已加入的多人视频房间ID
+        # 视频槽：(房间ID, 发送者用户ID) -> VideoSlot，以及每路视频两帧之间的最小间隔
+        self.video_slots = {}
+        self.video_pending = 0  # 有待写出帧的槽数
+        self.video_interval = 1.0 / engine.video_max_fps
+        self.video_sent = 0
+        self.video_replaced = 0  # 还没写出就被新帧覆盖的帧数
+        self._video_timer = None
+        self.media_tokens = {}  # 房间ID -> 媒体转发令牌
+        self.media_rooms = set()  # UDP 地址已被媒体转发服务器确认的房间，视频不再经聊天连接发给他
+        self.bulk_token = None  # 尚未使用的数据连接令牌
+        self.bulk = None  # 已连上的数据连接会话
+        self.owner = None  # 数据连接所属的聊天连接会话（本会话是数据连接时）
+        self.fragments = {}  # 消息类型 -> [序号, 已收到的分片列表, 总字节数]，拼接客户端拆开发送的大帧
+        self.udp_endpoint = None  # 一对一视频通话中客户端报告的 (UDP 端口, 本机 IP)
+        self.writable = asyncio.Event()  # transport 可写（未被暂停）
+        self.writable.set()
+        self.wakeup = asyncio.Event()  # 队列中有新数据
+        transport.set_write_buffer_limits(
+            high=TRANSPORT_HIGH_WATER, low=TRANSPORT_LOW_WATER)
+        self.writer_task = asyncio.get_event_loop().create_task(self.writer())
+
+    @property
+    def data_channel(self):
+        """发送视频和文件数据的会话：有数据连接时为数据连接，否则为本会话"""
+        return self.bulk if self.bulk is not None else self
+
+    def deliver(self, message, droppable=False):
+        """发送一条 OutboundMessage（只入队，不阻塞），返回是否入队成功"""
+        if self.bulk is not None and message.frame.msg_type in BULK_MESSAGE_TYPES:
+            return self.bulk.deliver(message, droppable)
+        frame = message.encoded_for(self)
+        if frame is None:
+            return False
+        return self.enqueue(frame, droppable)
+
+    def send_system(self, text):
+        """发送一条系统消息"""
+        return self.deliver(system_message(text))
+
+    def deliver_video(self, message):
+        """发送一帧视频：放进该路视频的单帧槽，覆盖还没写出的旧帧"""
+        if self.bulk is not None:
+            return self.bulk.deliver_video(message)
+        if self.closing or self.transport.is_closing():
+            return False
+        frame = message.encoded_for(self)
+        if frame is None:
+            return False
+        key = (message.frame.room, message.frame.user)
+        slot = self.video_slots.get(key)
+        if slot is None:
+            if len(self.video_slots) >= MAX_VIDEO_SLOTS:
+                self.video_slots = {k: s for k, s in self.video_slots.items()
+                                    if s.frame is not None}
+            slot = self.video_slots[key] = VideoSlot()
+        if slot.frame is not None:
+            self.video_replaced += 1
+        else:
+            self.video_pending += 1
+        slot.frame = frame
+        self.wakeup.set()
+        return True
+
+    def enqueue(self, frame, droppable=False):
+        """把已编码的帧放入出站队列，按慢客户端策略处理积压"""
+        if self.closing or self.transport.is_closing():
+            return False
+
+        engine = self.engine
+        if not self.congested and self.queued_bytes >= engine.outbound_high_watermark:
+            self.congested = True
+            engine.log(f"{self.username} 接收过慢，出站积压 {self.queued_bytes} 字节")
+
+        if self.congested:
+            policy = engine.slow_consumer_policy
+            if policy == POLICY_DISCONNECT:
+                engine.log(f"{self.username} 接收过慢，已断开连接")
+                self.abort()
+                return False
+            if policy == POLICY_DROP or droppable:
+                self.dropped_frames += 1
+                return False
+            # 降级模式下不可丢弃的消息继续排队，但积压到硬上限仍要断开，防止内存无限增长
+            if self.queued_bytes >= engine.outbound_high_watermark * 4:
+                engine.log(f"{self.username} 出站积压超过上限，已断开连接")
+                self.abort()
+                return False
+
+        if not self.outbound and self.writable.is_set():
+            # 队列为空且 transport 未暂停时直接写出，省去一次协程切换
+            self.transport.write(frame)
+            return True
+
+        self.outbound.append(frame)
+        self.queued_bytes += len(frame)
+        self.wakeup.set()
+        return True
+
+    async def writer(self):
+        """写协程：按顺序把出站队列写入 transport，再写出视频槽中的最新帧，transport 暂停时等待"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.outbound:
+                if not self.writable.is_set():
+                    await self.writable.wait()
+                frame = self.outbound.popleft()
+                if frame is _CLOSE:
+                    self.transport.close()
+                    return
+                self.queued_bytes -= len(frame)
+                self.transport.write(frame)
+                if self.queued_bytes <= self.engine.outbound_low_watermark:
+                    self.congested = False
+                    if self.waiting_transfers:
+                        self.engine.release_file_transfers(self)
+            if self.video_pending and not self.closing:
+                await self.write_video()
+
+    async def write_video(self):
+        """写出各路视频到了发送时间的最新帧；出站队列有新消息时先让给它们"""
+        loop = asyncio.get_running_loop()
+        next_due = None
+        for slot in list(self.video_slots.values()):
+            if slot.frame is None:
+                continue
+            if self.outbound or self.closing:
+                self.wakeup.set()  # 聊天和信令优先，之后再回来写视频
+                return
+            if not self.writable.is_set():
+                # 等待期间新到的帧会覆盖槽中的旧帧，恢复后写出的就是最新的
+                await self.writable.wait()
+                if slot.frame is None:
+                    continue
+            due = slot.last_sent + self.video_interval
+            now = loop.time()
+            if due > now:
+                next_due = due if next_due is None else min(next_due, due)
+                continue
+            frame, slot.frame = slot.frame, None
+            slot.last_sent = now
+            self.video_pending -= 1
+            self.video_sent += 1
+            self.transport.write(frame)
+        if next_due is not None and self._video_timer is None:
+            self._video_timer = loop.call_at(next_due, self._video_due)
+
+    def _video_due(self):
+        self._video_timer = None
+        self.wakeup.set()
+
+    def close(self):
+        """把已排队的消息写完后关闭连接"""
+        if self.closing:
+            return
+        self.closing = True
+        self.outbound.append(_CLOSE)
+        self.wakeup.set()
+
+    def abort(self):
+        """丢弃积压的消息并立即断开"""
+        self.closing = True
+        self.outbound.clear()
+        self.queued_bytes = 0
+        self.video_slots.clear()
+        self.video_pending = 0
+        self.transport.abort()
+
+
+class CommandStats:
+    """单个命令的调用次数和处理耗时"""
+
+    __slots__ = ('name', 'count', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": self.total_time * 1000 / self.count if self.count else 0.0,
+            "max_ms": self.max_time * 1000,
+        }
+
+
+class FileUpload:
+    """发送者 -> 服务器的一次上传
+
+    数据块写入文件仓库（内容已在仓库中时不需要上传）。上传完成后私聊文件分别发给接收者，
+    群发文件只通知其他用户，点击下载时才发送。
+    """
+
+    __slots__ = ('sender', 'transfer_id', 'filename', 'size', 'sha256',
+                 'chunk_size', 'flags', 'recipients', 'thumbnail', 'incoming',
+                 'received')
+
+    def __init__(self, sender, transfer_id, filename, size, sha256, chunk_size,
+                 flags, recipients, thumbnail=None):
+        self.sender = sender
+        self.transfer_id = transfer_id
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.chunk_size = chunk_size
+        self.flags = flags
+        self.recipients = recipients  # 上传完成后要发给（群发时为通知）的会话
+        self.thumbnail = thumbnail  # 群发图片的缩略图，随文件通知发送
+        self.incoming = None  # 仓库中的未完成文件，整条发送的文件为 None
+        self.received = 0  # 已收到的字节数（含重传），用于流量控制确认
+
+    @property
+    def key(self):
+        return (self.sender.user_id, self.transfer_id)
+
+
+class FileDelivery:
+    """服务器 -> 一个接收者：从文件仓库按块读取接收者缺少的部分发送
+
+    帧头的用户ID和传输ID沿用上传者的，接收者看到的与直接从发送者收到的一样。
+    """
+
+    __slots__ = ('session', 'sender_id', 'sender_name', 'transfer_id', 'filename',
+                 'size', 'sha256', 'chunk_size', 'chunk_count', 'flags', 'file',
+                 'pending', 'completing', 'rounds')
+
+    def __init__(self, session, upload, file):
+        self.session = session
+        self.sender_id = upload.sender.user_id
+        self.sender_name = upload.sender.username
+        self.transfer_id = upload.transfer_id
+        self.filename = upload.filename
+        self.size = upload.size
+        self.sha256 = upload.sha256
+        self.chunk_size = upload.chunk_size
+        self.chunk_count = chunk_count(upload.size, upload.chunk_size)
+        self.flags = upload.flags
+        self.file = file
+        self.pending = collections.deque()  # 待发送的块序号
+        self.completing = False  # 已发送 COMPLETE，等待接收者回复位图
+        self.rounds = 0  # 补发轮数
+
+    @property
+    def key(self):
+        return (self.session.user_id, self.sender_id, self.transfer_id)
+
+    def read_chunk(self, index):
+        offset = index * self.chunk_size
+        self.file.seek(offset)
+        return offset, self.file.read(min(self.chunk_size, self.size - offset))
+
+
+class SessionRegistry:
+    """在线会话的索引：用户名 / 用户ID / 连接 -> 会话
+
+    登录成功时加入、下线时移除，所有按用户名或用户ID路由的路径（私聊、视频信令、踢人）
+    都通过它做一次字典查找，而不是遍历全部连接。
+    """
+
+    def __init__(self):
+        self.by_name = {}  # username -> session
+        self.by_id = {}  # user_id -> session
+        self.by_transport = {}  # transport -> session
+
+    def add(self, session):
+        """登记已登录的会话，用户名已被占用时返回 False"""
+        if session.username in self.by_name:
+            return False
+        self.by_name[session.username] = session
+        self.by_id[session.user_id] = session
+        self.by_transport[session.transport] = session
+        return True
+
+    def remove(self, session):
+        """移除会话，返回它之前是否已登记"""
+        if self.by_transport.pop(session.transport, None) is None:
+            return False
+        del self.by_name[session.username]
+        del self.by_id[session.user_id]
+        return True
+
+    def get(self, username):
+        return self.by_name.get(username)
+
+    def get_by_id(self, user_id):
+        return self.by_id.get(user_id)
+
+    def get_by_transport(self, transport):
+        return self.by_transport.get(transport)
+
+    def usernames(self):
+        return list(self.by_name)
+
+    def users(self):
+        """[(用户ID, 用户名), ...]"""
+        return [(session.user_id, name) for name, session in self.by_name.items()]
+
+    def clear(self):
+        self.by_name.clear()
+        self.by_id.clear()
+        self.by_transport.clear()
+
+    def __contains__(self, session):
+        return session.transport in self.by_transport
+
+    def __iter__(self):
+        return iter(list(self.by_name.values()))
+
+    def __len__(self):
+        return len(self.by_name)
+
+
+class ChatServerProtocol(asyncio.BufferedProtocol):
+    """每个连接一个协议实例，负责分帧并把消息交给引擎
+
+    事件循环直接把数据读入 FrameBuffer 的可复用缓冲区，一次读取中的所有完整帧
+    依次交给引擎处理。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.session = None
+        self.frames = FrameBuffer(engine.max_frame_size)
+
+    def connection_made(self, transport):
+        self.session = ClientSession(self.engine, transport)
+
+    def get_buffer(self, sizehint):
+        return self.frames.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.frames.buffer_updated(nbytes)
+        if self.session.closing:
+            return  # 已决定关闭的连接不再处理后续消息
+        try:
+            while True:
+                frame = self.frames.next_frame()
+                if frame is None:
+                    break
+                self.engine.handle_frame(self.session, frame)
+        except FrameTooLargeError as e:
+            self.engine.log(f"客户端 {self.session.address} 发送了过大的帧: {str(e)}")
+            self.session.abort()
+        except Exception as e:
+            self.engine.log(f"处理客户端 {self.session.address} 时出错: {str(e)}")
+            self.session.close()
+
+    def pause_writing(self):
+        self.session.writable.clear()
+
+    def resume_writing(self):
+        self.session.writable.set()
+
+    def connection_lost(self, exc):
+        self.session.writer_task.cancel()
+        self.engine.remove_session(self.session)
+
+
+class ChatEngine:
+    """基于 asyncio 的聊天室服务器引擎
+
+    负责接受连接、分帧、命令分发和广播。GUI 和命令行前端只需创建引擎、
+    注册回调并调用 start()/stop()，所有网络操作都在引擎自己的事件循环线程中完成。
+    """
+
+    def __init__(self, host="0.0.0.0", port=8888, backlog=1024,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 outbound_high_watermark=DEFAULT_OUTBOUND_HIGH_WATERMARK,
+                 outbound_low_watermark=DEFAULT_OUTBOUND_LOW_WATERMARK,
+                 slow_consumer_policy=POLICY_DEGRADE,
+                 blob_dir=None, blob_max_bytes=DEFAULT_MAX_BYTES, download_port=0,
+                 media_relay=None, video_max_fps=DEFAULT_VIDEO_FPS, reuse_port=False,
+                 node_id=0, backplane=None, admin_port=None, on_log=None, on_users_changed=None):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"未知的慢客户端策略: {slow_consumer_policy}")
+        if outbound_low_watermark > outbound_high_watermark:
+            raise ValueError("出站低水位不能高于高水位")
+        if not 0 <= node_id < MAX_NODES:
+            raise ValueError(f"节点号必须在 0 到 {MAX_NODES - 1} 之间")
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port  # 多个分片进程用 SO_REUSEPORT 监听同一端口
+        self.max_frame_size = max_frame_size  # 单帧最大字节数
+        # 每个会话出站队列的高/低水位（字节）及积压时的处理策略
+        self.outbound_high_watermark = outbound_high_watermark
+        self.outbound_low_watermark = outbound_low_watermark
+        self.slow_consumer_policy = slow_consumer_policy
+        self.video_max_fps = video_max_fps  # 每个接收者每路视频的最高帧率
+        self.on_log = on_log  # 日志回调：on_log(message)
+        self.on_users_changed = on_users_changed  # 在线用户变化回调：on_users_changed(users)
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.running = False
+        self.sessions = SessionRegistry()  # 在线会话：用户名 / 用户ID <-> 会话
+        # 用户ID 分配器，0 表示服务器；高 8 位为节点号，集群中各节点分配的用户ID互不重复
+        self.node_id = node_id
+        self._user_ids = itertools.count((node_id << NODE_SHIFT) + 1)
+        self._user_list_message = None  # 缓存的在线用户列表消息，在线用户变化时失效
+        self.bulk_tokens = {}  # 数据连接令牌 -> 还没连上数据连接的会话
+        self.video_calls = {}  # 存储视频通话配对：username -> partner_username
+        self.rooms = {}  # 多人视频房间成员：房间ID -> 会话集合，房间事件和视频只发给成员
+        self.room_modes = {}  # 切换为合成画面模式的房间ID -> VIDEO_MODE_MOSAIC，其余房间逐路转发
+        # 文件仓库及进行中的分块传输：
+        #   上传 (上传者用户ID, 传输ID) -> FileUpload
+        #   下发 (接收者用户ID, 上传者用户ID, 传输ID) -> FileDelivery
+        self.blobs = BlobStore(blob_dir or DEFAULT_BLOB_DIR, blob_max_bytes)
+        self.uploads = {}
+        self.deliveries = {}
+        # 已通知、可以点击下载的群发文件：(上传者用户ID, 传输ID) -> FileUpload
+        self.shared_files = collections.OrderedDict()
+        # 服务器代整条发送的文件分配的传输ID，与客户端自己分配的（从 1 递增）不重叠
+        self._file_ids = itertools.count(0x80000000)
+        # 点击下载的文件通过单独的下载端口发送（0 表示由系统分配端口，None 表示不开启，
+        # 此时仍在聊天连接上分块发送）
+        self.downloads = None
+        self.caps = SERVER_CAPS
+        if download_port is not None:
+            self.downloads = DownloadServer(self.blobs, host, download_port, on_log=self.log)
+            self.caps = self.caps | {CAP_FILE_DOWNLOAD}
+        # 媒体转发服务器（单独进程）控制连接的地址 (host, port)，为 None 时多人视频只经聊天连接转发
+        self.media = None
+        if media_relay is not None:
+            self.media = RelayLink(media_relay[0], media_relay[1], self.media_connected,
+                                   self.handle_media_message, self.media_disconnected,
+                                   on_log=self.log)
+            self.caps = self.caps | {CAP_MEDIA_RELAY}
+        # 分片 / 集群模式（sharding.py）：广播、私聊和用户上下线经总线（backplane.Backplane）发给其他节点，
+        # 其他节点的在线用户保存在本地目录中，用于用户列表、重名检查和按用户名找到私聊对象
+        self.backplane = backplane
+        self.remote_users = {}  # 其他节点号 -> 该节点的在线用户 {用户ID: 用户名}
+        self.remote_names = {}  # 其他节点的用户名 -> (节点号, 用户ID)
+        self.remote_ids = {}  # 其他节点的用户ID -> (节点号, 用户名)
+        if backplane is not None:
+            backplane.attach(self, node_id)
+            # 数据连接可能被分给另一个节点，找不到令牌，所以分片 / 集群模式下不提供
+            self.caps = self.caps - {CAP_BULK_CHANNEL}
+        # 本机管理端口（admin_control.py），供单独运行的管理界面查看日志和状态、踢人和广播，
+        # 为 None 时不开启
+        self.admin = None
+        if admin_port is not None:
+            self.admin = AdminServer(self, port=admin_port)
+
+        self._tasks = set()  # spawn() 启动、还没结束的后台任务
+
+        # 命令分发表：消息类型 -> (处理函数, 统计)
+        self._handlers = {}
+        self.register_default_handlers()
+
+    # ==================== 生命周期 ====================
+
+    def start(self):
+        """在后台线程中启动事件循环，绑定失败时抛出异常"""
+        if self.running:
+            raise RuntimeError("服务器已经在运行")
+        ready = concurrent.futures.Future()
+        self.thread = threading.Thread(
+            target=self.serve_forever, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.result()  # 等待监听成功或把绑定错误抛给调用者
+
+    def serve_forever(self, ready=None):
+        """在当前线程运行事件循环，直到 stop() 被调用"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(self.loop.create_server(
+                lambda: ChatServerProtocol(self),
+                self.host, self.port,
+                reuse_address=True, reuse_port=self.reuse_port, backlog=self.backlog))
+            if self.downloads is not None:
+                self.loop.run_until_complete(self.downloads.start())
+            if self.admin is not None:
+                self.loop.run_until_complete(self.admin.start())
+            if self.media is not None:
+                self.loop.call_soon(self.media.start)
+            if self.backplane is not None:
+                self.loop.call_soon(self.backplane.start)
+        except Exception as e:
+            if self.server is not None:
+                self.server.close()
+            self.loop.close()
+            if ready is None:
+                raise
+            ready.set_exception(e)
+            return
+
+        self.running = True
+        if ready is not None:
+            ready.set_result(True)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.running = False
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            if self.downloads is not None:
+                self.loop.run_until_complete(self.downloads.close())
+            if self.admin is not None:
+                self.loop.run_until_complete(self.admin.close())
+            if self.media is not None:
+                self.loop.run_until_complete(self.media.close())
+            if self.backplane is not None:
+                self.loop.run_until_complete(self.backplane.close())
+            # 取消残留的写协程后再关闭事件循环
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+    def stop(self):
+        """关闭所有连接并停止事件循环（线程安全）"""
+        if not self.running:
+            return
+        self.call_in_loop(self._shutdown)
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    def _shutdown(self):
+        self.server.close()
+        for session in self.sessions:
+            session.transport.close()
+            if session.bulk is not None:
+                session.bulk.transport.close()
+        self.sessions.clear()
+        self.bulk_tokens.clear()
+        self.video_calls.clear()
+        self.rooms.clear()
+        self.room_modes.clear()
+        for upload in list(self.uploads.values()):
+            self.close_file_upload(upload)
+        for delivery in list(self.deliveries.values()):
+            self.close_file_delivery(delivery)
+        self.shared_files.clear()
+        self.notify_users_changed()
+        self.loop.call_soon(self.loop.stop)
+
+    def call_in_loop(self, func, *args):
+        """在事件循环线程中执行 func 并返回结果（供前端线程调用）"""
+        if self.loop is None or not self.running:
+            return None
+        try:
+            if asyncio.get_running_loop() is self.loop:
+                return func(*args)
+        except RuntimeError:
+            pass
+        future = concurrent.futures.Future()
+
+        def runner():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(runner)
+        return future.result(timeout=5)
+
+    # ==================== 前端接口（线程安全） ====================
+
+    def online_users(self):
+        """返回在线用户名列表"""
+        return self.sessions.usernames()
+
+    def kick_user(self, username):
+        """踢出指定用户，返回是否成功"""
+        return bool(self.call_in_loop(self._kick_user, username))
+
+    def system_broadcast(self, message):
+        """发送系统广播消息"""
+        self.call_in_loop(
+            self.publish, system_message(f"【系统广播】{message}"))
+
+    def command_stats(self):
+        """返回各命令的调用次数和耗时统计（按调用次数降序）"""
+        stats = self.call_in_loop(self._command_stats)
+        if stats is None:
+            stats = self._command_stats()
+        return stats
+
+    def _command_stats(self):
+        stats = [entry[1].snapshot() for entry in self._handlers.values()]
+        stats.sort(key=lambda item: item["count"], reverse=True)
+        return stats
+
+    def blob_stats(self):
+        """返回文件仓库的文件数、总大小、上限和省去上传的次数"""
+        stats = self.call_in_loop(self.blobs.stats)
+        if stats is None:
+            stats = self.blobs.stats()
+        return stats
+
+    def video_stats(self):
+        """返回经聊天连接写出的视频帧数，以及还没写出就被更新的帧覆盖（跳过）的帧数"""
+        stats = self.call_in_loop(self._video_stats)
+        if stats is None:
+            stats = self._video_stats()
+        return stats
+
+    def _video_stats(self):
+        channels = [session.data_channel for session in self.sessions]
+        return {"sent": sum(channel.video_sent for channel in channels),
+                "replaced": sum(channel.video_replaced for channel in channels)}
+
+    def media_stats(self):
+        """返回媒体转发服务器的连接状态和经 UDP 收发视频的会话数，未配置时返回 None"""
+        if self.media is None:
+            return None
+        return self.call_in_loop(self._media_stats)
+
+    def _media_stats(self):
+        return {"connected": self.media.connected, "udp_port": self.media.udp_port,
+                "attached": sum(len(session.media_rooms) for session in self.sessions),
+                "mosaic_rooms": len(self.room_modes)}
+
+    def download_stats(self):
+        """返回下载端口的票据数、请求数和发送的字节数，未开启下载端口时返回 None"""
+        if self.downloads is None:
+            return None
+        stats = self.call_in_loop(self.downloads.stats)
+        if stats is None:
+            stats = self.downloads.stats()
+        return stats
+
+    def _kick_user(self, target_user):
+        session = self.sessions.get(target_user)
+        if session is None:
+            return False
+        # 先向被踢出的用户发送通知
+        session.send_system("【系统】您已被管理员踢出聊天室")
+        # 通知其他用户该用户被踢出
+        self.publish(
+            system_message(f"【系统】{target_user} 被管理员踢出聊天室"), session)
+        session.close()
+        return True
+
+    # ==================== 回调 ====================
+
+    def spawn(self, coroutine):
+        """在事件循环中运行后台任务（等待线程池中的文件仓库操作等），结束前保留引用"""
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log(f"后台任务出错: {task.exception()!r}")
+
+    def log(self, message):
+        if self.admin is not None:
+            self.admin.add_log(message)
+        if self.on_log:
+            self.on_log(message)
+
+    def notify_users_changed(self):
+        self._user_list_message = None
+        if self.on_users_changed:
+            self.on_users_changed(self.online_users())
+
+    # ==================== 总线（分片 / 集群） ====================
+
+    def backplane_connected(self):
+        self.backplane.presence(self.sessions.users())
+
+    def backplane_disconnected(self):
+        """与总线断开后看不到其他节点的用户，从用户列表中去掉"""
+        if self.remote_users:
+            for node in list(self.remote_users):
+                self.forget_remote_users(node)
+            self.remote_users_changed()
+
+    def remote_presence(self, node, users):
+        self.forget_remote_users(node)
+        if users:
+            self.remote_users[node] = users
+            for user_id, name in users.items():
+                self.remote_names[name] = (node, user_id)
+                self.remote_ids[user_id] = (node, name)
+        self.remote_users_changed()
+
+    def remote_user_online(self, node, user_id, name):
+        self.remote_users.setdefault(node, {})[user_id] = name
+        self.remote_names[name] = (node, user_id)
+        self.remote_ids[user_id] = (node, name)
+        self.remote_users_changed(online=True)
+
+    def remote_user_offline(self, node, user_id):
+        name = self.remote_users.get(node, {}).pop(user_id, None)
+        if name is None:
+            return
+        self.remote_ids.pop(user_id, None)
+        if self.remote_names.get(name) == (node, user_id):
+            del self.remote_names[name]
+        self.remote_users_changed()
+
+    def remote_broadcast(self, frame, name, text):
+        self.broadcast(OutboundMessage(frame, name, text))
+
+    def remote_direct(self, user_id, frame, name, text):
+        session = self.sessions.get_by_id(user_id)
+        if session is not None:
+            session.deliver(OutboundMessage(frame, name, text))
+
+    def forget_remote_users(self, node):
+        for user_id, name in self.remote_users.pop(node, {}).items():
+            self.remote_ids.pop(user_id, None)
+            if self.remote_names.get(name) == (node, user_id):
+                del self.remote_names[name]
+
+    def remote_users_changed(self, online=False):
+        """其他节点的用户上线时把新的用户列表发给本节点的 v2 客户端（与本节点用户上线时相同），
+        下线时发给所有客户端"""
+        self._user_list_message = None
+        user_list = self.user_list_message()
+        for session in self.sessions:
+            if not online or session.version == BINARY_PROTOCOL:
+                session.deliver(user_list)
+
+    # ==================== 消息处理 ====================
+
+    def handle_frame(self, session, payload):
+        """处理一帧消息，第一帧为握手（旧版客户端为用户名）
+
+        payload 是接收缓冲区的 memoryview，只在本次调用内有效。
+        """
+        if session.username is None:
+            self.handle_login(session, payload)
+            return
+        if session.owner is not None:
+            self.handle_bulk_frame(session, payload)
+            return
+
+        try:
+            if session.version == BINARY_PROTOCOL:
+                frame, target_name = Frame.decode(payload), None
+                if frame.flags & FLAG_MORE or session.fragments:
+                    frame = self.reassemble(session, frame)
+                    if frame is None:
+                        return
+            else:
+                frame, target_name = parse_text_message(payload)
+        except MessageFormatError as e:
+            session.send_system(f"【系统】错误：{e}")
+            self.log(f"{session.username} 发送的消息格式不正确: {e}")
+            return
+
+        entry = self._handlers.get(frame.msg_type)
+        if entry is None:
+            self.log(f"{session.username} 发送了未知类型的消息: {frame.msg_type}")
+            return
+        handler, stats = entry
+        start = time.perf_counter()
+        try:
+            handler(session, frame, target_name)
+        except MessageFormatError as e:
+            # 消息体格式错误只影响这一条消息，不断开连接
+            stats.errors += 1
+            session.send_system(f"【系统】错误：{e}")
+            self.log(f"{session.username} 发送的消息格式不正确: {e}")
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.record(time.perf_counter() - start)
+
+    def reassemble(self, session, frame):
+        """拼接带 FLAG_MORE 的分片，收到最后一片时返回完整的帧，否则返回 None
+
+        同一类型的分片是连续发送的，序号与正在拼接的不同说明前一帧没发完（客户端丢弃了），
+        丢掉已收到的部分重新开始。
+        """
+        partial = session.fragments.get(frame.msg_type)
+        if partial is not None and partial[0] != frame.seq:
+            del session.fragments[frame.msg_type]
+            partial = None
+        if not frame.flags & FLAG_MORE:
+            if partial is None:
+                return frame
+            del session.fragments[frame.msg_type]
+            partial[1].append(frame.body)
+            return Frame(frame.msg_type, b''.join(partial[1]), frame.flags,
+                         frame.room, frame.user, frame.seq)
+        if partial is None:
+            partial = session.fragments[frame.msg_type] = [frame.seq, [], 0]
+        partial[2] += len(frame.body)
+        if partial[2] > self.max_frame_size:
+            raise FrameTooLargeError(f"分片拼接后超过 {self.max_frame_size} 字节")
+        partial[1].append(bytes(frame.body))
+        return None
+
+    def register_handler(self, msg_type, name, handler):
+        """注册命令处理函数：handler(session, frame, target_name)
+
+        target_name 是旧版文本协议中按用户名指定的目标，v2 帧为 None（目标在帧头的用户ID中）。
+        """
+        self._handlers[msg_type] = (handler, CommandStats(name))
+
+    def register_default_handlers(self):
+        for msg_type, name, handler in (
+                (MSG_CHAT, "chat", self.handle_chat),
+                (MSG_PRIVATE, "private", self.handle_private),
+                (MSG_FILE, "file", self.handle_file),
+                (MSG_FILE_OFFER, "file_offer", self.handle_file_offer),
+                (MSG_FILE_CHUNK, "file_chunk", self.handle_file_chunk),
+                (MSG_FILE_COMPLETE, "file_complete", self.handle_file_complete),
+                (MSG_FILE_CANCEL, "file_cancel", self.handle_file_cancel),
+                (MSG_FILE_HAVE, "file_have", self.handle_file_have),
+                (MSG_FILE_FETCH, "file_fetch", self.handle_file_fetch),
+                (MSG_VIDEO_DATA, "video_data", self.handle_video_data),
+                (MSG_MULTI_VIDEO_DATA, "multi_video_data", self.handle_multi_video_data),
+                (MSG_VIDEO_CALL_REQUEST, "video_call_request", self.handle_video_call_request),
+                (MSG_VIDEO_CALL_ACCEPT, "video_call_accept", self.handle_video_call_accept),
+                (MSG_VIDEO_CALL_REJECT, "video_call_reject", self.handle_video_call_reject),
+                (MSG_VIDEO_CALL_END, "video_call_end", self.handle_video_call_end),
+                (MSG_MULTI_VIDEO_INVITE, "multi_video_invite", self.handle_multi_video_invite),
+                (MSG_MULTI_VIDEO_JOIN, "multi_video_join", self.handle_multi_video_join),
+                (MSG_MULTI_VIDEO_LEAVE, "multi_video_leave", self.handle_multi_video_leave),
+                (MSG_MULTI_VIDEO_REFRESH, "multi_video_refresh", self.handle_room_signal),
+                (MSG_CAMERA_STATUS, "camera_status", self.handle_room_signal),
+                (MSG_MULTI_VIDEO_MODE, "multi_video_mode", self.handle_multi_video_mode),
+                (MSG_REQUEST_USERLIST, "request_userlist", self.handle_request_userlist),
+                (MSG_UDP_PORT, "udp_port", self.handle_udp_port),
+                (MSG_QUIT, "quit", self.handle_quit)):
+            self.register_handler(msg_type, name, handler)
+
+    def handle_login(self, session, payload):
+        """处理登录：v2 客户端发送握手帧，旧版客户端直接发送用户名"""
+        try:
+            hello = decode_hello(payload)
+        except MessageFormatError as e:
+            self.log(f"客户端 {session.address} 握手失败: {e}")
+            session.close()
+            return
+
+        if hello is None:
+            session.version = TEXT_PROTOCOL
+            username = str(payload, 'utf-8')
+        elif "bulk_token" in hello:
+            self.attach_bulk(session, hello["bulk_token"])
+            return
+        else:
+            session.version = BINARY_PROTOCOL
+            username = str(hello.get("username", ""))
+            caps = hello.get("caps", [])
+            if isinstance(caps, list):
+                session.caps = self.caps.intersection(
+                    cap for cap in caps if isinstance(cap, str))
+            fps = hello.get("video_fps")
+            if isinstance(fps, (int, float)) and 0 < fps < self.video_max_fps:
+                session.video_interval = 1.0 / fps
+
+        # 去除可能的空白字符
+        username = username.strip()
+        if not username:
+            session.close()
+            return
+
+        session.username = username
+        session.user_id = next(self._user_ids)
+        if username in self.remote_names or not self.sessions.add(session):
+            # 用户名已被占用，拒绝登录
+            session.username = None
+            session.send_system(f"【系统】错误：用户名 {username} 已被占用，请更换用户名")
+            session.close()
+            self.log(f"拒绝重复用户名登录: {username}")
+            return
+        self.notify_users_changed()
+        if self.backplane is not None:
+            self.backplane.user_online(session.user_id, username)
+
+        if session.version == BINARY_PROTOCOL:
+            welcome = {"version": PROTOCOL_VERSION, "user_id": session.user_id,
+                       "caps": sorted(session.caps)}
+            if CAP_BULK_CHANNEL in session.caps:
+                session.bulk_token = secrets.token_hex(16)
+                self.bulk_tokens[session.bulk_token] = session
+                welcome["bulk_token"] = session.bulk_token
+            session.enqueue(Frame(MSG_WELCOME, json.dumps(welcome).encode(),
+                                  user=session.user_id).encode())
+
+        host, port = session.address[:2]
+        self.log(f"{username} ({host}:{port}) 上线了！")
+
+        # 通知其他人
+        self.publish(system_message(f"【系统】{username} 进入了聊天室"), session)
+
+        # 向新连接的客户端发送当前在线用户列表；v2 客户端靠用户列表把用户ID映射为用户名，
+        # 所以其他 v2 客户端也需要收到新列表
+        user_list = self.user_list_message()
+        for other in self.sessions:
+            if other is session or other.version == BINARY_PROTOCOL:
+                other.deliver(user_list)
+
+    def attach_bulk(self, session, token):
+        """数据连接的握手：凭令牌挂到对应的聊天连接会话上，令牌只能使用一次"""
+        owner = self.bulk_tokens.pop(token, None) if isinstance(token, str) else None
+        if owner is None or owner not in self.sessions or owner.closing:
+            self.log(f"客户端 {session.address} 的数据连接令牌无效")
+            session.close()
+            return
+        owner.bulk_token = None
+        session.version = BINARY_PROTOCOL
+        session.username = owner.username
+        session.user_id = owner.user_id
+        session.caps = owner.caps
+        session.video_interval = owner.video_interval
+        session.owner = owner
+        owner.bulk = session
+        host, port = session.address[:2]
+        self.log(f"{owner.username} 的数据连接 ({host}:{port}) 已建立")
+
+    def handle_bulk_frame(self, session, payload):
+        """数据连接上的帧按聊天连接的会话处理，只接受视频和文件数据"""
+        msg_type = payload[0] if len(payload) else None
+        if msg_type not in BULK_MESSAGE_TYPES:
+            self.log(f"{session.username} 在数据连接上发送了不允许的消息: {msg_type}")
+            return
+        self.handle_frame(session.owner, payload)
+
+    def resolve_target(self, frame, target_name):
+        """找到帧的目标会话：旧协议按用户名，v2 按帧头中的用户ID
+
+        返回 (目标会话或 None, 用于提示的用户名)
+        """
+        if target_name is not None:
+            return self.sessions.get(target_name), target_name
+        target = self.sessions.get_by_id(frame.user)
+        if target is None:
+            return None, f"#{frame.user}"
+        return target, target.username
+
+    def remote_target(self, frame, target_name):
+        """在其他节点上的目标用户：返回 (用户ID, 用户名)，不在线时返回 None"""
+        if target_name is not None:
+            entry = self.remote_names.get(target_name)
+            return None if entry is None else (entry[1], target_name)
+        entry = self.remote_ids.get(frame.user)
+        return None if entry is None else (frame.user, entry[1])
+
+    def relay_message(self, session, frame, msg_type=None, flags=None):
+        """把上行帧改写为下行消息：帧头中的用户ID换成发送者，消息体原样保留"""
+        return OutboundMessage(
+            Frame(msg_type if msg_type is not None else frame.msg_type,
+                  frame.body,
+                  flags=frame.flags if flags is None else flags,
+                  room=frame.room, user=session.user_id, seq=frame.seq),
+            name=session.username)
+
+    def handle_chat(self, session, frame, target_name):
+        """普通群聊消息"""
+        text = frame.text()
+        self.log(f"{session.username}：{text}")
+        self.publish(self.relay_message(session, frame), session)
+
+    def handle_private(self, session, frame, target_name):
+        """私聊消息"""
+        username = session.username
+        target, target_user = self.resolve_target(frame, target_name)
+        remote = self.remote_target(frame, target_name) if target is None else None
+        private_msg = frame.text()
+        if target is not None or remote is not None:
+            if remote is not None:
+                target_user = remote[1]
+            if session.version == TEXT_PROTOCOL:
+                # 旧版客户端靠服务器回显显示自己发出的私聊
+                session.send_system(f"[私聊给{target_user}] {username}：{private_msg}")
+            # 发送给接收者（在其他节点上时经总线转发）
+            message = self.relay_message(session, frame)
+            if target is not None:
+                target.deliver(message)
+            else:
+                self.backplane.direct(remote[0], message.frame, message.name)
+            self.log(f"{username} 私聊 {target_user}：{private_msg}")
+        else:
+            # 目标用户不存在，发送错误消息给发送者
+            session.send_system(f"【系统】错误：用户 {target_user} 不在线")
+            self.log(f"{username} 尝试私聊 {target_user}（用户不在线）")
+
+    def handle_file(self, session, frame, target_name):
+        """整条发送的文件（旧版客户端的 /FILE|，或不支持分块传输的 v2 客户端）
+
+        带 FLAG_PRIVATE 时私聊发送给目标用户，否则发给其他所有人。旧版接收者原样转发；
+        v2 接收者的文件先存入文件仓库，私聊从仓库分块发送，群发只通知，点击后再下载。
+        """
+        username = session.username
+        body = frame.body
+        if not isinstance(body, Base64Body):
+            # 只检查文件名头，文件内容原样转发
+            try:
+                unpack_file_body(body)
+            except (MessageFormatError, UnicodeDecodeError):
+                session.send_system("【系统】错误：文件格式不正确")
+                self.log(f"{username} 发送的文件格式不正确")
+                return
+
+        if frame.flags & FLAG_PRIVATE:
+            target, target_user = self.resolve_target(frame, target_name)
+            if target is None:
+                session.send_system(f"【系统】错误：用户 {target_user} 不在线")
+                self.log(f"{username} 尝试私聊发送文件给 {target_user}（用户不在线）")
+                return
+            recipients = [target]
+            self.log(f"{username} 私聊发送文件给 {target_user}")
+        else:
+            recipients = [other for other in self.sessions if other is not session]
+            self.log(f"{username} 发送了一个文件")
+
+        message = self.relay_message(session, frame)
+        binary_recipients = []
+        for recipient in recipients:
+            if recipient.version == BINARY_PROTOCOL:
+                binary_recipients.append(recipient)
+            else:
+                recipient.deliver(message)
+        if not binary_recipients:
+            return
+
+        try:
+            filename, data = unpack_file_body(binary_body(frame))
+        except (MessageFormatError, UnicodeDecodeError):
+            session.send_system("【系统】错误：文件格式不正确")
+            self.log(f"{username} 发送的文件格式不正确")
+            return
+        # 接收缓冲区只在本次调用内有效，存入仓库前先复制
+        self.spawn(self.store_file(session, filename, bytes(data), frame.flags & FLAG_PRIVATE,
+                                   binary_recipients, message))
+
+    async def store_file(self, session, filename, data, flags, recipients, message):
+        """整条发送的文件存入仓库后发给 v2 接收者（摘要和写盘在线程池中进行）"""
+        try:
+            sha256 = await self.blobs.put_bytes(data)
+        except (TransferError, OSError) as e:
+            # 存不进仓库时退回到整条转发
+            self.log(f"{session.username} 发送的文件未能存入文件仓库: {e}")
+            for recipient in recipients:
+                recipient.deliver(message)
+            return
+        upload = FileUpload(session, next(self._file_ids), filename, len(data), sha256,
+                            FILE_CHUNK_SIZE, flags, recipients)
+        self.publish_file(upload)
+
+    def handle_file_offer(self, session, frame, target_name):
+        """分块上传开始：确定接收者，回复服务器已有的块
+
+        文件已在仓库中时直接回复全满的位图，发送者不需要上传任何数据。
+        私聊（FLAG_PRIVATE）发给目标用户，否则通知其他所有 v2 客户端；
+        旧版客户端不支持分块接收，群发时只收到一条提示。
+        """
+        username = session.username
+        transfer_id, filename, size, sha256, chunk_size = unpack_file_offer(frame.body)
+        key = (session.user_id, transfer_id)
+        if key in self.uploads:
+            session.send_system("【系统】错误：文件传输ID重复")
+            return
+        if sum(1 for upload in self.uploads.values()
+               if upload.sender is session) >= MAX_FILE_TRANSFERS:
+            self.cancel_file_upload(session, transfer_id, "同时进行的文件传输过多")
+            return
+        # 仓库中已有的文件按实际大小发布，声明的大小不符时拒绝（接收者和下载票据都依赖这个大小）
+        stored = self.blobs.blobs.get(sha256)
+        if stored is not None and stored != size:
+            self.cancel_file_upload(session, transfer_id, "文件大小与校验值不符")
+            return
+
+        if frame.flags & FLAG_PRIVATE:
+            target, target_user = self.resolve_target(frame, target_name)
+            if target is None:
+                self.cancel_file_upload(session, transfer_id, f"用户 {target_user} 不在线")
+                return
+            if target.version != BINARY_PROTOCOL:
+                self.cancel_file_upload(
+                    session, transfer_id, f"{target_user} 的客户端版本不支持接收文件")
+                return
+            recipients = [target]
+            self.log(f"{username} 开始私聊发送文件 {filename} 给 {target_user}（{size} 字节）")
+        else:
+            recipients = []
+            notice = None
+            for other in self.sessions:
+                if other is session:
+                    continue
+                if other.version == BINARY_PROTOCOL:
+                    recipients.append(other)
+                else:
+                    if notice is None:
+                        notice = system_message(
+                            f"【系统】{username} 发送了文件 {filename}，"
+                            f"当前客户端版本不支持接收")
+                    other.deliver(notice)
+            if not recipients:
+                self.cancel_file_upload(session, transfer_id, "没有可以接收文件的用户")
+                return
+            self.log(f"{username} 开始发送文件 {filename}（{size} 字节）")
+
+        upload = FileUpload(session, transfer_id, filename, size, sha256, chunk_size,
+                            frame.flags & FLAG_PRIVATE, recipients,
+                            file_offer_thumbnail(frame.body))
+        if stored is not None:
+            self.blobs.hits += 1
+            self.blobs.touch(sha256)
+            have = full_chunk_bitmap(chunk_count(size, chunk_size))
+            session.enqueue(Frame(MSG_FILE_HAVE, pack_file_have(transfer_id, have)).encode())
+            self.log(f"文件 {filename} 已在文件仓库中，无需上传")
+            self.publish_file(upload)
+            return
+        try:
+            upload.incoming = self.blobs.open_upload(
+                username, filename, size, sha256, chunk_size)
+        except (TransferError, OSError) as e:
+            self.cancel_file_upload(session, transfer_id, str(e))
+            return
+        self.uploads[key] = upload
+        session.enqueue(Frame(
+            MSG_FILE_HAVE, pack_file_have(transfer_id, upload.incoming.have())).encode())
+
+    def handle_file_chunk(self, session, frame, target_name):
+        """上传的数据块：在线程池中校验 CRC 并写入仓库的未完成文件，写完后向发送者确认
+
+        发送者最多有 1MB 未确认的数据，写盘慢时发送者自然等待。
+        """
+        transfer_id, offset, crc, data = unpack_file_chunk(frame.body)
+        upload = self.uploads.get((session.user_id, transfer_id))
+        if upload is None:
+            return  # 已取消的传输在途的数据块
+        self.spawn(self.store_file_chunk(upload, offset, crc, bytes(data)))
+
+    async def store_file_chunk(self, upload, offset, crc, data):
+        session = upload.sender
+        try:
+            # CRC 不一致的块不记录，完成时由发送者补发
+            await self.blobs.write_chunk(upload.incoming, offset, crc, data)
+        except (TransferError, OSError) as e:
+            if self.uploads.get(upload.key) is upload:
+                self.close_file_upload(upload)
+                self.cancel_file_upload(session, upload.transfer_id, str(e))
+                self.log(f"{session.username} 上传的文件 {upload.filename} 中止：{e}")
+            return
+        if self.uploads.get(upload.key) is not upload:
+            return  # 写盘期间传输已取消或发送者已下线
+        upload.received += len(data)
+        session.enqueue(Frame(
+            MSG_FILE_ACK, pack_file_ack(upload.transfer_id, upload.received)).encode())
+
+    def handle_file_complete(self, session, frame, target_name):
+        """发送者发完一轮：校验并存入仓库后回复全满的位图，再发给接收者；缺块时回复缺少的块"""
+        transfer_id, digest = unpack_file_complete(frame.body)
+        upload = self.uploads.get((session.user_id, transfer_id))
+        if upload is None:
+            return
+        self.spawn(self.finish_file_upload(upload, bytes(digest)))
+
+    async def finish_file_upload(self, upload, digest):
+        """在之前的数据块写完后计算摘要（线程池中），内容已存在时直接算作完成"""
+        session, transfer_id = upload.sender, upload.transfer_id
+        count = chunk_count(upload.size, upload.chunk_size)
+        try:
+            done = await self.blobs.finish_upload(upload.incoming, digest)
+        except TransferError as e:
+            # 校验失败时块记录已清空，发送者会全部重发
+            self.log(f"{session.username} 上传的文件 {upload.filename} {e}")
+            done = False
+        except OSError as e:
+            if self.uploads.get(upload.key) is upload:
+                self.close_file_upload(upload)
+                self.cancel_file_upload(session, transfer_id, str(e))
+            return
+        if self.uploads.get(upload.key) is not upload:
+            return
+        have = full_chunk_bitmap(count) if done else upload.incoming.have()
+        session.enqueue(Frame(MSG_FILE_HAVE, pack_file_have(transfer_id, have)).encode())
+        if done:
+            self.close_file_upload(upload)
+            self.log(f"{session.username} 的文件 {upload.filename} 上传完成")
+            self.publish_file(upload)
+
+    def handle_file_have(self, session, frame, target_name):
+        """接收者报告已有的块（帧头用户ID为上传者）：补发缺少的块，全满时发送完成"""
+        transfer_id, bitmap = unpack_file_have(frame.body)
+        delivery = self.deliveries.get((session.user_id, frame.user, transfer_id))
+        if delivery is None:
+            return
+        if len(bitmap) != (delivery.chunk_count + 7) // 8:
+            bitmap = empty_chunk_bitmap(delivery.chunk_count)
+        missing = [index for index in range(delivery.chunk_count)
+                   if not bitmap_has(bitmap, index)]
+        if delivery.completing:
+            if not missing:
+                self.close_file_delivery(delivery)
+                self.log(f"{session.username} 已收到 {delivery.sender_name} "
+                         f"发送的文件 {delivery.filename}")
+                return
+            delivery.rounds += 1
+            if delivery.rounds > MAX_RESEND_ROUNDS:
+                self.abort_file_delivery(delivery, "多次重发后仍未收全")
+                return
+            delivery.completing = False
+        delivery.pending = collections.deque(missing)
+        self.pump_file_delivery(delivery)
+
+    def handle_file_cancel(self, session, frame, target_name):
+        """取消传输：上传者取消时放弃上传；接收者取消时停止发给它
+
+        接收者发来的取消消息帧头用户ID为上传者，上传者自己取消时为 0。
+        """
+        transfer_id = file_transfer_id(frame.body)
+        if frame.user and frame.user != session.user_id:
+            delivery = self.deliveries.get((session.user_id, frame.user, transfer_id))
+            if delivery is not None:
+                self.close_file_delivery(delivery)
+                return
+            upload = self.uploads.get((frame.user, transfer_id))
+            if upload is not None and session in upload.recipients:
+                self.remove_upload_recipient(upload, session, "接收方已取消")
+            return
+
+        upload = self.uploads.get((session.user_id, transfer_id))
+        if upload is None:
+            return
+        self.close_file_upload(upload)
+        self.log(f"{session.username} 取消了文件 {upload.filename} 的发送")
+
+    def handle_file_fetch(self, session, frame, target_name):
+        """用户点击下载群发的文件（帧头用户ID为上传者）：从仓库发给它"""
+        transfer_id = file_transfer_id(frame.body)
+        key = (frame.user, transfer_id)
+        upload = self.shared_files.get(key)
+        if upload is None or upload.sha256 not in self.blobs:
+            self.shared_files.pop(key, None)
+            session.enqueue(Frame(
+                MSG_FILE_CANCEL, pack_file_cancel(transfer_id, "文件已不在服务器上"),
+                user=frame.user).encode())
+            return
+        if (session.user_id,) + key in self.deliveries:
+            return  # 已经在下载
+        self.shared_files.move_to_end(key)
+        self.log(f"{session.username} 下载 {upload.sender.username} 发送的文件 {upload.filename}")
+        if CAP_FILE_DOWNLOAD in session.caps:
+            # 客户端自己连接下载端口获取文件内容
+            ticket = self.downloads.issue_ticket(upload.sha256, upload.size)
+            session.enqueue(Frame(
+                MSG_FILE_TICKET, pack_file_ticket(transfer_id, self.downloads.port, ticket),
+                user=frame.user).encode())
+            return
+        self.start_file_deliveries(upload, [session])
+
+    def publish_file(self, upload):
+        """文件已存入仓库：私聊直接发给接收者；群发只通知文件信息，用户点击后再下载"""
+        if upload.flags & FLAG_PRIVATE:
+            self.start_file_deliveries(upload, upload.recipients)
+            return
+        self.shared_files[upload.key] = upload
+        while len(self.shared_files) > MAX_SHARED_FILES:
+            self.shared_files.popitem(last=False)
+        announce = Frame(MSG_FILE_ANNOUNCE, pack_file_offer(
+            upload.transfer_id, upload.filename, upload.size, upload.sha256,
+            upload.chunk_size, upload.thumbnail), user=upload.sender.user_id).encode()
+        for recipient in upload.recipients:
+            if recipient in self.sessions:
+                recipient.enqueue(announce)
+
+    def start_file_deliveries(self, upload, recipients):
+        """文件已在仓库中：向每个仍在线的接收者发送传输请求，等它回复已有的块"""
+        offer = None
+        for recipient in recipients:
+            if recipient not in self.sessions:
+                continue
+            try:
+                delivery = FileDelivery(recipient, upload, self.blobs.open(upload.sha256))
+            except OSError as e:
+                self.log(f"打开文件仓库中的 {upload.filename} 失败: {e}")
+                return
+            self.deliveries[delivery.key] = delivery
+            if offer is None:
+                offer = Frame(MSG_FILE_OFFER, pack_file_offer(
+                    upload.transfer_id, upload.filename, upload.size, upload.sha256,
+                    upload.chunk_size), flags=upload.flags,
+                    user=upload.sender.user_id).encode()
+            recipient.enqueue(offer)
+
+    def pump_file_delivery(self, delivery):
+        """把待发送的块放进接收者（数据连接）的出站队列，积压超过低水位时暂停，写出后继续"""
+        session = delivery.session.data_channel
+        while delivery.pending:
+            if session.closing or session.transport.is_closing():
+                return
+            if session.queued_bytes > self.outbound_low_watermark:
+                session.waiting_transfers.add(delivery)
+                return
+            try:
+                offset, data = delivery.read_chunk(delivery.pending.popleft())
+            except OSError as e:
+                self.abort_file_delivery(delivery, f"读取文件失败: {e}")
+                return
+            session.enqueue(Frame(
+                MSG_FILE_CHUNK, pack_file_chunk(delivery.transfer_id, offset, data),
+                user=delivery.sender_id).encode())
+        if not delivery.completing:
+            delivery.completing = True
+            session.enqueue(Frame(
+                MSG_FILE_COMPLETE,
+                pack_file_complete(delivery.transfer_id, bytes.fromhex(delivery.sha256)),
+                user=delivery.sender_id).encode())
+
+    def release_file_transfers(self, session):
+        """会话的积压已回落到低水位以下，继续发送等待它的文件"""
+        deliveries = session.waiting_transfers
+        session.waiting_transfers = set()
+        for delivery in deliveries:
+            if self.deliveries.get(delivery.key) is delivery:
+                self.pump_file_delivery(delivery)
+
+    def remove_upload_recipient(self, upload, session, reason):
+        """上传完成前接收者取消或下线：最后一个接收者离开时取消上传"""
+        upload.recipients.remove(session)
+        if not upload.recipients:
+            self.close_file_upload(upload)
+            self.cancel_file_upload(upload.sender, upload.transfer_id, reason)
+
+    def close_file_upload(self, upload):
+        """上传结束，不再接受该传输的消息；未完成的数据留在仓库中以便续传"""
+        if self.uploads.pop(upload.key, None) is not None:
+            self.blobs.release_upload(upload.sha256)
+
+    def cancel_file_upload(self, session, transfer_id, reason):
+        """通知上传者它的传输已被取消（帧头用户ID为 0）"""
+        session.enqueue(Frame(
+            MSG_FILE_CANCEL, pack_file_cancel(transfer_id, reason)).encode())
+
+    def close_file_delivery(self, delivery):
+        if self.deliveries.pop(delivery.key, None) is None:
+            return
+        delivery.session.waiting_transfers.discard(delivery)
+        delivery.session.data_channel.waiting_transfers.discard(delivery)
+        delivery.file.close()
+        self.blobs.unpin(delivery.sha256)
+
+    def abort_file_delivery(self, delivery, reason):
+        """服务器停止向接收者发送，通知接收者（与数据块走同一连接，排在已发出的块之后）"""
+        self.close_file_delivery(delivery)
+        delivery.session.data_channel.enqueue(Frame(
+            MSG_FILE_CANCEL, pack_file_cancel(delivery.transfer_id, reason),
+            user=delivery.sender_id).encode())
+        self.log(f"向 {delivery.session.username} 发送文件 {delivery.filename} 中止：{reason}")
+
+    def handle_video_data(self, session, frame, target_name):
+        """一对一视频帧，转发给目标用户，服务器不记录视频数据，以保护隐私"""
+        target, _ = self.resolve_target(frame, target_name)
+        if target is not None:
+            target.deliver_video(self.relay_message(session, frame))
+
+    def handle_multi_video_data(self, session, frame, target_name):
+        """转发给同一房间的其他成员，服务器不记录视频数据，以保护隐私
+
+        不在房间中的用户发来的视频帧直接丢弃；合成画面模式的房间交给媒体转发服务器合成。
+        """
+        if session not in self.rooms.get(frame.room, ()):
+            return
+        if frame.room in self.room_modes:
+            body = binary_body(frame)
+            # 超过控制帧上限的帧转发服务器收不了，直接丢弃
+            if FRAME_HEADER.size + len(body) > MAX_CONTROL_FRAME:
+                return
+            self.media.send(CTRL_FRAME, frame.room, session.user_id, bytes(body))
+        else:
+            self.room_broadcast(frame.room, self.relay_message(session, frame), session,
+                                video=True)
+
+    def handle_multi_video_invite(self, session, frame, target_name):
+        # 广播邀请给所有用户（除了发起者），房间成员以之后的加入为准
+        self.broadcast(self.relay_message(session, frame), session)
+        self.log(f"{session.username} 发起了多人视频会议，邀请所有在线用户")
+
+    def handle_multi_video_join(self, session, frame, target_name):
+        """加入房间：把当前成员名单发给加入者，再通知房间内的其他成员"""
+        members = self.rooms.setdefault(frame.room, set())
+        if session in members:
+            return
+        roster = sorted((member.user_id, member.username) for member in members)
+        session.deliver(OutboundMessage(Frame(
+            MSG_MULTI_VIDEO_ROSTER, json.dumps(roster).encode(), room=frame.room)))
+        if frame.room in self.room_modes:
+            session.deliver(OutboundMessage(Frame(
+                MSG_MULTI_VIDEO_MODE, VIDEO_MODE_MOSAIC.encode(), room=frame.room)))
+        self.room_broadcast(frame.room, self.relay_message(session, frame))
+        members.add(session)
+        session.rooms.add(frame.room)
+        self.media_join(session, frame.room)
+        self.log(f"{session.username} 加入了多人视频会议（{len(members)} 人）")
+
+    def handle_multi_video_leave(self, session, frame, target_name):
+        if self.leave_room(session, frame.room):
+            self.log(f"{session.username} 离开了多人视频会议")
+
+    def handle_room_signal(self, session, frame, target_name):
+        """刷新请求、摄像头状态：转发给房间内的其他成员，不在聊天室显示"""
+        if session in self.rooms.get(frame.room, ()):
+            self.room_broadcast(frame.room, self.relay_message(session, frame), session)
+
+    def handle_multi_video_mode(self, session, frame, target_name):
+        """切换房间的视频模式（逐路转发 / 服务器合成画面），通知房间内的所有成员"""
+        if session not in self.rooms.get(frame.room, ()):
+            return
+        mode = frame.text()
+        if mode not in (VIDEO_MODE_FORWARD, VIDEO_MODE_MOSAIC):
+            raise MessageFormatError(f"未知的多人视频模式: {mode}")
+        if mode == VIDEO_MODE_MOSAIC and not (
+                self.media is not None and self.media.connected and self.media.mosaic):
+            session.send_system("【系统】错误：服务器不支持合成画面模式")
+            return
+        if (frame.room in self.room_modes) == (mode == VIDEO_MODE_MOSAIC):
+            return
+        self.set_room_mode(frame.room, mode, self.relay_message(session, frame))
+        self.log(f"{session.username} 把多人视频会议切换为"
+                 f"{'合成画面' if mode == VIDEO_MODE_MOSAIC else '逐路转发'}模式")
+
+    def set_room_mode(self, room, mode, message):
+        if mode == VIDEO_MODE_MOSAIC:
+            self.room_modes[room] = mode
+        else:
+            self.room_modes.pop(room, None)
+        if self.media is not None:
+            self.media.send(CTRL_MODE, room, 0, mode.encode())
+        self.room_broadcast(room, message)
+
+    def leave_room(self, session, room):
+        """把会话移出房间并通知剩下的成员，房间空了就删除；不在房间中时返回 False"""
+        members = self.rooms.get(room)
+        if members is None or session not in members:
+            return False
+        members.remove(session)
+        session.rooms.discard(room)
+        session.media_tokens.pop(room, None)
+        session.media_rooms.discard(room)
+        if self.media is not None:
+            self.media.send(CTRL_LEAVE, room, session.user_id)
+        if members:
+            self.room_broadcast(room, OutboundMessage(
+                Frame(MSG_MULTI_VIDEO_LEAVE, room=room, user=session.user_id),
+                name=session.username))
+        else:
+            del self.rooms[room]
+            self.room_modes.pop(room, None)
+        return True
+
+    def media_join(self, session, room):
+        """把房间成员告诉媒体转发服务器，支持的客户端得到 UDP 端口和令牌"""
+        if self.media is None or not self.media.connected:
+            return
+        token = b''
+        if CAP_MEDIA_RELAY in session.caps:
+            token = session.media_tokens.get(room)
+            if token is None:
+                token = session.media_tokens[room] = secrets.token_bytes(MEDIA_TOKEN_SIZE)
+            session.deliver(OutboundMessage(Frame(
+                MSG_MEDIA_RELAY, pack_media_relay(self.media.udp_port, token), room=room)))
+        self.media.send(CTRL_JOIN, room, session.user_id, token)
+
+    def media_connected(self):
+        """媒体转发服务器（重新）连上后下发所有房间的成员"""
+        for room, members in self.rooms.items():
+            for session in members:
+                self.media_join(session, room)
+
+    def media_disconnected(self):
+        """媒体转发服务器断开：视频改由聊天连接转发，合成画面的房间恢复为逐路转发"""
+        for session in self.sessions:
+            session.media_rooms.clear()
+        for room in list(self.room_modes):
+            self.set_room_mode(room, VIDEO_MODE_FORWARD, OutboundMessage(
+                Frame(MSG_MULTI_VIDEO_MODE, VIDEO_MODE_FORWARD.encode(), room=room)))
+
+    def handle_media_message(self, frame):
+        """媒体转发服务器发来的成员状态和需要经聊天连接转发的视频帧"""
+        members = self.rooms.get(frame.room, ())
+        if frame.msg_type == CTRL_FRAME and frame.user == 0:
+            # 合成画面，发给只用聊天连接的成员
+            message = OutboundMessage(
+                Frame(MSG_MULTI_VIDEO_DATA, frame.body, room=frame.room), name=MOSAIC_NAME)
+            for member in list(members):
+                if frame.room not in member.media_rooms:
+                    member.deliver_video(message)
+            return
+        session = self.sessions.get_by_id(frame.user)
+        if session is None or session not in members:
+            return
+        if frame.msg_type == CTRL_ATTACH:
+            session.media_rooms.add(frame.room)
+        elif frame.msg_type == CTRL_DETACH:
+            session.media_rooms.discard(frame.room)
+        elif frame.msg_type == CTRL_FRAME:
+            message = OutboundMessage(
+                Frame(MSG_MULTI_VIDEO_DATA, frame.body, room=frame.room, user=session.user_id),
+                name=session.username)
+            for member in list(members):
+                if member is not session and frame.room not in member.media_rooms:
+                    member.deliver_video(message)
+
+    def handle_request_userlist(self, session, frame, target_name):
+        session.deliver(self.user_list_message())
+
+    def handle_udp_port(self, session, frame, target_name):
+        """一对一视频通话中客户端报告自己的 UDP 端口，双方都报告后把对方的候选地址发给双方"""
+        session.udp_endpoint = unpack_udp_endpoint(frame.body)
+        partner = self.sessions.get(self.video_calls.get(session.username))
+        if partner is None or partner.udp_endpoint is None:
+            return
+        for receiver, peer in ((session, partner), (partner, session)):
+            receiver.deliver(OutboundMessage(Frame(
+                MSG_UDP_PORT, pack_udp_candidates(self.udp_candidates(peer)),
+                user=peer.user_id), name=peer.username))
+        self.log(f"{session.username} 与 {partner.username} 交换了点对点视频地址")
+
+    def udp_candidates(self, session):
+        """会话的点对点候选地址：服务器看到的 IP，以及客户端报告的本机 IP（同一局域网内有效）"""
+        port, local_ip = session.udp_endpoint
+        candidates = [(session.address[0], port)]
+        if local_ip and local_ip != session.address[0]:
+            candidates.append((local_ip, port))
+        return candidates
+
+    def handle_quit(self, session, frame, target_name):
+        session.close()
+
+    def handle_video_call_request(self, session, frame, target_name):
+        username = session.username
+        target, target_user = self.resolve_target(frame, target_name)
+        if target is not None:
+            # 发送给目标用户视频通话请求
+            invite = self.relay_message(session, frame, MSG_VIDEO_CALL_INVITE, 0)
+            if target.deliver(invite):
+                self.log(f"{username} 请求与 {target_user} 进行视频通话")
+            else:
+                # 发送失败，通知发起者
+                session.send_system(f"【系统】错误：无法连接到 {target_user}")
+                self.log(f"向 {target_user} 发送视频通话请求失败")
+        else:
+            # 目标用户不存在，发送错误消息给发起者
+            session.send_system(f"【系统】错误：用户 {target_user} 不在线")
+            self.log(f"{username} 尝试视频通话 {target_user}（用户不在线）")
+
+    def handle_video_call_accept(self, session, frame, target_name):
+        username = session.username
+        target, target_user = self.resolve_target(frame, target_name)
+        # 通知发起者对方接受了视频通话
+        start = self.relay_message(session, frame, MSG_VIDEO_CALL_START, 0)
+        if target is not None and target.deliver(start):
+            # 记录视频通话配对关系，双方在通话开始后重新报告 UDP 端口
+            self.video_calls[username] = target_user
+            self.video_calls[target_user] = username
+            session.udp_endpoint = target.udp_endpoint = None
+            self.log(f"{target_user} 接受了 {username} 的视频通话")
+        else:
+            session.send_system(f"【系统】错误：无法通知 {target_user} 视频通话已被接受")
+            self.log(f"通知 {target_user} 视频通话接受失败")
+
+    def handle_video_call_reject(self, session, frame, target_name):
+        username = session.username
+        target, target_user = self.resolve_target(frame, target_name)
+        # 通知发起者对方拒绝了视频通话
+        rejected = self.relay_message(session, frame, MSG_VIDEO_CALL_REJECTED, 0)
+        if target is not None and target.deliver(rejected):
+            self.log(f"{target_user} 拒绝了 {username} 的视频通话")
+        else:
+            session.send_system(f"【系统】错误：无法通知 {target_user} 视频通话已被拒绝")
+            self.log(f"通知 {target_user} 视频通话拒绝失败")
+
+    def handle_video_call_end(self, session, frame, target_name):
+        username = session.username
+        target, target_user = self.resolve_target(frame, target_name)
+        # 通知对方视频通话已结束
+        ended = self.relay_message(session, frame, MSG_VIDEO_CALL_ENDED, 0)
+        if target is not None and target.deliver(ended):
+            # 清除视频通话配对关系
+            self.video_calls.pop(username, None)
+            self.video_calls.pop(target_user, None)
+            self.log(f"{username} 与 {target_user} 的视频通话已结束")
+        else:
+            session.send_system(f"【系统】错误：无法通知 {target_user} 视频通话已结束")
+            self.log(f"通知 {target_user} 视频通话结束失败")
+
+    def remove_session(self, session):
+        """客户端下线；数据连接断开时关闭聊天连接，由聊天连接的断开完成下线"""
+        if session.owner is not None:
+            if session.owner.bulk is session and session.owner in self.sessions:
+                self.log(f"{session.username} 的数据连接已断开")
+                session.owner.close()
+            return
+        if not self.sessions.remove(session):
+            return
+        username = session.username
+        if self.backplane is not None:
+            self.backplane.user_offline(session.user_id)
+        if session.bulk_token is not None:
+            self.bulk_tokens.pop(session.bulk_token, None)
+        if session.bulk is not None:
+            session.bulk.abort()
+
+        # 检查用户是否正在进行视频通话
+        if username in self.video_calls:
+            # 通知视频通话伙伴用户已下线
+            partner = self.video_calls.pop(username)
+            self.send_to_user(partner, OutboundMessage(
+                Frame(MSG_VIDEO_CALL_ENDED, flags=FLAG_OFFLINE,
+                      user=session.user_id),
+                name=username))
+            self.video_calls.pop(partner, None)
+            self.log(f"{username} 下线，已通知视频通话伙伴 {partner}")
+
+        # 退出所有多人视频房间
+        for room in list(session.rooms):
+            self.leave_room(session, room)
+
+        # 停止该用户的上传（已收到的块保留在仓库中），并把它从其他上传的接收者中移除；
+        # 已经上传完成的文件继续从仓库发给其他接收者
+        for upload in list(self.uploads.values()):
+            if upload.sender is session:
+                self.close_file_upload(upload)
+            elif session in upload.recipients:
+                self.remove_upload_recipient(upload, session, "接收方已离线")
+        for delivery in list(self.deliveries.values()):
+            if delivery.session is session:
+                self.close_file_delivery(delivery)
+
+        self.notify_users_changed()
+
+        # 通知其他客户端更新用户列表
+        self.broadcast(self.user_list_message())
+
+        self.log(f"{username} 下线了")
+        self.publish(system_message(f"【系统】{username} 离开了聊天室"))
+
+    # ==================== 发送 ====================
+
+    def user_list_message(self):
+        """当前在线用户列表，在线用户不变时重复使用同一个编码结果
+
+        v2：消息体为 JSON [[用户ID, 用户名], ...]；旧协议：/USERLIST|user1|user2...
+        """
+        if self._user_list_message is None:
+            users = self.sessions.users()
+            for remote in self.remote_users.values():
+                users.extend(remote.items())
+            self._user_list_message = OutboundMessage(
+                Frame(MSG_USERLIST, json.dumps(users).encode()),
+                text="/USERLIST|" + "|".join(name for _, name in users))
+        return self._user_list_message
+
+    def publish(self, message, exclude_session=None):
+        """广播给本节点的所有客户端，并经总线广播给其他节点的客户端"""
+        self.broadcast(message, exclude_session)
+        if self.backplane is not None:
+            self.backplane.broadcast(message.frame, message.name, message.text)
+
+    def send_to_user(self, target_username, message, droppable=False):
+        """发送消息给指定用户，用户在其他节点上时按目录经总线直接发到该节点"""
+        session = self.sessions.get(target_username)
+        if session is not None:
+            return session.deliver(message, droppable)
+        entry = self.remote_names.get(target_username)
+        if entry is None:
+            return False
+        self.backplane.direct(entry[1], message.frame, message.name, message.text)
+        return True
+
+    def room_broadcast(self, room, message, exclude_session=None, video=False):
+        """只发给多人视频房间的成员，视频帧放进各成员的视频槽"""
+        for session in list(self.rooms.get(room, ())):
+            if session is not exclude_session:
+                if video:
+                    session.deliver_video(message)
+                else:
+                    session.deliver(message)
+
+    def broadcast(self, message, exclude_session=None, droppable=False):
+        """把同一条消息放进所有客户端的出站队列，每种协议只编码一次"""
+        for session in self.sessions:
+            if session is not exclude_session:
+                session.deliver(message, droppable)
@@ -0,0 +1,102 @@
+import asyncio
+import secrets
+import time
+
+from protocol import (DOWNLOAD_TICKET_SIZE, DOWNLOAD_REQUEST, DOWNLOAD_RESPONSE,
+                      DOWNLOAD_OK, DOWNLOAD_BAD_TICKET, DOWNLOAD_BAD_RANGE)
+
+TICKET_TTL = 10 * 60  # 票据有效期（秒），期间可以多次请求，断线后从缺少的部分继续
+IDLE_TIMEOUT = 60  # 下载连接空闲超过该时间则关闭（秒）
+
+
+class DownloadServer:
+    """文件仓库的下载端口
+
+    客户端凭聊天连接上得到的票据连接这里，按 (偏移, 长度) 请求文件的一段，服务器用
+    loop.sendfile() 直接从仓库文件发送（内核 sendfile，不经过 Python 缓冲区）。
+    下载和聊天连接分开，大文件不会占用聊天连接的出站队列。
+    与引擎运行在同一个事件循环中，文件仓库只在该线程中访问。
+    """
+
+    def __init__(self, blobs, host, port=0, ticket_ttl=TICKET_TTL, on_log=None):
+        self.blobs = blobs
+        self.host = host
+        self.port = port  # 0 表示由系统分配，启动后更新为实际端口
+        self.ticket_ttl = ticket_ttl
+        self.on_log = on_log
+        self.server = None
+        self.tickets = {}  # 票据 -> (SHA-256, 文件大小, 过期时间)
+        self.requests = 0
+        self.bytes_sent = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, reuse_address=True)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.tickets.clear()
+
+    def log(self, message):
+        if self.on_log:
+            self.on_log(message)
+
+    def issue_ticket(self, sha256, size):
+        """为仓库中的文件签发下载票据，同时清理过期的票据"""
+        now = time.monotonic()
+        for ticket, entry in list(self.tickets.items()):
+            if entry[2] < now:
+                del self.tickets[ticket]
+        ticket = secrets.token_bytes(DOWNLOAD_TICKET_SIZE)
+        self.tickets[ticket] = (sha256, size, now + self.ticket_ttl)
+        return ticket
+
+    def lookup(self, ticket):
+        entry = self.tickets.get(ticket)
+        if entry is None or entry[2] < time.monotonic() or entry[0] not in self.blobs:
+            return None
+        return entry
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        reader.readexactly(DOWNLOAD_REQUEST.size), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                ticket, offset, count = DOWNLOAD_REQUEST.unpack(request)
+                entry = self.lookup(ticket)
+                if entry is None:
+                    writer.write(DOWNLOAD_RESPONSE.pack(DOWNLOAD_BAD_TICKET, 0))
+                    await writer.drain()
+                    break
+                sha256, size, _ = entry
+                if offset > size:
+                    writer.write(DOWNLOAD_RESPONSE.pack(DOWNLOAD_BAD_RANGE, 0))
+                    await writer.drain()
+                    continue
+                count = size - offset if not count else min(count, size - offset)
+                f = self.blobs.open(sha256)
+                try:
+                    writer.write(DOWNLOAD_RESPONSE.pack(DOWNLOAD_OK, count))
+                    await writer.drain()
+                    if count:
+                        await loop.sendfile(writer.transport, f, offset, count)
+                finally:
+                    f.close()
+                    self.blobs.unpin(sha256)
+                self.requests += 1
+                self.bytes_sent += count
+        except (ConnectionError, OSError) as e:
+            self.log(f"下载连接 {writer.get_extra_info('peername')} 出错: {e}")
+        finally:
+            writer.close()
+
+    def stats(self):
+        return {"port": self.port, "tickets": len(self.tickets),
+                "requests": self.requests, "bytes": self.bytes_sent}
@@ -0,0 +1,367 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from protocol import (FILE_CHUNK_SIZE, DOWNLOAD_REQUEST, DOWNLOAD_RESPONSE, DOWNLOAD_OK,
+                      DOWNLOAD_BAD_TICKET, chunk_count, empty_chunk_bitmap,
+                      full_chunk_bitmap, bitmap_has)
+
+# 发送端最多允许这么多字节已发出但未被服务器确认，接收方慢时发送端在这里等待
+FILE_WINDOW = 16 * FILE_CHUNK_SIZE
+ACK_TIMEOUT = 60  # 超过该时间没有收到任何确认则放弃发送（秒）
+PROGRESS_INTERVAL = 0.1  # 进度事件的最小间隔（秒）
+MAX_RESEND_ROUNDS = 3  # 发完后仍有接收方缺块时最多重发的轮数
+
+# 接收端未完成的数据保存在 received_files/<SHA-256>.part，旁边的 .part.json 记录已收到的块，
+# 客户端重启或重新连接后，同一文件（SHA-256 相同）的传输从这里继续
+PART_SUFFIX = ".part"
+META_SUFFIX = ".part.json"
+META_SAVE_INTERVAL = 1.0  # 写入块记录的最小间隔（秒）
+PART_MAX_AGE = 7 * 24 * 3600  # 超过该时间未更新的未完成文件在启动时清理（秒）
+HASH_BLOCK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 30  # 下载连接上等待数据的超时（秒）
+
+
+class TransferError(Exception):
+    """文件传输失败（数据不连续、校验不一致、被取消等）"""
+
+
+def received_file_path(directory, filename):
+    """接收文件的保存路径：时间戳前缀 + 原文件名，已存在时追加序号避免覆盖"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    name, ext = os.path.splitext(os.path.basename(filename))
+    path = os.path.join(directory, f"{timestamp}_{name}{ext}")
+    counter = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{timestamp}_{name}_{counter}{ext}")
+        counter += 1
+    return path
+
+
+def file_sha256(path):
+    """计算文件的 SHA-256 十六进制摘要"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _recv_exactly(sock, size):
+    """从套接字读取 size 字节，连接提前关闭时抛出 ConnectionError"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("下载连接已断开")
+        received += n
+    return buffer
+
+
+def cleanup_stale_parts(directory, max_age=PART_MAX_AGE):
+    """删除长时间没有继续的未完成文件及其块记录"""
+    now = time.time()
+    for name in os.listdir(directory):
+        if not (name.endswith(PART_SUFFIX) or name.endswith(META_SUFFIX)):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class _Transfer:
+    """传输进度，供界面按固定间隔刷新"""
+
+    def __init__(self, transfer_id, filename, size, chunk_size):
+        self.transfer_id = transfer_id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunk_count = chunk_count(size, chunk_size)
+        self.done = 0  # 已完成的字节数
+        self._last_report = 0.0
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def progress_due(self):
+        """距上次进度事件超过 PROGRESS_INTERVAL 或传输已完成时返回 True"""
+        now = time.monotonic()
+        if self.done < self.size and now - self._last_report < PROGRESS_INTERVAL:
+            return False
+        self._last_report = now
+        return True
+
+    def percent(self):
+        return 100 if not self.size else self.done * 100 // self.size
+
+
+class OutgoingTransfer(_Transfer):
+    """发送端的一次分块传输：按接收方的块位图从磁盘读取缺少的块发送
+
+    发送线程调用 compute_digest()、chunks()、wait_have()；
+    acknowledge()、receive_have()、cancel() 由接收线程调用。
+    """
+
+    def __init__(self, transfer_id, path, chat_target="聊天室",
+                 chunk_size=FILE_CHUNK_SIZE, window=FILE_WINDOW):
+        super().__init__(transfer_id, os.path.basename(path),
+                         os.path.getsize(path), chunk_size)
+        self.path = path
+        self.chat_target = chat_target  # 聊天室或私聊对象的用户名
+        self.window = window
+        self.sha256 = None  # 十六进制摘要，由 compute_digest() 计算
+        self.sent = 0  # 已发出的字节数（含重传），与服务器确认的字节数比较
+        self.acked = 0
+        self.error = None  # 被取消时的原因
+        self._have = None  # 服务器转来的合并位图
+        self._condition = threading.Condition()
+
+    def compute_digest(self):
+        try:
+            self.sha256 = file_sha256(self.path)
+        except OSError as e:
+            raise TransferError(f"读取文件失败: {e}")
+        return self.sha256
+
+    def digest(self):
+        return bytes.fromhex(self.sha256)
+
+    def missing_chunks(self, have):
+        return [index for index in range(self.chunk_count)
+                if not bitmap_has(have, index)]
+
+    def is_complete(self, have):
+        return have == full_chunk_bitmap(self.chunk_count)
+
+    def chunks(self, indexes):
+        """依次产生 (偏移, 数据)，未确认的数据超过窗口时阻塞等待
+
+        读文件出错时抛出 TransferError，与发送时的连接错误（OSError）区分开。
+        """
+        self.done = self.size - sum(self.chunk_length(index) for index in indexes)
+        try:
+            f = open(self.path, 'rb')
+        except OSError as e:
+            raise TransferError(f"读取文件失败: {e}")
+        with f:
+            for index in indexes:
+                self._wait_for_window()
+                offset = index * self.chunk_size
+                try:
+                    f.seek(offset)
+                    data = f.read(self.chunk_length(index))
+                except OSError as e:
+                    raise TransferError(f"读取文件失败: {e}")
+                if len(data) != self.chunk_length(index):
+                    raise TransferError("文件在发送过程中被修改")
+                self.sent += len(data)
+                self.done += len(data)
+                yield offset, data
+
+    def wait_have(self, timeout=ACK_TIMEOUT):
+        """等待所有接收方回复已有的块，返回合并后的位图"""
+        with self._condition:
+            deadline = time.monotonic() + timeout
+            while self.error is None and self._have is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.error = "等待接收方回复超时"
+                    break
+                self._condition.wait(remaining)
+            if self.error is not None:
+                raise TransferError(self.error)
+            have, self._have = self._have, None
+            if len(have) != len(empty_chunk_bitmap(self.chunk_count)):
+                have = empty_chunk_bitmap(self.chunk_count)
+            return have
+
+    def receive_have(self, have):
+        with self._condition:
+            self._have = have
+            self._condition.notify_all()
+
+    def acknowledge(self, offset):
+        with self._condition:
+            if offset > self.acked:
+                self.acked = offset
+                self._condition.notify_all()
+
+    def cancel(self, reason):
+        with self._condition:
+            if self.error is None:
+                self.error = reason
+            self._condition.notify_all()
+
+    def _wait_for_window(self):
+        with self._condition:
+            deadline = time.monotonic() + ACK_TIMEOUT
+            while self.error is None and self.sent - self.acked >= self.window:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.error = "等待服务器确认超时"
+                    break
+                acked = self.acked
+                self._condition.wait(remaining)
+                if self.acked != acked:
+                    deadline = time.monotonic() + ACK_TIMEOUT
+            if self.error is not None:
+                raise TransferError(self.error)
+
+
+class IncomingTransfer(_Transfer):
+    """接收端的一次分块传输
+
+    数据块校验 CRC32 后写入 <SHA-256>.part 的对应位置，已收到的块记录在 .part.json 中；
+    连接断开时保留这两个文件，同一文件再次发来时只需要补齐缺少的块。
+    """
+
+    def __init__(self, sender, transfer_id, filename, size, sha256, chunk_size,
+                 directory, is_private=False):
+        super().__init__(transfer_id, os.path.basename(filename), size, chunk_size)
+        self.sender = sender
+        self.sha256 = sha256
+        self.directory = directory
+        self.is_private = is_private
+        self.path = None  # 完成后的保存路径
+        self.part_path = os.path.join(directory, sha256 + PART_SUFFIX)
+        self.meta_path = os.path.join(directory, sha256 + META_SUFFIX)
+        self.crc_errors = 0
+        self.chunks = bytearray(empty_chunk_bitmap(self.chunk_count))
+        self._last_save = time.monotonic()
+
+        if os.path.exists(self.part_path):
+            self._load_meta()
+        self._file = open(self.part_path, 'r+b' if os.path.exists(self.part_path) else 'w+b')
+        self.done = sum(self.chunk_length(index) for index in range(self.chunk_count)
+                        if bitmap_has(self.chunks, index))
+
+    def _load_meta(self):
+        """读取之前的块记录，文件大小或块大小不一致时从头接收"""
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            chunks = bytes.fromhex(meta["chunks"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        if (meta.get("size") == self.size and meta.get("chunk_size") == self.chunk_size
+                and len(chunks) == len(self.chunks)):
+            self.chunks[:] = chunks
+
+    def _save_meta(self):
+        """先把数据刷到磁盘再记录块，记录里的块一定已经写入 .part"""
+        self._file.flush()
+        meta = {"name": self.filename, "size": self.size, "sha256": self.sha256,
+                "chunk_size": self.chunk_size, "chunks": self.chunks.hex()}
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self.meta_path)
+        self._last_save = time.monotonic()
+
+    def have(self):
+        return bytes(self.chunks)
+
+    def write(self, offset, crc, data):
+        """写入一个数据块，CRC 不一致时丢弃并返回 False（稍后由发送方重发）"""
+        index, remainder = divmod(offset, self.chunk_size)
+        if remainder or index >= self.chunk_count or len(data) != self.chunk_length(index):
+            raise TransferError("数据块偏移或长度不正确")
+        if zlib.crc32(data) != crc:
+            self.crc_errors += 1
+            return False
+        if bitmap_has(self.chunks, index):
+            return True  # 重传给其他接收方的块，这里已经有了
+        self._file.seek(offset)
+        self._file.write(data)
+        self.chunks[index >> 3] |= 0x80 >> (index & 7)
+        self.done += len(data)
+        if time.monotonic() - self._last_save >= META_SAVE_INTERVAL:
+            self._save_meta()
+        return True
+
+    def missing_ranges(self):
+        """缺少的连续块合并成 (偏移, 长度)，下载时每段发一个请求"""
+        ranges = []
+        start = None
+        for index in range(self.chunk_count + 1):
+            missing = index < self.chunk_count and not bitmap_has(self.chunks, index)
+            if missing and start is None:
+                start = index
+            elif not missing and start is not None:
+                offset = start * self.chunk_size
+                end = min(index * self.chunk_size, self.size)
+                ranges.append((offset, end - offset))
+                start = None
+        return ranges
+
+    def download(self, host, port, ticket, on_progress=None):
+        """从服务器的下载端口获取缺少的部分（已有的块不再下载），连接出错时抛出 OSError"""
+        with socket.create_connection((host, port), timeout=DOWNLOAD_TIMEOUT) as sock:
+            for offset, length in self.missing_ranges():
+                sock.sendall(DOWNLOAD_REQUEST.pack(ticket, offset, length))
+                status, sent = DOWNLOAD_RESPONSE.unpack(
+                    _recv_exactly(sock, DOWNLOAD_RESPONSE.size))
+                if status == DOWNLOAD_BAD_TICKET:
+                    raise TransferError("文件已不在服务器上")
+                if status != DOWNLOAD_OK or sent != length:
+                    raise TransferError("下载请求被拒绝")
+                end = offset + length
+                while offset < end:
+                    data = _recv_exactly(sock, self.chunk_length(offset // self.chunk_size))
+                    # 数据由 TCP 保证正确，CRC 在本地计算，只为沿用 write() 的块记录
+                    self.write(offset, zlib.crc32(data), data)
+                    offset += len(data)
+                    if on_progress is not None and self.progress_due():
+                        on_progress(self)
+
+    def finish(self, digest, destination=None):
+        """发送方发完后调用：块齐全且 SHA-256 一致时移到 destination 并返回 True
+
+        缺块时返回 False，由发送方补发；SHA-256 不一致时清空块记录并抛出 TransferError。
+        destination 为空时保存到 directory 中，以原文件名加时间戳前缀命名。
+        """
+        if self.have() != full_chunk_bitmap(self.chunk_count):
+            self._save_meta()
+            return False
+        self._file.flush()
+        self._file.seek(0)
+        sha256 = hashlib.sha256()
+        for block in iter(lambda: self._file.read(HASH_BLOCK_SIZE), b''):
+            sha256.update(block)
+        if sha256.digest() != digest or digest.hex() != self.sha256:
+            self.chunks[:] = empty_chunk_bitmap(self.chunk_count)
+            self.done = 0
+            self._save_meta()
+            raise TransferError("SHA-256 校验失败")
+        self._file.truncate(self.size)
+        self._file.close()
+        self.path = destination or received_file_path(self.directory, self.filename)
+        os.replace(self.part_path, self.path)
+        self._remove(self.meta_path)
+        return True
+
+    def suspend(self):
+        """连接断开或发送方中止：保留已收到的数据，等待续传"""
+        if self._file.closed:
+            return
+        try:
+            self._save_meta()
+        finally:
+            self._file.close()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -2,9 +2,9 @@ import tkinter as tk
 from tkinter import scrolledtext, messagebox, simpledialog, filedialog
 import socket
 import threading
-import struct
 import os
-import base64
+import io
+import itertools
 import subprocess
 import platform
 from datetime import datetime
@@ -22,6 +22,58 @@ try:
 except ImportError:
     pygame = None
 
+from protocol import (
+    FrameReader, Frame, encode_frame, encode_hello, unpack_file_body,
+    pack_file_offer, unpack_file_offer, file_offer_thumbnail, pack_file_fetch,
+    unpack_file_ticket, CAP_FILE_DOWNLOAD, CAP_MEDIA_RELAY, unpack_media_relay,
+    CAP_BULK_CHANNEL, CAP_FRAGMENTS, BULK_MESSAGE_TYPES,
+    split_media_frame, MediaAssembler, MessageFormatError, MEDIA_UPLINK_HEADER,
+    MEDIA_DOWNLINK_HEADER, PEER_PROBE, PEER_PROBE_ACK, pack_udp_endpoint,
+    unpack_udp_candidates,
+    pack_file_chunk, unpack_file_chunk,
+    pack_file_complete, unpack_file_complete, pack_file_cancel, unpack_file_cancel,
+    unpack_file_ack, pack_file_have, unpack_file_have, room_id_from_name, room_name_from_id, CAP_BINARY_MEDIA,
+    FLAG_PRIVATE, FLAG_OFFLINE, MSG_WELCOME, MSG_QUIT, MSG_CHAT, MSG_PRIVATE,
+    MSG_SYSTEM, MSG_USERLIST, MSG_REQUEST_USERLIST, MSG_FILE, MSG_FILE_OFFER,
+    MSG_FILE_CHUNK, MSG_FILE_COMPLETE, MSG_FILE_CANCEL, MSG_FILE_ACK,
+    MSG_FILE_HAVE, MSG_FILE_ANNOUNCE, MSG_FILE_FETCH, MSG_FILE_TICKET,
+    MAX_THUMBNAIL_SIZE,
+    MSG_VIDEO_CALL_REQUEST,
+    MSG_VIDEO_CALL_INVITE, MSG_VIDEO_CALL_ACCEPT, MSG_VIDEO_CALL_START,
+    MSG_VIDEO_CALL_REJECT, MSG_VIDEO_CALL_REJECTED, MSG_VIDEO_CALL_END,
+    MSG_VIDEO_CALL_ENDED, MSG_VIDEO_DATA, MSG_UDP_PORT, MSG_MULTI_VIDEO_INVITE,
+    MSG_MULTI_VIDEO_JOIN, MSG_MULTI_VIDEO_LEAVE, MSG_MULTI_VIDEO_DATA,
+    MSG_MULTI_VIDEO_REFRESH, MSG_CAMERA_STATUS, MSG_MULTI_VIDEO_ROSTER, MSG_MEDIA_RELAY,
+    MSG_MULTI_VIDEO_MODE, VIDEO_MODE_FORWARD, VIDEO_MODE_MOSAIC)
+from send_scheduler import SendScheduler, FRAGMENT_SIZE
+from file_transfer import (
+    OutgoingTransfer, IncomingTransfer, TransferError, MAX_RESEND_ROUNDS,
+    received_file_path, cleanup_stale_parts)
+
+# 客户端声明的协议能力
+CLIENT_CAPS = [CAP_BINARY_MEDIA, CAP_FILE_DOWNLOAD, CAP_MEDIA_RELAY, CAP_BULK_CHANNEL,
+               CAP_FRAGMENTS]
+
+# 媒体转发服务器（UDP）：定时发送保活包，超过 MEDIA_TIMEOUT 收不到回复则改回聊天连接发送视频
+MEDIA_KEEPALIVE_INTERVAL = 2.0
+MEDIA_TIMEOUT = 6.0
+
+# 一对一视频的点对点打洞：每隔 PEER_PROBE_INTERVAL 向对方的候选地址发探测包，
+# 超过 PEER_PROBE_TIMEOUT 没有收到确认则继续经服务器中转
+PEER_PROBE_INTERVAL = 0.2
+PEER_PROBE_TIMEOUT = 5.0
+
+# 希望服务器发来的每路视频的最高帧率，与界面的刷新间隔一致
+VIDEO_FPS = 15
+
+# 合成画面模式：服务器把所有人的视频合成一路画面（发送者用户ID为 0），只显示这一路
+MOSAIC_NAME = "会议画面"
+MOSAIC_DISPLAY_SIZE = (480, 360)
+
+# 群发图片时附带的缩略图
+THUMBNAIL_SIZE = (160, 160)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
 
 class ChatClientGUI:
     # ====================【第四步修改：新增方法】====================
@@ -66,10 +118,32 @@ class ChatClientGUI:
 
         # 设置连接变量
         self.client_socket = None
+        self.frame_reader = None  # 接收方向的缓冲分帧读取器
         self.connected = False
         self.current_chat = "聊天室"  # 当前聊天对象，默认为公共聊天室
         self.username = ""  # 初始化用户名
 
+        # 协议 v2：帧头中用用户ID代替用户名，由服务器的用户列表维护映射
+        self.user_id = 0  # 服务器分配的本机用户ID
+        self.server_caps = set()  # 与服务器协商后的能力
+        self.user_ids = {}  # username -> user_id
+        self.user_names = {}  # user_id -> username
+        # 每条连接由一个发送线程按优先级写出（信令 > 聊天 > 文件 > 视频），界面线程、
+        # 文件发送线程和视频线程只把帧放进它的队列
+        self.sender = None
+        # 数据连接：视频和文件数据单独走一条连接，大文件和视频帧不会挡住聊天消息
+        self.bulk_socket = None
+        self.bulk_reader = None
+        self.bulk_sender = None
+
+        # 分块文件传输
+        self.transfer_ids = itertools.count(1)
+        self.outgoing_transfers = {}  # 传输ID -> OutgoingTransfer
+        self.incoming_transfers = {}  # (发送者用户ID, 传输ID) -> IncomingTransfer
+        self.interrupted_transfers = []  # 因断线中断的发送 [(文件路径, 聊天对象)]，重连后续传
+        self.remote_files = {}  # 服务器上可点击下载的群发文件：(发送者用户ID, 传输ID) -> 消息记录
+        self.downloads = {}  # 正在从下载端口获取的文件：(发送者用户ID, 传输ID) -> IncomingTransfer
+
         # 视频帧缓存，用于优化多人视频会议性能
         self.video_frame_buffer = {}
         self.last_frame_time = {}  # 记录每个用户最后更新时间
@@ -89,6 +163,7 @@ class ChatClientGUI:
             os.path.abspath(__file__)), "received_files")
         if not os.path.exists(self.files_dir):
             os.makedirs(self.files_dir)
+        cleanup_stale_parts(self.files_dir)
 
         # 文件路径映射（tag_id -> file_path）
         self.file_path_map = {}
@@ -119,10 +194,12 @@ class ChatClientGUI:
 
         # UDP视频传输相关属性
         self.udp_socket = None
-        self.udp_port = 9999  # 默认UDP端口
-        self.remote_udp_port = 9999  # 远程UDP端口
         self.local_udp_port = None  # 本地UDP端口（随机分配）
         self.video_recv_thread = None
+        # 一对一视频的点对点连接：收到对方对探测包的确认后才直接发给对方
+        self.peer_address = None
+        self.peer_last_ack = 0.0
+        self.peer_frame_seq = 0
 
         # 多人视频会议相关属性
         self.multi_video_active = False  # 是否正在进行多人视频会议
@@ -132,10 +209,17 @@ class ChatClientGUI:
         self.multi_video_window = None  # 多人视频窗口
         self.multi_video_frames = {}  # 存储多个参与者的视频帧
         self.camera_enabled = True  # 摄像头是否启用
+        self.multi_video_mosaic = False  # 房间是否处于服务器合成画面模式
         self.multi_video_layout = []  # 记录视频窗口布局信息
         self.multi_video_udp_sockets = {}  # 存储每个参与者的UDP套接字 {username: socket}
         self.multi_video_recv_threads = {}  # 存储每个参与者的接收线程 {username: thread}
         self.multi_video_send_socket = None  # 用于发送视频数据的UDP套接字
+        # 媒体转发服务器：加入房间后服务器发来 UDP 端口和令牌，视频帧分片后经 UDP 收发
+        self.media_socket = None
+        self.media_address = None
+        self.media_token = None
+        self.media_last_reply = 0.0  # 最近一次收到转发服务器回复的时间
+        self.media_frame_seq = 0
 
         # 用户头像映射（用户名 -> 头像信息）
         self.user_avatars = {}
@@ -520,7 +604,7 @@ class ChatClientGUI:
 
         # 获取服务器地址和端口
         server_ip = simpledialog.askstring(
-            "服务器地址", "请输入服务器IP地址:", initialvalue="192.168.110.107")
+            "服务器地址", "请输入服务器IP地址:", initialvalue="127.0.0.1")
         if not server_ip:
             return
 
@@ -539,11 +623,18 @@ class ChatClientGUI:
             self.client_socket = socket.socket(
                 socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((server_ip, server_port))
+            self.server_ip = server_ip
+            self.server_port = server_port
+            self.frame_reader = FrameReader(self.client_socket)
 
             # 保存用户名
             self.username = username
-            # 发送用户名
-            self.send_message_raw(username)
+            self.user_ids = {}
+            self.user_names = {}
+            # 发送握手（用户名和客户端支持的能力）
+            self.client_socket.sendall(
+                encode_frame(encode_hello(username, CLIENT_CAPS, VIDEO_FPS)))
+            self.sender = SendScheduler(self.client_socket)
 
             self.connected = True   # ★关键：一定要在启动线程前
 
@@ -568,23 +659,38 @@ class ChatClientGUI:
 
         try:
             # 发送退出消息
-            self.send_message_raw("/quit")
+            self.send_frame(MSG_QUIT)
+            self.sender.flush(1.0)
         except:
             pass
         finally:
             self.connected = False
             if self.client_socket:
                 self.client_socket.close()
+            if self.sender:
+                self.sender.close()
+            self.close_bulk_channel()
+            self.abort_file_transfers()
             self.update_status("已断开连接")
             self.add_message_to_history("聊天室", "系统: 已断开与聊天室的连接")
 
-    def send_message_raw(self, message):  # 发送原始消息
-        """发送原始消息到服务器"""
-        data = message.encode()
-        length = struct.pack('!I', len(data))
-        self.client_socket.sendall(length + data)
-        # self 代表类的当前实例（对象）
-        # 它是类中方法的第一个参数，指向调用该方法的具体对象
+    def send_frame(self, msg_type, body=b'', flags=0, room=0, user=0):
+        """把一帧放进发送队列，user 为目标用户ID；视频和文件数据在连上数据连接后走数据连接
+
+        只有文件数据在队列积压时会等待，连接已断开时抛出 OSError。
+        """
+        sender = self.bulk_sender if msg_type in BULK_MESSAGE_TYPES else None
+        if sender is None or sender.closed:
+            sender = self.sender
+        sender.send(msg_type, body, flags, room, user)
+
+    def user_id_of(self, username):
+        """用户名 -> 用户ID（未知用户返回 0，服务器会回复不在线）"""
+        return self.user_ids.get(username, 0)
+
+    def user_name_of(self, user_id):
+        """用户ID -> 用户名"""
+        return self.user_names.get(user_id, f"#{user_id}")
 
     def send_file(self):
         """发送文件功能"""
@@ -601,52 +707,128 @@ class ChatClientGUI:
         if not file_path:
             return
 
+        # 根据当前聊天对象决定发送方式：私聊文件发给目标用户，否则发到聊天室
+        self.start_file_transfer(file_path, self.current_chat)
+
+    def start_file_transfer(self, file_path, chat_target, announce=True):
+        """开始（或断线后继续）发送文件，数据块在后台线程发送，不阻塞界面"""
+        try:
+            # 只读取文件大小，内容由发送线程按块从磁盘读取
+            transfer = OutgoingTransfer(next(self.transfer_ids), file_path, chat_target)
+        except OSError as e:
+            messagebox.showerror("发送文件错误", f"无法读取文件: {str(e)}")
+            return
+
+        # 先登记再发送请求，服务器可能立即回复取消
+        self.outgoing_transfers[transfer.transfer_id] = transfer
+        threading.Thread(target=self.send_file_worker, args=(transfer,),
+                         daemon=True).start()
+        if not announce:
+            self.add_message_to_history(
+                chat_target, f"系统: 继续发送文件 {transfer.filename}")
+            return
+
+        size_text = self.format_file_size(transfer.size)
+        if chat_target != "聊天室":
+            text = f"[私聊给{chat_target}] {self.username}：[文件] {transfer.filename} ({size_text})"
+        else:
+            text = f"{self.username}：[文件] {transfer.filename} ({size_text})"
+        # 在对话中添加发送记录
+        file_info = {
+            "type": "file",
+            "text": text,
+            "file_path": file_path,  # 使用原始文件路径
+            "filename": transfer.filename,
+            "sender": self.username
+        }
+        self.add_message_to_history(chat_target, file_info)
+
+    def send_file_worker(self, transfer):
+        """发送线程：计算 SHA-256 后发送传输请求，按服务器回复的位图只发送缺少的块
+
+        服务器已有该文件时回复全满的位图，不需要上传；否则发完后发送带 SHA-256 的完成消息，
+        服务器校验后再回复位图，仍有缺块（CRC 错误）时补发。
+        """
+        transfer_id = transfer.transfer_id
+        chat_target = transfer.chat_target
         try:
-            # 读取文件
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-
-            # 获取文件名（不包含路径）
-            filename = os.path.basename(file_path)
-            file_size = len(file_data)
-
-            # 将文件数据编码为base64
-            file_data_base64 = base64.b64encode(file_data).decode('utf-8')
-
-            # 构建文件传输消息：/FILE|filename|filesize|base64data
-            file_message = f"/FILE|{filename}|{file_size}|{file_data_base64}"
-
-            # 根据当前聊天对象决定发送方式
-            if self.current_chat != "聊天室":
-                # 私聊文件：格式 @target_user /FILE|filename|filesize|base64data
-                private_file_message = f"@{self.current_chat} {file_message}"
-                self.send_message_raw(private_file_message)
-
-                # 在私聊对话中添加发送记录
-                file_info = {
-                    "type": "file",
-                    "text": f"[私聊给{self.current_chat}] {self.username}：[文件] {filename} ({self.format_file_size(file_size)})",
-                    "file_path": file_path,  # 使用原始文件路径
-                    "filename": filename,
-                    "sender": self.username
-                }
-                self.add_message_to_history(self.current_chat, file_info)
+            transfer.compute_digest()
+            if chat_target != "聊天室":
+                flags, target_id = FLAG_PRIVATE, self.user_id_of(chat_target)
             else:
-                # 群聊文件
-                self.send_message_raw(file_message)
-
-                # 在聊天室中添加发送记录
-                file_info = {
-                    "type": "file",
-                    "text": f"{self.username}：[文件] {filename} ({self.format_file_size(file_size)})",
-                    "file_path": file_path,  # 使用原始文件路径
-                    "filename": filename,
-                    "sender": self.username
-                }
-                self.add_message_to_history("聊天室", file_info)
+                flags, target_id = 0, 0
+            thumbnail = self.make_thumbnail(transfer.path) if not flags else None
+            self.send_frame(MSG_FILE_OFFER, pack_file_offer(
+                transfer_id, transfer.filename, transfer.size, transfer.sha256,
+                transfer.chunk_size, thumbnail), flags=flags, user=target_id)
+
+            # 服务器回复已有的块，续传时只需发送缺少的部分
+            have = transfer.wait_have()
+            rounds = 0
+            while not transfer.is_complete(have):
+                if rounds > MAX_RESEND_ROUNDS:
+                    raise TransferError("多次重发后服务器仍未收全")
+                rounds += 1
+                for offset, data in transfer.chunks(transfer.missing_chunks(have)):
+                    self.send_frame(MSG_FILE_CHUNK,
+                                    pack_file_chunk(transfer_id, offset, data))
+                    if transfer.progress_due():
+                        self.report_transfer_progress("发送", transfer)
+                self.send_frame(MSG_FILE_COMPLETE,
+                                pack_file_complete(transfer_id, transfer.digest()))
+                have = transfer.wait_have()
+            self.master.after(0, self.update_status,
+                              f"文件 {transfer.filename} 发送完成")
+        except OSError:
+            # 连接断开：重新连接后从接收方已有的块继续
+            self.interrupted_transfers.append((transfer.path, chat_target))
+            self.master.after(0, self.add_message_to_history, chat_target,
+                              f"系统: 文件 {transfer.filename} 发送中断，重新连接后将继续发送")
+        except TransferError as e:
+            if transfer_id not in self.outgoing_transfers:
+                # 已被 abort_file_transfers 停止（连接断开）
+                self.interrupted_transfers.append((transfer.path, chat_target))
+                self.master.after(0, self.add_message_to_history, chat_target,
+                                  f"系统: 文件 {transfer.filename} 发送中断，重新连接后将继续发送")
+                return
+            try:
+                self.send_frame(MSG_FILE_CANCEL, pack_file_cancel(transfer_id, str(e)))
+            except OSError:
+                pass
+            self.master.after(0, self.add_message_to_history, chat_target,
+                              f"系统: 文件 {transfer.filename} 发送失败：{e}")
+        finally:
+            self.outgoing_transfers.pop(transfer_id, None)
 
-        except Exception as e:
-            messagebox.showerror("发送文件错误", f"发送文件失败: {str(e)}")
+    def make_thumbnail(self, path):
+        """群发图片时生成 JPEG 缩略图，随文件通知显示给其他用户；不是图片或生成失败时返回 None"""
+        if not path.lower().endswith(IMAGE_EXTENSIONS):
+            return None
+        try:
+            with Image.open(path) as image:
+                image.thumbnail(THUMBNAIL_SIZE)
+                buffer = io.BytesIO()
+                image.convert("RGB").save(buffer, "JPEG", quality=70)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+        thumbnail = buffer.getvalue()
+        return thumbnail if len(thumbnail) <= MAX_THUMBNAIL_SIZE else None
+
+    def resume_file_transfers(self):
+        """重新连接后继续发送中断的文件（私聊对象需要在线）"""
+        pending, self.interrupted_transfers = self.interrupted_transfers, []
+        for file_path, chat_target in pending:
+            if chat_target != "聊天室" and chat_target not in self.user_ids:
+                self.interrupted_transfers.append((file_path, chat_target))
+                continue
+            self.start_file_transfer(file_path, chat_target, announce=False)
+
+    def report_transfer_progress(self, action, transfer):
+        """进度事件：在状态栏显示传输进度（由传输所在线程调用，限制刷新频率）"""
+        text = (f"正在{action}文件 {transfer.filename}：{transfer.percent()}% "
+                f"({self.format_file_size(transfer.done)} / "
+                f"{self.format_file_size(transfer.size)})")
+        self.master.after(0, self.update_status, text)
 
     def format_file_size(self, size):
         """格式化文件大小显示"""
@@ -660,26 +842,14 @@ class ChatClientGUI:
         """接收来自服务器的消息"""
         while self.connected:
             try:
-                # 接收消息长度
-                raw_len = self.recv_all(4)
-                if not raw_len:
+                # 接收一帧（缓冲读取，一次 recv 可能解析出多帧）
+                payload = self.frame_reader.read_frame()
+                if payload is None:
                     self.add_message_to_history("聊天室", "系统: 服务器连接已关闭")
                     break
 
-                msg_len = struct.unpack('!I', raw_len)[0]
-
-                # 接收消息内容
-                message = self.recv_all(msg_len).decode()
-
-                # 检查是否是文件传输消息
-                if "/FILE|" in message:
-                    # 在主线程中处理文件接收
-                    self.master.after(0, self.handle_file_receive, message)
-                    # 注意：对于文件消息，已经在handle_file_receive中通过process_received_message进行了处理
-                    # 所以这里不再单独处理
-                else:
-                    # 解析消息类型并处理（非文件消息）
-                    self.process_received_message(message)
+                # 解析帧头并按消息类型处理
+                self.process_received_frame(Frame.decode(payload))
 
             except Exception as e:
                 if self.connected:
@@ -687,6 +857,55 @@ class ChatClientGUI:
                     self.add_message_to_history("聊天室", f"系统: {error_msg}")
                     self.master.after(0, self.handle_connection_error, str(e))
                 break
+        if self.sender:
+            self.sender.close("连接已断开")
+        self.close_bulk_channel()
+        self.abort_file_transfers()
+
+    def receive_bulk_messages(self, token):
+        """打开数据连接并接收其上的视频和文件数据
+
+        数据连接连不上或断开时视频和文件改回聊天连接发送；服务器在已建立的数据连接断开时
+        也会关闭聊天连接，由聊天连接的接收线程处理断线。
+        """
+        try:
+            bulk_socket = socket.create_connection((self.server_ip, self.server_port))
+            bulk_socket.sendall(encode_frame(encode_hello(self.username, [], bulk_token=token)))
+        except OSError as e:
+            self.add_message_to_history("聊天室", f"系统: 数据连接失败，视频和文件改由聊天连接发送: {e}")
+            return
+        self.bulk_reader = FrameReader(bulk_socket)
+        if not self.connected:
+            bulk_socket.close()
+            return
+        self.bulk_socket = bulk_socket
+        self.bulk_sender = SendScheduler(
+            bulk_socket, FRAGMENT_SIZE if CAP_FRAGMENTS in self.server_caps else None)
+        try:
+            while self.connected:
+                payload = self.bulk_reader.read_frame()
+                if payload is None:
+                    break
+                self.process_received_frame(Frame.decode(payload))
+        except Exception as e:
+            if self.connected and self.bulk_socket is bulk_socket:
+                self.add_message_to_history("聊天室", f"系统: 数据连接出错: {e}")
+        if self.bulk_socket is bulk_socket:
+            self.close_bulk_channel()
+        else:
+            bulk_socket.close()
+
+    def close_bulk_channel(self):
+        bulk_socket, self.bulk_socket = self.bulk_socket, None
+        bulk_sender, self.bulk_sender = self.bulk_sender, None
+        if bulk_sender is not None:
+            bulk_sender.close("数据连接已断开")
+        if bulk_socket is not None:
+            try:
+                bulk_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            bulk_socket.close()
     # ====================【第二步修改：新增方法】====================
 
     def video_processing_worker(self):
@@ -698,20 +917,20 @@ class ChatClientGUI:
         """
         while True:
             try:
-                # 1. 从队列获取数据 (sender是用户名, video_data是base64字符串)
-                sender, video_data = self.video_process_queue.get()
+                # 1. 从队列获取数据 (sender是用户名, img_bytes是JPEG数据)
+                sender, img_bytes = self.video_process_queue.get()
 
                 # --- 下面是耗时操作，全部在后台完成，绝不卡顿主界面 ---
 
-                # A. Base64 解码
-                img_bytes = base64.b64decode(video_data)
+                # A. JPEG 解码
                 nparr = np.frombuffer(img_bytes, np.uint8)
                 frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
                 if frame is not None:
                     # B. Resize (缩放) - 移到这里做！
-                    # 强制缩放到 UI 显示的大小 (240x180)
-                    resized_frame = cv2.resize(frame, (240, 180))
+                    # 强制缩放到 UI 显示的大小 (240x180)，合成画面显示得大一些
+                    size = MOSAIC_DISPLAY_SIZE if sender == MOSAIC_NAME else (240, 180)
+                    resized_frame = cv2.resize(frame, size)
 
                     # C. Color Convert (颜色转换) - 移到这里做！
                     rgb_frame = cv2.cvtColor(resized_frame, cv2.COLOR_BGR2RGB)
@@ -731,344 +950,404 @@ class ChatClientGUI:
                 print(f"后台处理线程出错: {e}")
     # ====================【第二步修改结束】====================
 
-    def handle_file_receive(self, file_message):
-        """处理接收到的文件"""
+    def handle_file_receive(self, sender_name, filename, file_data, is_private):
+        """保存旧版客户端整条发送的文件（file_data 为原始文件内容，在接收线程中写盘）"""
         try:
-            # 由于服务器已修改，不再将文件消息发送回发送者
-            # 因此这里接收到的文件消息一定是别人发送的
-
-            # 服务器广播的格式可能是 "username：/FILE|..." 或直接是 "/FILE|..."
-            # 提取发送者用户名（如果有）
-            sender_name = None
-            file_content = file_message
-
-            # 检查是否是私聊消息格式
-            is_private_msg = file_message.startswith("[私聊")
-            if is_private_msg:
-                # 提取私聊来源用户
-                sender_start = file_message.find("[私聊来自") + 5  # "[私聊来自"的长度
-                if sender_start > 4:
-                    sender_end = file_message.find("]", sender_start)
-                    if sender_end > sender_start:
-                        sender_name = file_message[sender_start:sender_end]
-                        # 移除私聊标签，获取实际内容
-                        content_after_bracket = file_message[sender_end + 1:].strip()
-                        # 检查是否有冒号分隔符
-                        if content_after_bracket.startswith(sender_name + "：") or content_after_bracket.startswith(sender_name + ":"):
-                            # 移除用户名和冒号部分，获取剩余内容
-                            separator_pos = content_after_bracket.find("：")
-                            if separator_pos == -1:  # 没找到中文冒号，尝试英文冒号
-                                separator_pos = content_after_bracket.find(":")
-                            if separator_pos != -1:
-                                file_content = content_after_bracket[separator_pos + 1:].strip(
-                                )
-                        else:
-                            file_content = content_after_bracket
-            elif "：" in file_message or ":" in file_message:
-                # 查找冒号分隔符（中文或英文）
-                separator = "：" if "：" in file_message else ":"
-                parts_msg = file_message.split(separator, 1)
-                if len(parts_msg) == 2:
-                    potential_sender = parts_msg[0].strip()
-                    # 检查是否是文件消息格式，避免将其他格式的消息误处理
-                    if parts_msg[1].strip().startswith("/FILE|"):
-                        sender_name = potential_sender
-                        file_content = parts_msg[1].strip()
-                    else:
-                        # 如果第二部分不是文件格式，可能是其他类型的消息
-                        sender_name = potential_sender
-                        file_content = parts_msg[1].strip()
-                else:
-                    sender_name = None
-                    file_content = file_message
-            # 解析文件消息：/FILE|filename|filesize|base64data
-            # 使用maxsplit=3确保只分割前3个|，避免文件名中包含|导致的解析错误
-            parts = file_content.split("|", 3)
-            if len(parts) != 4:
-                self.add_message_to_history("聊天室", "系统: 文件消息格式错误")
-                return
-
-            command, filename, file_size_str, file_data_base64 = parts
-
-            # 解析文件大小
-            try:
-                file_size = int(file_size_str)
-            except ValueError:
-                self.add_message_to_history("聊天室", "系统: 文件大小格式错误")
-                return
-
-            # 解码base64数据
-            try:
-                file_data = base64.b64decode(file_data_base64)
-            except Exception as e:
-                self.add_message_to_history("聊天室", f"系统: 文件数据解码失败: {str(e)}")
-                return
-
-            # 验证文件大小
-            if len(file_data) != file_size:
-                self.add_message_to_history(
-                    "聊天室", f"系统: 文件大小不匹配 (期望: {file_size}, 实际: {len(file_data)})")
-                return
-
-            # 接收到的文件消息一定是别人发送的，因为服务器不会将文件发回给发送者
-            # 所以我们总是接收文件并保存
-            sender_info = f"{sender_name} 发送了" if sender_name else "收到"
-            file_size_formatted = self.format_file_size(file_size)
-
-            # 自动保存文件到固定目录
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            # 处理文件名，避免冲突
-            name, ext = os.path.splitext(filename)
-            safe_filename = f"{timestamp}_{name}{ext}"
-            save_path = os.path.join(self.files_dir, safe_filename)
-
-            # 保存文件
+            # 服务器不会将文件发回给发送者，这里接收到的文件一定是别人发送的
+            save_path = received_file_path(self.files_dir, filename)
             with open(save_path, 'wb') as f:
                 f.write(file_data)
+        except OSError as e:
+            self.master.after(0, self.show_file_error, f"接收文件时出错: {str(e)}")
+            return
+        self.master.after(0, self.show_received_file, sender_name, filename,
+                          save_path, len(file_data), is_private)
+
+    def show_received_file(self, sender_name, filename, save_path, file_size, is_private):
+        """在对话中显示已保存的接收文件"""
+        # 确定聊天目标（群聊或私聊）
+        chat_target = sender_name if is_private else "聊天室"
+
+        # 接收者：显示记录
+        file_info = {
+            "type": "file",
+            "text": f"{sender_name}：[文件] {filename} ({self.format_file_size(file_size)})",
+            "file_path": save_path,
+            "filename": filename,
+            "sender": sender_name
+        }
+        self.add_message_to_history(chat_target, file_info)
+        self.update_status(f"文件 {filename} 接收完成")
+
+        # 显示文件接收成功提示
+        print(f"文件已保存至: {save_path}")  # 控制台输出，便于调试
+
+    def show_remote_file(self, key, sender_name, filename, file_size, sha256, chunk_size,
+                         thumbnail):
+        """显示群发的文件（此时还没有下载），点击下载按钮时才从服务器获取"""
+        file_info = {
+            "type": "file",
+            "text": f"{sender_name}：[文件] {filename} ({self.format_file_size(file_size)})",
+            "file_path": "",
+            "filename": filename,
+            "sender": sender_name,
+            "remote": key,
+            "size": file_size,
+            "sha256": sha256,
+            "chunk_size": chunk_size,
+            "thumbnail": thumbnail
+        }
+        self.remote_files[key] = file_info
+        self.add_message_to_history("聊天室", file_info)
+
+    def open_file_message(self, file_info):
+        """点击文件消息的按钮：已在本地则打开，群发的文件先从服务器下载"""
+        file_path = file_info.get("file_path")
+        key = file_info.get("remote")
+        if key is None or (file_path and os.path.exists(file_path)):
+            self.download_file(file_path)
+            return
+        if key in self.incoming_transfers or key in self.downloads:
+            self.update_status(f"文件 {file_info['filename']} 正在下载")
+            return
+        if not self.connected:
+            messagebox.showwarning("警告", "未连接到服务器！")
+            return
+        try:
+            self.send_frame(MSG_FILE_FETCH, pack_file_fetch(key[1]), user=key[0])
+        except OSError:
+            messagebox.showerror("下载文件错误", "未连接到服务器")
+            return
+        self.update_status(f"正在下载文件 {file_info['filename']}")
+
+    def handle_file_ticket(self, frame):
+        """服务器同意下载：打开（或继续）<SHA-256>.part，在后台线程从下载端口获取缺少的部分"""
+        transfer_id, port, ticket = unpack_file_ticket(frame.body)
+        key = (frame.user, transfer_id)
+        file_info = self.remote_files.get(key)
+        if file_info is None or key in self.downloads:
+            return
+        if any(transfer.sha256 == file_info["sha256"]
+               for transfer in list(self.incoming_transfers.values())
+               + list(self.downloads.values())):
+            self.master.after(0, self.update_status,
+                              f"正在接收相同的文件 {file_info['filename']}")
+            return
+        try:
+            transfer = IncomingTransfer(file_info["sender"], transfer_id,
+                                        file_info["filename"], file_info["size"],
+                                        file_info["sha256"], file_info["chunk_size"],
+                                        self.files_dir)
+        except OSError as e:
+            self.master.after(0, self.show_file_error,
+                              f"下载文件 {file_info['filename']} 失败：{str(e)}")
+            return
+        self.downloads[key] = transfer
+        host = self.client_socket.getpeername()[0]
+        threading.Thread(target=self.download_worker,
+                         args=(key, transfer, host, port, ticket), daemon=True).start()
 
-            # 确定聊天目标（群聊或私聊）
-            chat_target = "聊天室"
-            if is_private_msg and sender_name and sender_name != self.username:
-                # 这是私聊文件消息
-                chat_target = sender_name
-            elif is_private_msg:
-                # 即使无法提取发送者姓名，只要是私聊格式的消息，就不应加入聊天室
-                # 可能是格式问题，但仍应视为私聊消息
-                # 为了安全起见，尝试从原始消息中提取发送者
-                if '[私聊来自' in file_message:
-                    # 提取私聊来源用户
-                    start_idx = file_message.find('[私聊来自') + 5
-                    end_idx = file_message.find(']', start_idx)
-                    if start_idx > 4 and end_idx > start_idx:
-                        extracted_sender = file_message[start_idx:end_idx]
-                        if extracted_sender and extracted_sender != self.username:
-                            chat_target = extracted_sender
-                        else:
-                            # 如果仍无法提取，可以忽略此消息或显示错误
-                            print(f'无法正确解析私聊文件消息: {file_message}')
-                            return  # 避免将无法解析的消息添加到聊天室
-                else:
-                    # 如果是私聊格式但无法解析，最好忽略
-                    print(f'无法解析的私聊文件消息: {file_message}')
-                    return  # 避免将无法解析的消息添加到聊天室
-            elif sender_name and sender_name != self.username:
-                # 如果是群聊中的文件消息
-                pass
-
-            # 接收者：保存文件并显示记录
-            file_info = {
-                "type": "file",
-                "text": f"{sender_name}：[文件] {filename} ({file_size_formatted})",
-                "file_path": save_path,
-                "filename": filename,
-                "sender": sender_name or "未知"
-            }
-            self.add_message_to_history(chat_target, file_info)
-
-            # 显示文件接收成功提示
-            print(f"文件已保存至: {save_path}")  # 控制台输出，便于调试
-
-        except Exception as e:
-            error_msg = f"接收文件时出错: {str(e)}"
-            self.add_message_to_history("聊天室", f"系统: {error_msg}")
-            messagebox.showerror("接收文件错误", error_msg)
-
-    def process_received_message(self, message):
-        """处理接收到的消息"""
-        # 检查是否是用户列表消息
-        if message.startswith("/USERLIST|"):
-            # 解析用户列表：/USERLIST|user1|user2|user3
-            parts = message.split("|")
-            if len(parts) >= 1:
-                users = [user for user in parts[1:] if user]  # 排除空字符串
-                # 在主线程中更新用户列表
-                self.master.after(0, self.update_users_list, users)
-        # 检查是否是UDP端口信息
-        elif message.startswith("/UDP_PORT|"):
-            # 格式：/UDP_PORT|port_number|ip_address（如果服务器提供IP）
-            # 或者：/UDP_PORT|port_number（需要从消息来源获取IP）
-            try:
-                parts = message.split('|')
-                if len(parts) >= 2:
-                    udp_port = int(parts[1])
-
-                    # 如果服务器也提供了IP地址
-                    if len(parts) >= 3:
-                        self.remote_ip = parts[2]
-                    else:
-                        # 从当前连接获取对方IP（这在P2P情况下可能不准确）
-                        # 实际应用中，服务器应该提供对方的公网IP
-                        # 这里使用一个默认值，实际部署时需要根据网络环境调整
-                        if not hasattr(self, 'remote_ip'):
-                            # 在实际应用中，这需要服务器提供正确的IP信息
-                            print("警告：服务器未提供对方IP，UDP通信可能失败")
-
-                    self.remote_udp_port = udp_port
-                    print(
-                        f"设置远程UDP端口: {self.remote_udp_port}, IP: {getattr(self, 'remote_ip', '未知')}")
-            except ValueError:
-                print(f"UDP端口格式错误: {message}")
-        # 检查是否是视频通话相关消息
-        elif message.startswith("/VIDEO_CALL_INVITE|"):
-            # 视频通话邀请
-            caller = message.split('|')[1]
-            self.master.after(0, self.receive_video_call_request, caller)
-        elif message.startswith("/VIDEO_CALL_START|"):
-            # 视频通话开始
-            caller = message.split('|')[1]
-            self.master.after(0, self.start_video_call, caller, False)
-        elif message.startswith("/VIDEO_CALL_REJECTED|"):
-            # 视频通话被拒绝
-            caller = message.split('|')[1]
+    def download_worker(self, key, transfer, host, port, ticket):
+        """下载线程：连接失败或中断时保留已下载的部分，再次点击从缺少的部分继续"""
+        try:
+            transfer.download(host, port, ticket,
+                              lambda t: self.report_transfer_progress("下载", t))
+            if not transfer.finish(bytes.fromhex(transfer.sha256)):
+                raise TransferError("下载不完整")
+        except (TransferError, OSError) as e:
+            transfer.suspend()
+            self.master.after(0, self.show_file_error,
+                              f"下载文件 {transfer.filename} 失败：{str(e)}")
+            return
+        finally:
+            self.downloads.pop(key, None)
+        self.master.after(0, self.finish_remote_file, key, transfer.path)
+
+    def finish_remote_file(self, key, save_path):
+        """点击下载的文件接收完成：记录保存路径并打开"""
+        file_info = self.remote_files[key]
+        file_info["file_path"] = save_path
+        self.update_status(f"文件 {file_info['filename']} 下载完成")
+        self.download_file(save_path)
+
+    def thumbnail_photo(self, file_info):
+        """群发图片的缩略图（转换结果保存在消息记录中，刷新显示时不再重复解码）"""
+        if "thumbnail_photo" not in file_info:
+            photo = None
+            if file_info.get("thumbnail"):
+                try:
+                    photo = ImageTk.PhotoImage(Image.open(io.BytesIO(file_info["thumbnail"])))
+                except (OSError, ValueError):
+                    pass
+            file_info["thumbnail_photo"] = photo
+        return file_info["thumbnail_photo"]
+
+    def show_file_error(self, error_msg):
+        self.add_message_to_history("聊天室", f"系统: {error_msg}")
+        messagebox.showerror("接收文件错误", error_msg)
+
+    def handle_file_offer(self, frame, sender):
+        """对方开始发送文件：打开（或继续）<SHA-256>.part，并回复已有的块"""
+        transfer_id, filename, size, sha256, chunk_size = unpack_file_offer(frame.body)
+        if any(transfer.sha256 == sha256 for transfer in self.incoming_transfers.values()):
+            self.send_frame(MSG_FILE_CANCEL,
+                            pack_file_cancel(transfer_id, "正在接收相同的文件"),
+                            user=frame.user)
+            return
+        try:
+            transfer = IncomingTransfer(sender, transfer_id, filename, size, sha256,
+                                        chunk_size, self.files_dir,
+                                        bool(frame.flags & FLAG_PRIVATE))
+        except OSError as e:
+            # 帧头用户ID为发送者，表示取消的是对方的传输
+            self.send_frame(MSG_FILE_CANCEL, pack_file_cancel(transfer_id, str(e)),
+                            user=frame.user)
+            self.master.after(0, self.show_file_error, f"接收文件时出错: {str(e)}")
+            return
+        self.incoming_transfers[(frame.user, transfer_id)] = transfer
+        self.send_frame(MSG_FILE_HAVE, pack_file_have(transfer_id, transfer.have()),
+                        user=frame.user)
+        if transfer.done:
+            self.add_message_to_history(
+                "聊天室", f"系统: 继续接收 {sender} 发送的文件 {transfer.filename}"
+                f"（已有 {transfer.percent()}%）")
+        self.report_transfer_progress("接收", transfer)
+
+    def handle_file_chunk(self, frame):
+        transfer_id, offset, crc, data = unpack_file_chunk(frame.body)
+        key = (frame.user, transfer_id)
+        transfer = self.incoming_transfers.get(key)
+        if transfer is None:
+            return  # 已取消的传输在途的数据块
+        try:
+            # CRC 不一致的块不记录，发送方在完成阶段补发
+            transfer.write(offset, crc, data)
+        except (TransferError, OSError) as e:
+            self.stop_incoming_transfer(key, str(e))
+            return
+        if transfer.progress_due():
+            self.report_transfer_progress("接收", transfer)
+
+    def handle_file_complete(self, frame):
+        """发送方发完一轮：块齐全时校验 SHA-256，回复位图（全满表示接收成功）"""
+        transfer_id, digest = unpack_file_complete(frame.body)
+        key = (frame.user, transfer_id)
+        transfer = self.incoming_transfers.get(key)
+        if transfer is None:
+            return
+        try:
+            finished = transfer.finish(digest)
+        except TransferError as e:
+            # 校验失败：块记录已清空，回复空位图让发送方全部重发
+            self.add_message_to_history(
+                "聊天室", f"系统: 文件 {transfer.filename} {e}，正在重新接收")
+            finished = False
+        except OSError as e:
+            self.stop_incoming_transfer(key, str(e))
+            return
+        self.send_frame(MSG_FILE_HAVE, pack_file_have(transfer_id, transfer.have()),
+                        user=frame.user)
+        if finished:
+            del self.incoming_transfers[key]
+            if key in self.remote_files:
+                self.master.after(0, self.finish_remote_file, key, transfer.path)
+                return
+            self.master.after(0, self.show_received_file, transfer.sender,
+                              transfer.filename, transfer.path, transfer.size,
+                              transfer.is_private)
+
+    def stop_incoming_transfer(self, key, reason):
+        """本地出错时停止接收并通知发送方，已收到的数据保留"""
+        transfer = self.incoming_transfers.pop(key)
+        transfer.suspend()
+        self.send_frame(MSG_FILE_CANCEL, pack_file_cancel(key[1], reason), user=key[0])
+        self.master.after(0, self.show_file_error,
+                          f"接收文件 {transfer.filename} 失败：{reason}")
+
+    def handle_file_cancel(self, frame):
+        """帧头用户ID为 0 时是自己发送的传输被取消，否则是对方取消了正在接收的传输"""
+        transfer_id, reason = unpack_file_cancel(frame.body)
+        if frame.user == 0:
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer is not None:
+                transfer.cancel(reason or "已取消")
+            return
+        transfer = self.incoming_transfers.pop((frame.user, transfer_id), None)
+        if transfer is not None:
+            # 保留已收到的数据，对方重新发送同一文件时继续
+            transfer.suspend()
+            self.add_message_to_history(
+                "聊天室", f"系统: {transfer.sender} 发送的文件 {transfer.filename} 已中断"
+                + (f"：{reason}" if reason else ""))
+        elif (frame.user, transfer_id) in self.remote_files:
+            # 点击下载的文件已不在服务器上
+            file_info = self.remote_files[(frame.user, transfer_id)]
+            self.master.after(0, self.show_file_error,
+                              f"下载文件 {file_info['filename']} 失败：{reason}")
+
+    def abort_file_transfers(self):
+        """连接断开：停止所有发送中的传输，保存未接收完的文件以便续传"""
+        outgoing = list(self.outgoing_transfers.values())
+        self.outgoing_transfers.clear()
+        for transfer in outgoing:
+            transfer.cancel("连接已断开")
+        for key in list(self.incoming_transfers):
+            transfer = self.incoming_transfers.pop(key, None)
+            if transfer is not None:
+                transfer.suspend()
+
+    def process_received_frame(self, frame):
+        """处理接收到的帧（下行帧的用户ID为发送者）"""
+        msg_type = frame.msg_type
+        sender = self.user_name_of(frame.user)
+
+        if msg_type == MSG_CHAT:
+            # 普通群聊消息
+            self.add_message_to_history("聊天室", f"{sender}：{frame.text()}")
+        elif msg_type == MSG_PRIVATE:
+            # 私聊消息，添加到该用户的私聊历史
+            self.add_message_to_history(
+                sender, f"[私聊来自{sender}] {sender}：{frame.text()}")
+        elif msg_type == MSG_SYSTEM:
+            message = frame.text()
+            if message.startswith("【系统广播】"):
+                # 系统广播消息，添加到所有聊天（包括私聊）
+                for chat_target in list(self.chat_history):
+                    self.add_message_to_history(chat_target, message)
+            else:
+                # 系统消息（如用户上下线通知）添加到聊天室
+                self.add_message_to_history("聊天室", message)
+        elif msg_type == MSG_USERLIST:
+            # 用户列表：[[用户ID, 用户名], ...]
+            users = json.loads(frame.text())
+            self.user_names = {user_id: name for user_id, name in users}
+            self.user_ids = {name: user_id for user_id, name in users}
+            # 在主线程中更新用户列表
+            self.master.after(0, self.update_users_list,
+                              [name for _, name in users])
+            if self.interrupted_transfers:
+                self.master.after(0, self.resume_file_transfers)
+        elif msg_type == MSG_FILE_CHUNK:
+            # 数据块在接收线程中直接写入文件，不经过界面线程
+            self.handle_file_chunk(frame)
+        elif msg_type == MSG_FILE_ACK:
+            transfer_id, offset = unpack_file_ack(frame.body)
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer is not None:
+                transfer.acknowledge(offset)
+        elif msg_type == MSG_FILE_HAVE:
+            transfer_id, have = unpack_file_have(frame.body)
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer is not None:
+                transfer.receive_have(have)
+        elif msg_type == MSG_FILE_OFFER:
+            self.handle_file_offer(frame, sender)
+        elif msg_type == MSG_FILE_ANNOUNCE:
+            # 群发的文件只有文件信息，点击后再下载
+            transfer_id, filename, size, sha256, chunk_size = unpack_file_offer(frame.body)
+            self.master.after(0, self.show_remote_file, (frame.user, transfer_id),
+                              sender, filename, size, sha256, chunk_size,
+                              file_offer_thumbnail(frame.body))
+        elif msg_type == MSG_FILE_TICKET:
+            self.handle_file_ticket(frame)
+        elif msg_type == MSG_FILE_COMPLETE:
+            self.handle_file_complete(frame)
+        elif msg_type == MSG_FILE_CANCEL:
+            self.handle_file_cancel(frame)
+        elif msg_type == MSG_FILE:
+            # 旧版客户端整条发送的文件
+            filename, file_data = unpack_file_body(frame.body)
+            self.handle_file_receive(sender, filename, file_data,
+                                     bool(frame.flags & FLAG_PRIVATE))
+        elif msg_type == MSG_WELCOME:
+            # 握手完成：记录服务器分配的用户ID和协商后的能力
+            welcome = json.loads(frame.text())
+            self.user_id = frame.user
+            self.server_caps = set(welcome.get("caps", []))
+            if CAP_FRAGMENTS in self.server_caps:
+                self.sender.fragment_size = FRAGMENT_SIZE
+            if welcome.get("bulk_token"):
+                threading.Thread(target=self.receive_bulk_messages,
+                                 args=(welcome["bulk_token"],), daemon=True).start()
+        elif msg_type == MSG_UDP_PORT:
+            # 服务器发来通话对方的候选地址，开始打洞
+            candidates = unpack_udp_candidates(frame.body)
+            if self.video_call_active and frame.user == self.user_id_of(self.video_call_with):
+                threading.Thread(target=self.peer_probe_worker, args=(candidates,),
+                                 daemon=True).start()
+        # 视频通话相关消息
+        elif msg_type == MSG_VIDEO_CALL_INVITE:
+            self.master.after(0, self.receive_video_call_request, sender)
+        elif msg_type == MSG_VIDEO_CALL_START:
+            self.master.after(0, self.start_video_call, sender, False)
+        elif msg_type == MSG_VIDEO_CALL_REJECTED:
             self.master.after(0, lambda: messagebox.showinfo(
-                "视频通话", f"{caller} 拒绝了您的视频通话请求"))
-        elif message.startswith("/VIDEO_CALL_ENDED|"):
-            # 视频通话结束
-            caller = message.split('|')[1]
+                "视频通话", f"{sender} 拒绝了您的视频通话请求"))
+        elif msg_type == MSG_VIDEO_CALL_ENDED:
+            caller = f"{sender} (已离线)" if frame.flags & FLAG_OFFLINE else sender
             self.master.after(0, lambda: messagebox.showinfo(
                 "视频通话", f"{caller} 结束了视频通话"))
             if self.video_call_active:
                 self.master.after(0, self.stop_video_call)
-        elif message.startswith("/VIDEO_DATA|"):
-            # 视频数据
-            try:
-                parts = message.split('|', 2)  # 最多分割为3部分
-                sender = parts[1]
-                video_data = parts[2]
-                # 在主线程中处理视频数据
-                self.master.after(0, self.receive_video_data,
-                                  sender, video_data)
-            except IndexError:
-                print(f"视频数据格式错误: {message}")
-        # 检查是否是多人视频会议相关消息
-        elif message.startswith("/MULTI_VIDEO_INVITE|"):
-            # 多人视频会议邀请
-            parts = message.split('|')
-            if len(parts) >= 3:
-                room_id = parts[1]
-                inviter = parts[2]
-                # 在聊天室中添加会议邀请消息
-                invite_msg = f"{inviter} 发起了一个视频会议，点击进入"
-                # 创建可点击的消息
-                clickable_msg = {
-                    "type": "multi_video_invite",
-                    "text": f"【多人视频会议】{invite_msg}",
-                    "room_id": room_id,
-                    "inviter": inviter
-                }
-                self.add_message_to_history("聊天室", clickable_msg)
-        elif message.startswith("/MULTI_VIDEO_JOIN|"):
-            # 有人加入多人视频会议
-            parts = message.split('|')
-            if len(parts) >= 3:
-                room_id = parts[1]
-                username = parts[2]
-                if self.multi_video_active and self.multi_video_room_id == room_id:
-                    # 添加到参与者列表
-                    self.multi_video_participants[username] = {
-                        'frame': None, 'udp_port': None}
-                    print(f"{username} 加入了多人视频会议")
-        elif message.startswith("/MULTI_VIDEO_LEAVE|"):
-            # 有人离开多人视频会议
-            parts = message.split('|')
-            if len(parts) >= 3:
-                room_id = parts[1]
-                username = parts[2]
-                if self.multi_video_active and self.multi_video_room_id == room_id:
-                    # 从参与者列表中移除
-                    if username in self.multi_video_participants:
-                        del self.multi_video_participants[username]
-                    print(f"{username} 离开了多人视频会议")
-        elif message.startswith("/MULTI_VIDEO_DATA|"):
-            # 多人视频会议数据
-            try:
-                parts = message.split('|', 3)  # 分割为4部分：命令|房间ID|发送者|数据
-                if len(parts) >= 4:
-                    room_id = parts[1]
-                    sender = parts[2]
-                    video_data = parts[3]
-                    # 只处理当前房间的数据
-                    if self.multi_video_active and self.multi_video_room_id == room_id:
-                        # 在后台线程直接解码，不占用主线程CPU
-                        try:
-                            # put_nowait 是关键！如果队列满了(处理不过来)，直接丢弃这一帧
-                            # 这样永远不会导致内存爆炸或延迟累积
-                            self.video_process_queue.put_nowait(
-                                (sender, video_data))
-                        except queue.Full:
-                            pass  # 队列满，丢弃该帧（这是正常的丢帧策略）
-                        # ====================【第三步修改结束】====================
-            except IndexError:
-                print(f"多人视频数据格式错误: {message}")
-        elif message.startswith("/MULTI_VIDEO_REFRESH|"):
-            # 多人视频会议刷新请求
-            # 格式：/MULTI_VIDEO_REFRESH|room_id|username
-            try:
-                parts = message.split('|', 2)
-                room_id = parts[1]
-                username = parts[2]
-
-                # 只处理当前房间的刷新请求
-                if self.multi_video_active and self.multi_video_room_id == room_id:
-                    print(f"{username} 请求刷新视频会议")
-                    # 重新请求用户列表，获取所有会议成员信息
-                    self.master.after(
-                        0, lambda: self.send_message_raw('/REQUEST_USERLIST'))
-            except IndexError:
-                print(f"多人视频刷新格式错误: {message}")
-        elif message.startswith("/CAMERA_STATUS|"):
-            # 摄像头状态更新
-            # 格式：/CAMERA_STATUS|room_id|username|status
+        elif msg_type == MSG_VIDEO_DATA:
+            # 原始JPEG数据，在主线程中处理
+            self.master.after(0, self.receive_video_data,
+                              sender, bytes(frame.body))
+        # 多人视频会议相关消息
+        elif msg_type == MSG_MULTI_VIDEO_INVITE:
+            room_id = room_name_from_id(frame.room)
+            # 在聊天室中添加可点击的会议邀请消息
+            invite_msg = f"{sender} 发起了一个视频会议，点击进入"
+            clickable_msg = {
+                "type": "multi_video_invite",
+                "text": f"【多人视频会议】{invite_msg}",
+                "room_id": room_id,
+                "inviter": sender
+            }
+            self.add_message_to_history("聊天室", clickable_msg)
+        elif not (self.multi_video_active
+                  and self.multi_video_room_id == room_name_from_id(frame.room)):
+            return  # 以下消息只处理当前房间的
+        elif msg_type == MSG_MULTI_VIDEO_ROSTER:
+            # 加入房间时服务器发来的当前成员名单
+            for _, name in json.loads(frame.text()):
+                if name != self.username:
+                    self.multi_video_participants.setdefault(
+                        name, {'frame': None, 'udp_port': None})
+            print(f"多人视频会议当前成员: {len(self.multi_video_participants)} 人")
+        elif msg_type == MSG_MEDIA_RELAY:
+            port, token = unpack_media_relay(frame.body)
+            self.start_media_relay(port, token)
+        elif msg_type == MSG_MULTI_VIDEO_JOIN:
+            # 添加到参与者列表
+            self.multi_video_participants[sender] = {
+                'frame': None, 'udp_port': None}
+            print(f"{sender} 加入了多人视频会议")
+        elif msg_type == MSG_MULTI_VIDEO_LEAVE:
+            # 从参与者列表中移除
+            if sender in self.multi_video_participants:
+                del self.multi_video_participants[sender]
+            print(f"{sender} 离开了多人视频会议")
+        elif msg_type == MSG_MULTI_VIDEO_MODE:
+            self.master.after(0, self.set_mosaic_mode,
+                              frame.text() == VIDEO_MODE_MOSAIC)
+        elif msg_type == MSG_MULTI_VIDEO_DATA:
+            # 在后台线程解码，不占用主线程CPU
             try:
-                parts = message.split('|', 3)
-                room_id = parts[1]
-                username = parts[2]
-                status = parts[3]
-
-                # 只处理当前房间的摄像头状态更新
-                if self.multi_video_active and self.multi_video_room_id == room_id:
-                    # 更新UI中的摄像头状态显示（例如，显示一个图标表示用户摄像头已关闭）
-                    print(f"{username} 摄像头状态更新为: {status}")
-                    # 这里可以添加更新UI的代码，比如在用户旁边显示摄像头状态图标
-                    # 但不添加到聊天室消息历史中
-            except IndexError:
-                print(f"摄像头状态格式错误: {message}")
-        # 检查是否是系统消息（如用户上下线通知）
-        elif message.startswith("【系统】"):
-            # 系统消息添加到聊天室
-            self.add_message_to_history("聊天室", message)
-        elif message.startswith("[私聊"):
-            # 私聊消息
-            # 提取发送者用户名
-            sender_start = message.find("[私聊来自") + 5  # "[私聊来自"的长度
-            if sender_start > 4:  # 确保找到了标记
-                sender_end = message.find("]", sender_start)
-                if sender_end > sender_start:
-                    sender = message[sender_start:sender_end]
-                    # 添加到该用户的私聊历史
-                    self.add_message_to_history(sender, message)
-        elif message.startswith("【系统广播】"):
-            # 系统广播消息，添加到所有聊天（包括私聊）
-            # 添加到聊天室
-            self.add_message_to_history("聊天室", message)
-            # 添加到所有私聊对话
-            for chat_target in self.chat_history:
-                if chat_target != "聊天室":
-                    self.add_message_to_history(chat_target, message)
-        # 修改此行以排除包含UDP_PORT、MULTI_VIDEO_JOIN、MULTI_VIDEO_INVITE和CAMERA_STATUS的消息
-        elif not "/UDP_PORT" in message and not "/MULTI_VIDEO_JOIN" in message and not "/MULTI_VIDEO_INVITE" in message and not "/CAMERA_STATUS" in message:
-            # 普通群聊消息
-            self.add_message_to_history("聊天室", message)
-
-    def recv_all(self, size):
-        """接收指定长度的数据"""
-        data = b''
-        while len(data) < size:
-            packet = self.client_socket.recv(size - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
+                # put_nowait 是关键！如果队列满了(处理不过来)，直接丢弃这一帧
+                # 这样永远不会导致内存爆炸或延迟累积
+                self.video_process_queue.put_nowait(
+                    (sender if frame.user else MOSAIC_NAME, bytes(frame.body)))
+            except queue.Full:
+                pass  # 队列满，丢弃该帧（这是正常的丢帧策略）
+        elif msg_type == MSG_MULTI_VIDEO_REFRESH:
+            print(f"{sender} 请求刷新视频会议")
+            # 重新请求用户列表，获取所有会议成员信息
+            self.master.after(
+                0, lambda: self.send_frame(MSG_REQUEST_USERLIST))
+        elif msg_type == MSG_CAMERA_STATUS:
+            # 不添加到聊天室消息历史中
+            print(f"{sender} 摄像头状态更新为: {frame.text()}")
 
     def append_message(self, message, is_debug=False):
         """在消息显示区域追加消息"""
@@ -1111,7 +1390,7 @@ class ChatClientGUI:
         if self.connected:
             try:
                 # 发送特殊消息请求用户列表
-                self.send_message_raw("/REQUEST_USERLIST")
+                self.send_frame(MSG_REQUEST_USERLIST)
             except Exception as e:
                 messagebox.showerror("错误", f"请求用户列表失败: {str(e)}")
         else:
@@ -1214,7 +1493,6 @@ class ChatClientGUI:
         elif isinstance(msg, dict) and msg.get("type") == "file":
             # 文件消息
             text = msg["text"]
-            file_path = msg.get("file_path", "")
             sender = msg.get("sender", "")
             is_own = (sender.strip() == self.username.strip())
 
@@ -1265,8 +1543,8 @@ class ChatClientGUI:
 
                     download_button = tk.Button(button_frame,
                                                 text=f"下载文件: {filename_part}",
-                                                command=lambda fp=file_path: self.download_file(
-                                                    fp),
+                                                command=lambda info=msg: self.open_file_message(
+                                                    info),
                                                 font=("Microsoft YaHei", 10),
                                                 bg="#FFFFFF",
                                                 fg="#000000",
@@ -1299,6 +1577,12 @@ class ChatClientGUI:
                     self.messages_display.tag_add(
                         "message_received", msg_start, msg_end)
 
+                    # 群发图片的缩略图
+                    thumbnail = self.thumbnail_photo(msg)
+                    if thumbnail is not None:
+                        self.messages_display.insert(tk.END, "\n")
+                        self.messages_display.image_create(tk.END, image=thumbnail)
+
                     # 在下一行添加下载按钮
                     self.messages_display.insert(tk.END, "\n")  # 添加换行
                     button_frame = tk.Frame(
@@ -1307,8 +1591,8 @@ class ChatClientGUI:
 
                     download_button = tk.Button(button_frame,
                                                 text=f"下载文件: {filename_part}",
-                                                command=lambda fp=file_path: self.download_file(
-                                                    fp),
+                                                command=lambda info=msg: self.open_file_message(
+                                                    info),
                                                 font=("Microsoft YaHei", 10),
                                                 bg="#E6E6E6",
                                                 fg="#000000",
@@ -1493,15 +1777,15 @@ class ChatClientGUI:
                     self.add_message_to_history(
                         "聊天室", f"{self.username}：{message}")
 
-                    self.send_message_raw(message)
+                    self.send_frame(MSG_CHAT, message.encode())
                 else:
                     # 发送私聊消息
-                    private_message = f"@{self.current_chat} {message}"
                     # 在本地显示私聊消息
                     self.add_message_to_history(
                         self.current_chat, f"[私聊给{self.current_chat}] {self.username}：{message}")
 
-                    self.send_message_raw(private_message)
+                    self.send_frame(MSG_PRIVATE, message.encode(),
+                                    user=self.user_id_of(self.current_chat))
 
                 self.message_entry.delete(0, tk.END)
 
@@ -1552,9 +1836,9 @@ class ChatClientGUI:
                 "视频通话", f"确定要向 {target_user} 发起视频通话吗？")
             if confirm:
                 # 发送视频通话请求
-                video_call_request = f"/VIDEO_CALL_REQUEST|{target_user}"
                 try:
-                    self.send_message_raw(video_call_request)
+                    self.send_frame(MSG_VIDEO_CALL_REQUEST,
+                                    user=self.user_id_of(target_user))
                     self.add_message_to_history(
                         "聊天室", f"系统: 已向 {target_user} 发起视频通话请求")
                 except Exception as e:
@@ -1581,8 +1865,7 @@ class ChatClientGUI:
         self.multi_video_room_id = room_id
 
         # 发送多人视频会议邀请消息
-        multi_video_invite = f"/MULTI_VIDEO_INVITE|{room_id}|{self.username}"
-        self.send_message_raw(multi_video_invite)
+        self.send_frame(MSG_MULTI_VIDEO_INVITE, room=room_id_from_name(room_id))
 
         # 在聊天室中添加会议发起消息（使用结构化消息格式，标记为发起者）
         invite_msg = f"{self.username} 发起了一个视频会议"
@@ -1655,6 +1938,11 @@ class ChatClientGUI:
                                            bg="#FF6B6B", fg="white", font=("Microsoft YaHei", 10))
         self.camera_toggle_btn.pack(side=tk.LEFT, padx=5)
 
+        # 合成画面开关按钮（由服务器合成一路画面，人多时减少下载和解码）
+        self.mosaic_toggle_btn = tk.Button(control_frame, text="合成画面", command=self.toggle_mosaic,
+                                           bg="#BB8FCE", fg="white", font=("Microsoft YaHei", 10))
+        self.mosaic_toggle_btn.pack(side=tk.LEFT, padx=5)
+
         # 刷新视频按钮
         refresh_btn = tk.Button(control_frame, text="刷新视频", command=self.refresh_multi_video,
                                 bg="#FFD700", fg="black", font=("Microsoft YaHei", 10))
@@ -1682,21 +1970,18 @@ class ChatClientGUI:
         if not cap.isOpened():
             messagebox.showerror("错误", "无法打开摄像头，无法接受视频通话！")
             # 拒绝视频通话
-            reject_msg = f"/VIDEO_CALL_REJECT|{caller}"
-            self.send_message_raw(reject_msg)
+            self.send_frame(MSG_VIDEO_CALL_REJECT, user=self.user_id_of(caller))
             return
         cap.release()
 
         response = messagebox.askyesno("视频通话请求", f"{caller} 邀请您进行视频通话，是否接受？")
         if response:
             # 接受视频通话
-            accept_msg = f"/VIDEO_CALL_ACCEPT|{caller}"
-            self.send_message_raw(accept_msg)
+            self.send_frame(MSG_VIDEO_CALL_ACCEPT, user=self.user_id_of(caller))
             self.start_video_call(caller, is_caller=False)
         else:
             # 拒绝视频通话
-            reject_msg = f"/VIDEO_CALL_REJECT|{caller}"
-            self.send_message_raw(reject_msg)
+            self.send_frame(MSG_VIDEO_CALL_REJECT, user=self.user_id_of(caller))
 
     def update_local_video(self):
         """更新本地视频画面（现在为空函数，因为使用OpenCV窗口）"""
@@ -1712,9 +1997,9 @@ class ChatClientGUI:
         """结束视频通话"""
         if self.video_call_active:
             # 发送结束视频通话消息
-            end_msg = f"/VIDEO_CALL_END|{self.video_call_with}"
             try:
-                self.send_message_raw(end_msg)
+                self.send_frame(MSG_VIDEO_CALL_END,
+                                user=self.user_id_of(self.video_call_with))
             except Exception as e:
                 print(f"发送视频通话结束消息失败: {str(e)}")
 
@@ -1914,8 +2199,8 @@ class ChatClientGUI:
 
         # 重置UDP相关变量
         self.udp_socket = None
-        self.remote_ip = None
-        self.remote_udp_port = None
+        self.peer_address = None
+        self.peer_last_ack = 0.0
 
     def request_join_multi_video_call(self, room_id, inviter):
         """请求加入多人视频通话，弹出询问窗口"""
@@ -1957,8 +2242,7 @@ class ChatClientGUI:
         self.local_video_cap.set(cv2.CAP_PROP_FPS, 15)
 
         # 发送加入消息
-        join_msg = f"/MULTI_VIDEO_JOIN|{room_id}|{self.username}"
-        self.send_message_raw(join_msg)
+        self.send_frame(MSG_MULTI_VIDEO_JOIN, room=room_id_from_name(room_id))
 
         # 启动视频传输
         self.start_multi_video_stream()
@@ -2015,11 +2299,18 @@ class ChatClientGUI:
         self.video_recv_thread.start()
 
     def transmit_video(self):
-        """通过UDP传输视频数据"""
-        # 设置UDP套接字
+        """传输一对一视频：点对点 UDP 可用时直接发给对方，否则经服务器中转（原始JPEG数据）"""
+        # 设置UDP套接字，把端口告诉服务器（只发一次），服务器再把双方的地址发给对方
         self.setup_udp_socket()
+        target_id = self.user_id_of(self.video_call_with)
+        try:
+            self.send_frame(MSG_UDP_PORT, pack_udp_endpoint(
+                self.local_udp_port, self.client_socket.getsockname()[0]), user=target_id)
+        except OSError as e:
+            print(f"发送UDP端口失败: {e}")
 
         last_send_time = time.time()
+        last_keepalive = 0.0
         SEND_INTERVAL = 0.2  # 限制发送间隔为0.2秒（5fps）
 
         while self.video_call_active and self.local_video_cap:
@@ -2029,6 +2320,11 @@ class ChatClientGUI:
                 continue
 
             current_time = time.time()
+            # 点对点连接建立后定时发探测包，对方的确认用来判断连接是否仍然可用
+            if self.peer_address and current_time - last_keepalive >= MEDIA_KEEPALIVE_INTERVAL:
+                self.send_peer_probe(self.peer_address, PEER_PROBE)
+                last_keepalive = current_time
+
             # 控制发送频率
             if current_time - last_send_time < SEND_INTERVAL:
                 time.sleep(0.033)  # 30fps的延迟
@@ -2038,41 +2334,63 @@ class ChatClientGUI:
             encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 40]  # 进一步降低质量以减少带宽
             result, encoded_image = cv2.imencode('.jpg', frame, encode_param)
             if result:
-                # 转换为base64编码并发送
-                image_data = base64.b64encode(
-                    encoded_image.tobytes()).decode('utf-8')
-
-                # 通过UDP发送视频数据
+                jpeg_data = encoded_image.tobytes()
                 try:
-                    # 发送本地UDP端口给服务器，以便它能转发给对方
-                    port_msg = f"/UDP_PORT|{self.local_udp_port}"
-                    self.send_message_raw(port_msg)
-
-                    # 通过UDP发送视频数据
-                    video_packet = f"{self.username}:{image_data}".encode(
-                        'utf-8')
-                    # 需要知道对方的IP地址和UDP端口
-                    # 通常在建立连接时服务器会提供对方的网络信息
-                    if hasattr(self, 'remote_ip') and hasattr(self, 'remote_udp_port') and self.remote_ip and self.remote_udp_port:
-                        self.udp_socket.sendto(
-                            video_packet, (self.remote_ip, self.remote_udp_port))
-                    else:
-                        # 如果没有对方的IP信息，回退到TCP发送（保持兼容性）
-                        video_data = f"/VIDEO_DATA|{self.video_call_with}|{image_data}"
-                        self.send_message_raw(video_data)
+                    if not self.send_peer_frame(jpeg_data):
+                        self.send_frame(MSG_VIDEO_DATA, jpeg_data, user=target_id)
                 except Exception as e:
-                    print(f"发送UDP视频数据失败: {e}, 尝试使用TCP")
-                    # 如果UDP失败，回退到TCP发送
-                    try:
-                        video_data = f"/VIDEO_DATA|{self.video_call_with}|{image_data}"
-                        self.send_message_raw(video_data)
-                    except Exception as tcp_e:
-                        print(f"TCP视频数据发送也失败: {tcp_e}")
-                        break
+                    print(f"视频数据发送失败: {e}")
+                    break
 
             last_send_time = current_time
             time.sleep(0.033)  # 30fps的延迟
 
+    def send_peer_probe(self, address, kind):
+        """发送点对点探测包（kind 为 PEER_PROBE）或确认（PEER_PROBE_ACK）"""
+        sock = self.udp_socket
+        if sock is None:
+            return
+        try:
+            sock.sendto(MEDIA_DOWNLINK_HEADER.pack(0, self.user_id, 0, kind, 0), address)
+        except OSError:
+            pass
+
+    def peer_probe_worker(self, candidates):
+        """向对方的每个候选地址发送探测包，直到收到确认或超时"""
+        self.peer_address = None
+        deadline = time.time() + PEER_PROBE_TIMEOUT
+        while self.video_call_active and self.peer_address is None and time.time() < deadline:
+            for address in candidates:
+                self.send_peer_probe(address, PEER_PROBE)
+            time.sleep(PEER_PROBE_INTERVAL)
+        if self.video_call_active and self.peer_address is None:
+            self.add_message_to_history("聊天室", "系统: 无法与对方建立点对点连接，视频经服务器中转")
+        elif self.peer_address is not None:
+            print(f"点对点视频连接: {self.peer_address[0]}:{self.peer_address[1]}")
+
+    def peer_ready(self):
+        return (self.peer_address is not None
+                and time.time() - self.peer_last_ack < MEDIA_TIMEOUT)
+
+    def send_peer_frame(self, jpeg_data):
+        """把一帧视频分片后经 UDP 直接发给通话对方，点对点不可用时返回 False（改由服务器中转）"""
+        sock, address = self.udp_socket, self.peer_address
+        if sock is None or not self.peer_ready():
+            return False
+        try:
+            fragments = split_media_frame(jpeg_data)
+        except MessageFormatError:
+            return False
+        self.peer_frame_seq = (self.peer_frame_seq + 1) & 0xFFFFFFFF
+        try:
+            for index, fragment in enumerate(fragments):
+                sock.sendto(MEDIA_DOWNLINK_HEADER.pack(
+                    0, self.user_id, self.peer_frame_seq, index, len(fragments)) + fragment,
+                    address)
+        except OSError:
+            return False
+        return True
+
     def transmit_multi_video(self):
         """传输多人视频数据，优化帧率和带宽使用"""
         # 设置UDP套接字
@@ -2112,22 +2430,12 @@ class ChatClientGUI:
                 result, encoded_image = cv2.imencode(
                     '.jpg', frame, encode_param)
                 if result:
-                    # 转换为base64编码并发送
-                    image_data = base64.b64encode(
-                        encoded_image.tobytes()).decode('utf-8')
-
-                    # 通过TCP发送多人视频数据
-                    video_data = f"/MULTI_VIDEO_DATA|{self.multi_video_room_id}|{self.username}|{image_data}"
+                    # 媒体转发服务器可用时经 UDP 发送，否则通过TCP发送（原始JPEG数据）
                     try:
-                        # 尝试通过UDP发送（如果服务器支持）
-                        # UDP格式: username:image_data
-                        udp_packet = f"{self.username}:{image_data}".encode(
-                            'utf-8')
-                        # 这里需要知道服务器的UDP地址和端口，暂时使用TCP
-                        # self.udp_socket.sendto(udp_packet, (server_addr, server_udp_port))
-
-                        # 目前还是使用TCP发送以确保可靠性
-                        self.send_message_raw(video_data)
+                        if not self.send_media_frame(encoded_image.tobytes()):
+                            self.send_frame(
+                                MSG_MULTI_VIDEO_DATA, encoded_image.tobytes(),
+                                room=room_id_from_name(self.multi_video_room_id))
                     except Exception as e:
                         print(f"发送多人视频数据失败: {e}")
                         break
@@ -2138,127 +2446,126 @@ class ChatClientGUI:
             last_send_time = current_time
             time.sleep(0.067)  # 15fps的延迟，与UI更新同步
 
+    def start_media_relay(self, port, token):
+        """收到媒体转发服务器的端口和令牌，开始发送保活包，确认可用后改用 UDP 收发视频"""
+        self.media_address = (self.server_ip, port)
+        self.media_token = token
+        self.media_last_reply = 0.0
+        if self.media_socket is None:
+            self.media_socket = udp_socket_module.socket(
+                udp_socket_module.AF_INET, udp_socket_module.SOCK_DGRAM)
+            self.media_socket.bind(('', 0))
+            self.media_socket.settimeout(0.5)
+            threading.Thread(target=self.media_relay_worker,
+                             args=(self.media_socket,), daemon=True).start()
+        print(f"媒体转发服务器: {self.media_address[0]}:{port}")
+
+    def stop_media_relay(self):
+        sock, self.media_socket = self.media_socket, None
+        self.media_address = self.media_token = None
+        if sock:
+            sock.close()
+
+    def media_relay_ready(self):
+        return (self.media_socket is not None
+                and time.time() - self.media_last_reply < MEDIA_TIMEOUT)
+
+    def send_media_frame(self, jpeg_data):
+        """把一帧视频分片后经 UDP 发给媒体转发服务器，不可用时返回 False（改用聊天连接）"""
+        sock, address, token = self.media_socket, self.media_address, self.media_token
+        if not self.media_relay_ready() or address is None:
+            return False
+        try:
+            fragments = split_media_frame(jpeg_data)
+        except MessageFormatError:
+            return False
+        self.media_frame_seq = (self.media_frame_seq + 1) & 0xFFFFFFFF
+        try:
+            for index, fragment in enumerate(fragments):
+                sock.sendto(MEDIA_UPLINK_HEADER.pack(
+                    token, self.media_frame_seq, index, len(fragments)) + fragment, address)
+        except OSError:
+            return False
+        return True
+
+    def media_relay_worker(self, sock):
+        """发送保活包并接收转发来的视频分片，重组成整帧后交给解码线程"""
+        assembler = MediaAssembler()
+        last_keepalive = 0.0
+        while self.media_socket is sock:
+            now = time.time()
+            if now - last_keepalive >= MEDIA_KEEPALIVE_INTERVAL and self.media_address:
+                try:
+                    sock.sendto(MEDIA_UPLINK_HEADER.pack(self.media_token, 0, 0, 0),
+                                self.media_address)
+                except OSError:
+                    pass
+                last_keepalive = now
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # 套接字已关闭
+            if len(data) < MEDIA_DOWNLINK_HEADER.size:
+                continue
+            room, user_id, frame_seq, index, count = MEDIA_DOWNLINK_HEADER.unpack_from(data)
+            self.media_last_reply = time.time()
+            if count == 0:
+                continue  # 保活回复
+            jpeg_data = assembler.add(user_id, frame_seq, index, count,
+                                      memoryview(data)[MEDIA_DOWNLINK_HEADER.size:])
+            if jpeg_data is not None:
+                try:
+                    self.video_process_queue.put_nowait(
+                        (self.user_name_of(user_id) if user_id else MOSAIC_NAME, jpeg_data))
+                except queue.Full:
+                    pass  # 队列满，丢弃该帧
+
     def receive_video_via_udp(self):
-        """通过UDP接收视频数据"""
+        """接收一对一通话对方经点对点 UDP 发来的探测包和视频分片"""
+        sock = self.udp_socket
+        assembler = MediaAssembler()
         try:
-            while self.video_call_active or self.multi_video_active:
+            while (self.video_call_active or self.multi_video_active) and self.udp_socket is sock:
                 try:
                     # 设置短超时以允许定期检查video_call_active状态
-                    if self.udp_socket:  # 加一个空值检查
-                        self.udp_socket.settimeout(0.5)
-                        data, addr = self.udp_socket.recvfrom(
-                            65536)  # 接收最大64KB数据
-
-                        # ... (中间原本的解码逻辑保持不变) ...
-                        # 原有的解码逻辑如下：
-                        decoded_data = data.decode('utf-8')
-                        parts = decoded_data.split(':', 1)
-                        if len(parts) == 2:
-                            sender = parts[0]
-                            image_data = parts[1]
-
-                            # 解码base64图像数据
-                            img_bytes = base64.b64decode(image_data)
-                            nparr = np.frombuffer(img_bytes, np.uint8)
-                            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-                            if frame is not None:
-                                if self.video_call_active:
-                                    # 更新远程视频帧（一对一视频通话）
-                                    self.remote_video_frame = frame
-
-                                    # 如果启用了OpenCV窗口，则更新远程视频帧
-                                    # 远程视频会在display_combined_video函数中显示在组合窗口中
-                                    pass
-                                elif self.multi_video_active:
-                                    # 更新多人视频会议中的参与者视频帧
-                                    self.update_participant_video(
-                                        sender, frame)
-                    if data:
-                        try:
-                            # 解析数据格式: sender:image_data
-                            decoded_data = data.decode('utf-8')
-                            parts = decoded_data.split(':', 1)
-                            if len(parts) == 2:
-                                sender = parts[0]
-                                image_data = parts[1]
-
-                                # 解码base64图像数据
-                                img_bytes = base64.b64decode(image_data)
-                                nparr = np.frombuffer(img_bytes, np.uint8)
-                                frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-                                if frame is not None:
-                                    if self.video_call_active:
-                                        # 更新远程视频帧（一对一视频通话）
-                                        self.remote_video_frame = frame
-
-                                        # 如果启用了OpenCV窗口，则更新远程视频帧
-                                        # 远程视频会在display_combined_video函数中显示在组合窗口中
-                                        pass
-                                    elif self.multi_video_active:
-                                        # 更新多人视频会议中的参与者视频帧
-                                        self.update_participant_video(
-                                            sender, frame)
-                        except Exception as e:
-                            print(f"UDP视频数据解析错误: {e}")
-                            # 尝试解析TCP格式的多人视频数据
-                            try:
-                                # TCP格式: /MULTI_VIDEO_DATA|room_id|sender|image_data
-                                if decoded_data.startswith('/MULTI_VIDEO_DATA|'):
-                                    parts = decoded_data.split('|', 3)
-                                    if len(parts) >= 4:
-                                        room_id = parts[1]
-                                        sender = parts[2]
-                                        image_data = parts[3]
-
-                                        # 检查是否是当前房间的数据
-                                        if self.multi_video_active and self.multi_video_room_id == room_id:
-                                            # 解码base64图像数据
-                                            img_bytes = base64.b64decode(
-                                                image_data)
-                                            nparr = np.frombuffer(
-                                                img_bytes, np.uint8)
-                                            frame = cv2.imdecode(
-                                                nparr, cv2.IMREAD_COLOR)
-
-                                            if frame is not None:
-                                                # 更新多人视频会议中的参与者视频帧
-                                                self.update_participant_video(
-                                                    sender, frame)
-                            except Exception as tcp_parse_error:
-                                print(f"解析TCP格式多人视频数据错误: {tcp_parse_error}")
+                    sock.settimeout(0.5)
+                    data, addr = sock.recvfrom(65536)
                 except socket.timeout:
-                    # 超时是正常的，继续循环检查video_call_active
                     continue
-                # ====================【修改开始】====================
-                except OSError as e:
-                    # WinError 10038 是 socket 被关闭的正常现象，不是 bug
-                    if e.winerror == 10038 or e.errno == 10038:
-                        # Socket 被主线程关闭了，安静退出即可
-                        break
-                    else:
-                        print(f"接收UDP视频数据错误: {e}")
-                        break
-                # ====================【修改结束】====================
-                except Exception as e:
-                    if not (self.video_call_active or self.multi_video_active):  # 如果视频通话已停止，则退出循环
-                        break
-                    print(f"接收UDP视频数据错误: {e}")
-        except Exception as e:
-            print(f"接收UDP视频时出错: {e}")
+                except OSError:
+                    break  # 套接字已被主线程关闭
+                if len(data) < MEDIA_DOWNLINK_HEADER.size or not self.video_call_active:
+                    continue
+                room, user_id, frame_seq, index, count = MEDIA_DOWNLINK_HEADER.unpack_from(data)
+                if user_id != self.user_id_of(self.video_call_with):
+                    continue  # 不是通话对方发来的
+                if count == 0:
+                    if index == PEER_PROBE:
+                        self.send_peer_probe(addr, PEER_PROBE_ACK)
+                    elif index == PEER_PROBE_ACK:
+                        # 对方收到了我们的探测包：这个地址两个方向都通
+                        self.peer_address = addr
+                        self.peer_last_ack = time.time()
+                    continue
+                jpeg_data = assembler.add(user_id, frame_seq, index, count,
+                                          memoryview(data)[MEDIA_DOWNLINK_HEADER.size:])
+                if jpeg_data is None:
+                    continue
+                frame = cv2.imdecode(np.frombuffer(jpeg_data, np.uint8), cv2.IMREAD_COLOR)
+                if frame is not None:
+                    # 更新远程视频帧，在display_combined_video函数中显示在组合窗口中
+                    self.remote_video_frame = frame
         finally:
             # 设置停止事件
             self.remote_display_stopped.set()
-            # 不在这里调用destroyAllWindows，避免多线程冲突
-            pass
 
-    def receive_video_data(self, sender, image_data):
+    def receive_video_data(self, sender, img_bytes):
         """接收并显示远程视频数据（保留TCP方式以备兼容性）"""
         if self.video_call_active:
             try:
-                # 解码base64图像数据
-                img_bytes = base64.b64decode(image_data)
+                # 解码JPEG图像数据
                 nparr = np.frombuffer(img_bytes, np.uint8)
                 frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
@@ -2273,12 +2580,11 @@ class ChatClientGUI:
             except Exception as e:
                 print(f"视频解码错误: {e}")
 
-    def receive_multi_video_data(self, sender, image_data):
+    def receive_multi_video_data(self, sender, img_bytes):
         """接收多人视频会议数据"""
         if self.multi_video_active:
             try:
-                # 解码base64图像数据
-                img_bytes = base64.b64decode(image_data)
+                # 解码JPEG图像数据
                 nparr = np.frombuffer(img_bytes, np.uint8)
                 frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
@@ -2298,10 +2604,9 @@ class ChatClientGUI:
             except Exception as e:
                 print(f"多人视频解码错误: {e}")
 
-    def decode_and_update_video(self, sender, video_data):
+    def decode_and_update_video(self, sender, img_bytes):
         """在后台线程解码视频数据并通知主线程更新UI"""
         try:
-            img_bytes = base64.b64decode(video_data)
             nparr = np.frombuffer(img_bytes, np.uint8)
             frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
@@ -2338,8 +2643,27 @@ class ChatClientGUI:
 
         # 发送摄像头状态更新
         status = "enabled" if self.camera_enabled else "disabled"
-        camera_status_msg = f"/CAMERA_STATUS|{self.multi_video_room_id}|{self.username}|{status}"
-        self.send_message_raw(camera_status_msg)
+        self.send_frame(MSG_CAMERA_STATUS, status.encode(),
+                        room=room_id_from_name(self.multi_video_room_id))
+
+    def toggle_mosaic(self):
+        """请求服务器切换房间的视频模式，切换结果以服务器的通知为准"""
+        mode = VIDEO_MODE_FORWARD if self.multi_video_mosaic else VIDEO_MODE_MOSAIC
+        self.send_frame(MSG_MULTI_VIDEO_MODE, mode.encode(),
+                        room=room_id_from_name(self.multi_video_room_id))
+
+    def set_mosaic_mode(self, enabled):
+        """服务器通知房间的视频模式：合成画面模式下只显示服务器合成的一路画面"""
+        self.multi_video_mosaic = enabled
+        if enabled:
+            self.multi_video_participants.setdefault(
+                MOSAIC_NAME, {'frame': None, 'udp_port': None})
+        else:
+            self.multi_video_participants.pop(MOSAIC_NAME, None)
+        if self.multi_video_window and self.multi_video_window.winfo_exists():
+            self.mosaic_toggle_btn.config(text="逐路显示" if enabled else "合成画面")
+            self.update_video_layout()
+        print(f"多人视频会议切换为{'合成画面' if enabled else '逐路转发'}模式")
 
     def refresh_multi_video(self):
         """刷新多人视频会议中的视频显示，清空现有视频帧并重启传输，同时重新请求参与者列表"""
@@ -2365,11 +2689,11 @@ class ChatClientGUI:
                 self.video_thread.join(timeout=2)
 
             # 请求最新用户列表，获取所有会议成员信息
-            self.send_message_raw('/REQUEST_USERLIST')
+            self.send_frame(MSG_REQUEST_USERLIST)
 
             # 发送一个特殊的刷新请求给房间内其他成员
-            refresh_msg = f"/MULTI_VIDEO_REFRESH|{self.multi_video_room_id}|{self.username}"
-            self.send_message_raw(refresh_msg)
+            self.send_frame(MSG_MULTI_VIDEO_REFRESH,
+                            room=room_id_from_name(self.multi_video_room_id))
 
             # 重新启动视频传输
             self.video_thread = threading.Thread(
@@ -2388,8 +2712,8 @@ class ChatClientGUI:
         """离开多人视频会议"""
         if self.multi_video_active:
             # 发送离开消息
-            leave_msg = f"/MULTI_VIDEO_LEAVE|{self.multi_video_room_id}|{self.username}"
-            self.send_message_raw(leave_msg)
+            self.send_frame(MSG_MULTI_VIDEO_LEAVE,
+                            room=room_id_from_name(self.multi_video_room_id))
 
             # 设置停止标志，让传输线程可以安全退出
             if hasattr(self, '_stopping_transmission'):
@@ -2412,6 +2736,8 @@ class ChatClientGUI:
             if self.udp_socket:
                 self.udp_socket.close()
 
+            self.stop_media_relay()
+
             # 关闭多方视频专用的UDP套接字
             if self.multi_video_send_socket:
                 self.multi_video_send_socket.close()
@@ -2438,6 +2764,7 @@ class ChatClientGUI:
             # 重置变量
             self.multi_video_room_id = None
             self.multi_video_participants.clear()
+            self.multi_video_mosaic = False
             self.multi_video_layout.clear()
 
             # 清理视频帧缓冲
@@ -2584,9 +2911,13 @@ class ChatClientGUI:
         for widget in self.others_video_frame.winfo_children():
             widget.destroy()
 
-        # 获取其他参与者列表
-        other_participants = [
-            u for u in self.multi_video_participants if u != self.username]
+        # 获取其他参与者列表，合成画面模式下只显示合成的一路
+        if self.multi_video_mosaic:
+            other_participants = [MOSAIC_NAME]
+        else:
+            other_participants = [
+                u for u in self.multi_video_participants
+                if u != self.username and u != MOSAIC_NAME]
 
         if not other_participants:
             # 如果没有其他参与者，显示提示信息
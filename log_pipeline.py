@@ -0,0 +1,136 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024  # 日志文件超过该大小时轮转
+DEFAULT_BACKUPS = 5  # 保留的旧日志文件数：server.log.1 ... server.log.5
+FLUSH_INTERVAL = 0.2  # 后台线程成批写出的间隔（秒）
+MAX_PENDING = 100000  # 等待写出的日志条数上限，超过时丢弃最早的并记录丢弃数
+
+_MILLIS = [f".{ms:03d} " for ms in range(1000)]
+
+
+class LogPipeline:
+    """成批写出的服务器日志
+
+    emit() 只把 (时间, 内容) 追加到 deque（线程安全，不加锁），可以在事件循环或任何线程中调用；
+    后台线程每隔 FLUSH_INTERVAL 秒取出积累的日志，格式化后一次写入日志文件（带时间，按大小轮转）
+    和 / 或控制台。日志来得太快时只保留最新的 MAX_PENDING 条，并在日志中记下丢弃了多少条。
+    """
+
+    def __init__(self, path=None, stream=None, max_bytes=DEFAULT_MAX_BYTES,
+                 backup_count=DEFAULT_BACKUPS, flush_interval=FLUSH_INTERVAL,
+                 max_pending=MAX_PENDING):
+        self.path = path  # 日志文件，为 None 时不写文件
+        self.stream = stream  # 控制台（如 sys.stdout），为 None 时不输出
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.events = collections.deque(maxlen=max_pending)
+        self.dropped = 0
+        self.file = None
+        self.size = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._second = (None, "")  # 缓存的时间前缀 (整秒, "YYYY-mm-dd HH:MM:SS")
+        if path is not None:
+            self.open()
+
+    def emit(self, message):
+        """记录一条日志（可以直接作为 on_log 回调）"""
+        events = self.events
+        if len(events) == events.maxlen:
+            self.dropped += 1
+        events.append((time.time(), message))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """写出剩余的日志并关闭文件"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        events = self.events
+        batch = []
+        try:
+            while True:
+                batch.append(events.popleft())
+        except IndexError:
+            pass
+        dropped, self.dropped = self.dropped, 0
+        if not batch and not dropped:
+            return
+        messages = [message for _, message in batch]
+        if dropped:
+            messages.insert(0, f"（日志过多，丢弃了 {dropped} 条）")
+        if self.stream is not None:
+            try:
+                self.stream.write("\n".join(messages) + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                self.stream = None  # 控制台已关闭
+        if self.file is not None:
+            if dropped:
+                batch.insert(0, (batch[0][0] if batch else time.time(), messages[0]))
+            # 同一秒内的日志共用格式化好的日期时间，毫秒查表
+            lines = []
+            second, prefix = self._second
+            for t, message in batch:
+                whole = int(t)
+                if whole != second:
+                    second = whole
+                    prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(whole))
+                lines.append(f"{prefix}{_MILLIS[int(t * 1000) % 1000]}{message}\n")
+            self._second = (second, prefix)
+            self.write("".join(lines).encode("utf-8"))
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+
+    def write(self, data):
+        try:
+            if self.size and self.size + len(data) > self.max_bytes:
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+        except OSError as e:
+            print(f"无法写入日志文件 {self.path}: {e}", file=sys.stderr)
+            if self.file.closed:  # 轮转失败
+                try:
+                    self.open()
+                except OSError:
+                    self.file = None
+
+    def rotate(self):
+        """server.log -> server.log.1 -> ... -> server.log.N，最旧的删除"""
+        self.file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
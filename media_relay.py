@@ -0,0 +1,457 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import mosaic
+from log_pipeline import LogPipeline
+from protocol import (Frame, MessageFormatError, MediaAssembler, read_control_frame,
+                      split_media_frame, MEDIA_UPLINK_HEADER, MEDIA_DOWNLINK_HEADER,
+                      VIDEO_MODE_MOSAIC)
+
+# 控制连接（聊天服务器 <-> 媒体转发服务器，只监听本机地址）上的消息，使用 v2 帧格式，
+# 帧头中的房间ID和用户ID即房间和成员
+CTRL_HELLO = 1  # 转发 -> 聊天：连接建立后发送，消息体为 JSON {"port": UDP 端口, "mosaic": 是否支持合成画面}
+CTRL_JOIN = 2  # 聊天 -> 转发：成员加入房间，消息体为令牌（为空表示该成员只用聊天连接收发视频）
+CTRL_LEAVE = 3  # 聊天 -> 转发：成员离开房间
+CTRL_ATTACH = 4  # 转发 -> 聊天：成员的 UDP 地址已确认，之后视频经 UDP 发给他
+CTRL_DETACH = 5  # 转发 -> 聊天：成员的保活超时，之后视频改由聊天连接发给他
+CTRL_FRAME = 6  # 转发 -> 聊天：成员经 UDP 发来的完整一帧（用户ID为 0 时是合成画面），由聊天服务器
+               # 转给只用聊天连接的成员；聊天 -> 转发：合成画面模式的房间中成员经聊天连接发来的一帧
+CTRL_MODE = 7  # 聊天 -> 转发：房间的视频模式，消息体为 VIDEO_MODE_*
+
+DEFAULT_CONTROL_PORT = 8891
+MEMBER_TIMEOUT = 10  # 超过该时间没有收到某成员的 UDP 包，认为地址失效（秒）
+SWEEP_INTERVAL = 2
+RECONNECT_INTERVAL = 2  # 控制连接断开后的重连间隔（秒）
+# 发送缓冲超过该值时丢弃视频包（UDP 和上交给聊天服务器的整帧都可以丢）
+UDP_HIGH_WATER = 1024 * 1024
+CONTROL_HIGH_WATER = 1024 * 1024
+
+
+class RelayMember:
+    __slots__ = ('room', 'user_id', 'token', 'address', 'last_seen')
+
+    def __init__(self, room, user_id, token):
+        self.room = room
+        self.user_id = user_id
+        self.token = token  # 为空表示该成员只用聊天连接
+        self.address = None  # 最近一个 UDP 包的来源地址
+        self.last_seen = 0.0
+
+
+class _RelayProtocol(asyncio.DatagramProtocol):
+    def __init__(self, relay):
+        self.relay = relay
+
+    def datagram_received(self, data, address):
+        self.relay.datagram_received(data, address)
+
+    def error_received(self, exc):
+        pass  # 对方端口不可达等错误由保活超时处理
+
+
+class MediaRelay:
+    """UDP 媒体转发服务器（SFU）
+
+    作为独立进程运行，只收包、按房间查表、转发，不解码视频，视频负载不占用聊天服务器的 CPU，
+    也不会在聊天连接上造成队头阻塞。房间成员由聊天服务器通过本机控制连接下发，客户端的 UDP 包
+    凭加入时得到的令牌识别，地址以最近收到的包为准。房间中还有只用聊天连接的成员时，
+    把分片重组成整帧交给聊天服务器转发给他们。
+    切换为合成画面模式的房间不逐路转发，由 MosaicMixer 在线程池中合成一路画面发给每个成员。
+    """
+
+    def __init__(self, host="0.0.0.0", port=0, control_host="127.0.0.1",
+                 control_port=DEFAULT_CONTROL_PORT, on_log=None):
+        self.host = host
+        self.port = port  # 0 表示由系统分配，启动后更新为实际端口
+        self.control_host = control_host
+        self.control_port = control_port
+        self.on_log = on_log
+        self.transport = None
+        self.control_server = None
+        self.control_writer = None  # 当前的聊天服务器连接，同一时间只有一个
+        self.rooms = {}  # 房间ID -> {用户ID: RelayMember}
+        self.tokens = {}  # 令牌 -> RelayMember
+        self.assemblers = {}  # 房间ID -> MediaAssembler（需要整帧时使用）
+        self.mixers = {}  # 合成画面模式的房间ID -> (MosaicMixer, 合成任务)
+        self.executor = None  # 解码、合成和编码在线程池中进行，不阻塞转发
+        self._sweeper = None
+        self.packets_in = 0
+        self.packets_out = 0
+        self.bytes_out = 0
+        self.dropped = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _RelayProtocol(self), local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self.control_server = await asyncio.start_server(
+            self.handle_control, self.control_host, self.control_port, reuse_address=True)
+        self.control_port = self.control_server.sockets[0].getsockname()[1]
+        self._sweeper = loop.create_task(self.sweep())
+        if mosaic.available():
+            self.executor = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        if self.control_server is not None:
+            self.control_server.close()
+            await self.control_server.wait_closed()
+        if self.control_writer is not None:
+            self.control_writer.close()
+        if self.transport is not None:
+            self.transport.close()
+        self.reset()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def log(self, message):
+        if self.on_log:
+            self.on_log(message)
+
+    def reset(self):
+        self.rooms.clear()
+        self.tokens.clear()
+        self.assemblers.clear()
+        for room in list(self.mixers):
+            self.stop_mixer(room)
+
+    # ==================== 控制连接 ====================
+
+    async def handle_control(self, reader, writer):
+        """聊天服务器的控制连接，新连接取代旧连接，房间状态由聊天服务器重新下发"""
+        if self.control_writer is not None:
+            self.control_writer.close()
+        self.reset()
+        self.control_writer = writer
+        hello = {"port": self.port, "mosaic": self.executor is not None}
+        writer.write(Frame(CTRL_HELLO, json.dumps(hello).encode()).encode())
+        self.log(f"聊天服务器已连接: {writer.get_extra_info('peername')}")
+        try:
+            while True:
+                frame = await read_control_frame(reader, self.skip_control_frame)
+                if frame is None:
+                    break
+                if frame.msg_type == CTRL_JOIN:
+                    self.join(frame.room, frame.user, bytes(frame.body))
+                elif frame.msg_type == CTRL_LEAVE:
+                    self.leave(frame.room, frame.user)
+                elif frame.msg_type == CTRL_MODE:
+                    self.set_mode(frame.room, frame.text())
+                elif frame.msg_type == CTRL_FRAME:
+                    entry = self.mixers.get(frame.room)
+                    if entry is not None and frame.user in self.rooms.get(frame.room, ()):
+                        entry[0].submit(frame.user, bytes(frame.body))
+        except (ConnectionError, OSError, MessageFormatError) as e:
+            self.log(f"控制连接出错: {e}")
+        finally:
+            writer.close()
+            if self.control_writer is writer:
+                self.control_writer = None
+                self.reset()
+                self.log("聊天服务器已断开，清空所有房间")
+
+    def skip_control_frame(self, length):
+        """过大的控制帧只丢弃这一帧，不断开控制连接（断开会清空所有房间）"""
+        self.dropped += 1
+        self.log(f"丢弃过大的控制帧（{length} 字节）")
+
+    def notify(self, msg_type, room, user_id, body=b''):
+        if self.control_writer is not None:
+            self.control_writer.write(Frame(msg_type, body, room=room, user=user_id).encode())
+
+    def join(self, room, user_id, token):
+        members = self.rooms.setdefault(room, {})
+        old = members.get(user_id)
+        if old is not None and old.token:
+            self.tokens.pop(old.token, None)
+        member = members[user_id] = RelayMember(room, user_id, token)
+        if token:
+            self.tokens[token] = member
+
+    def leave(self, room, user_id):
+        members = self.rooms.get(room)
+        if members is None:
+            return
+        member = members.pop(user_id, None)
+        if member is None:
+            return
+        if member.token:
+            self.tokens.pop(member.token, None)
+        assembler = self.assemblers.get(room)
+        if assembler is not None:
+            assembler.discard(user_id)
+        if not members:
+            del self.rooms[room]
+            self.assemblers.pop(room, None)
+            self.stop_mixer(room)
+
+    def set_mode(self, room, mode):
+        """切换房间的视频模式，合成画面模式下成员的视频不再转发，而是交给合成任务"""
+        if mode != VIDEO_MODE_MOSAIC:
+            self.stop_mixer(room)
+        elif room not in self.mixers and self.executor is not None:
+            mixer = mosaic.MosaicMixer()
+            task = asyncio.get_running_loop().create_task(self.mix_room(room, mixer))
+            self.mixers[room] = (mixer, task)
+
+    def stop_mixer(self, room):
+        entry = self.mixers.pop(room, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    # ==================== UDP 转发 ====================
+
+    def datagram_received(self, data, address):
+        if len(data) < MEDIA_UPLINK_HEADER.size:
+            return
+        token, frame_seq, index, count = MEDIA_UPLINK_HEADER.unpack_from(data)
+        member = self.tokens.get(token)
+        if member is None:
+            return
+        self.packets_in += 1
+        member.last_seen = time.monotonic()
+        if member.address != address:
+            attached = member.address is None
+            member.address = address  # NAT 映射变化时跟随新地址
+            if attached:
+                self.notify(CTRL_ATTACH, member.room, member.user_id)
+        header = MEDIA_DOWNLINK_HEADER.pack(member.room, member.user_id, frame_seq, index, count)
+        if count == 0:
+            self.sendto(header, address)  # 保活回复，客户端据此确认 UDP 可用
+            return
+        entry = self.mixers.get(member.room)
+        if entry is not None:
+            data = self.assemble(member, frame_seq, index, count,
+                                 memoryview(data)[MEDIA_UPLINK_HEADER.size:])
+            if data is not None:
+                entry[0].submit(member.user_id, data)
+            return
+
+        packet = header + data[MEDIA_UPLINK_HEADER.size:]
+        tcp_only = False
+        for other in self.rooms[member.room].values():
+            if other is member:
+                continue
+            if other.address is None:
+                tcp_only = True
+            else:
+                self.sendto(packet, other.address)
+        if tcp_only:
+            self.forward_to_chat(member, frame_seq, index, count,
+                                 memoryview(data)[MEDIA_UPLINK_HEADER.size:])
+
+    def sendto(self, packet, address):
+        if self.transport.get_write_buffer_size() > UDP_HIGH_WATER:
+            self.dropped += 1
+            return
+        self.transport.sendto(packet, address)
+        self.packets_out += 1
+        self.bytes_out += len(packet)
+
+    def assemble(self, member, frame_seq, index, count, fragment):
+        """重组整帧，凑齐时返回完整数据"""
+        assembler = self.assemblers.get(member.room)
+        if assembler is None:
+            assembler = self.assemblers[member.room] = MediaAssembler()
+        return assembler.add(member.user_id, frame_seq, index, count, fragment)
+
+    def forward_to_chat(self, member, frame_seq, index, count, fragment):
+        """重组整帧，交给聊天服务器转发给只用聊天连接的成员"""
+        data = self.assemble(member, frame_seq, index, count, fragment)
+        if data is not None:
+            self.frame_to_chat(member.room, member.user_id, data)
+
+    def frame_to_chat(self, room, user_id, data):
+        if self.control_writer is None:
+            return
+        if self.control_writer.transport.get_write_buffer_size() > CONTROL_HIGH_WATER:
+            self.dropped += 1
+            return
+        self.notify(CTRL_FRAME, room, user_id, data)
+
+    async def mix_room(self, room, mixer):
+        """按固定帧率合成房间画面并发给每个成员，期间没有新画面时不发送"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            deadline = max(deadline + mixer.interval, loop.time())
+            await asyncio.sleep(deadline - loop.time())
+            members = self.rooms.get(room)
+            if not members or not mixer.pending:
+                continue
+            data = await loop.run_in_executor(
+                self.executor, mixer.compose, mixer.take_pending(), sorted(members))
+            if data is not None and room in self.rooms:
+                self.send_mosaic(room, mixer, data)
+
+    def send_mosaic(self, room, mixer, data):
+        try:
+            fragments = split_media_frame(data)
+        except MessageFormatError:
+            self.dropped += 1
+            return
+        mixer.frame_seq = (mixer.frame_seq + 1) & 0xFFFFFFFF
+        headers = [MEDIA_DOWNLINK_HEADER.pack(room, 0, mixer.frame_seq, index, len(fragments))
+                   for index in range(len(fragments))]
+        tcp_only = False
+        for member in self.rooms[room].values():
+            if member.address is None:
+                tcp_only = True
+                continue
+            for header, fragment in zip(headers, fragments):
+                self.sendto(header + fragment, member.address)
+        if tcp_only:
+            self.frame_to_chat(room, 0, data)
+
+    async def sweep(self):
+        """定期清除保活超时的成员地址，之后视频改由聊天连接发给他"""
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            deadline = time.monotonic() - MEMBER_TIMEOUT
+            for member in self.tokens.values():
+                if member.address is not None and member.last_seen < deadline:
+                    member.address = None
+                    self.notify(CTRL_DETACH, member.room, member.user_id)
+
+    def stats(self):
+        return {"port": self.port, "rooms": len(self.rooms), "mosaic_rooms": len(self.mixers),
+                "members": sum(len(members) for members in self.rooms.values()),
+                "attached": sum(1 for member in self.tokens.values() if member.address),
+                "packets_in": self.packets_in, "packets_out": self.packets_out,
+                "bytes_out": self.bytes_out, "dropped": self.dropped}
+
+
+class RelayLink:
+    """聊天服务器一侧的控制连接
+
+    连接断开后定时重连；每次连上后调用 on_connected()，由聊天服务器重新下发所有房间成员。
+    收到的 ATTACH / DETACH / FRAME 交给 on_message(frame)，断开时调用 on_disconnected()。
+    回调都在聊天服务器的事件循环中执行。
+    """
+
+    def __init__(self, host, port, on_connected, on_message, on_disconnected, on_log=None):
+        self.host = host
+        self.port = port
+        self.on_connected = on_connected
+        self.on_message = on_message
+        self.on_disconnected = on_disconnected
+        self.on_log = on_log
+        self.writer = None
+        self.udp_port = None  # 媒体转发服务器的 UDP 端口，连上后由 HELLO 告知
+        self.mosaic = False  # 媒体转发服务器是否支持合成画面（安装了 OpenCV）
+        self._task = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def log(self, message):
+        if self.on_log:
+            self.on_log(message)
+
+    async def run(self):
+        reported = False  # 同一次断开只记录一次日志
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                if not reported:
+                    self.log(f"无法连接媒体转发服务器 {self.host}:{self.port}: {e}，"
+                             f"多人视频经聊天连接转发")
+                    reported = True
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            try:
+                hello = await read_control_frame(reader)
+                if hello is None or hello.msg_type != CTRL_HELLO:
+                    raise MessageFormatError("媒体转发服务器握手失败")
+                meta = json.loads(hello.text())
+                self.udp_port = meta["port"]
+                self.mosaic = bool(meta.get("mosaic"))
+                self.writer = writer
+                reported = False
+                self.log(f"已连接媒体转发服务器，UDP 端口 {self.udp_port}")
+                self.on_connected()
+                while True:
+                    frame = await read_control_frame(reader)
+                    if frame is None:
+                        break
+                    self.on_message(frame)
+            except (ConnectionError, OSError, ValueError, KeyError, MessageFormatError) as e:
+                self.log(f"媒体转发服务器控制连接出错: {e}")
+            finally:
+                writer.close()
+                if self.writer is writer:
+                    self.writer = None
+                    self.log("与媒体转发服务器的连接已断开，多人视频经聊天连接转发")
+                    self.on_disconnected()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    def send(self, msg_type, room, user_id, body=b''):
+        if self.writer is not None:
+            self.writer.write(Frame(msg_type, body, room=room, user=user_id).encode())
+
+
+def run(host="0.0.0.0", port=0, control_host="127.0.0.1", control_port=DEFAULT_CONTROL_PORT,
+        quiet=False, log_options=None):
+    """运行媒体转发服务器直到进程结束（可作为 multiprocessing.Process 的入口）
+
+    quiet 为 True 时不输出到控制台；log_options 为 LogPipeline 的参数，
+    日志文件 server.log 在转发进程中为 server-media.log。
+    """
+    log_options = dict(log_options or {})
+    if log_options.get("path"):
+        root, ext = os.path.splitext(log_options["path"])
+        log_options["path"] = f"{root}-media{ext}"
+    logs = None
+    if log_options.get("path") or not quiet:
+        logs = LogPipeline(stream=None if quiet else sys.stdout, **log_options).start()
+    log = (lambda message: logs.emit(f"[媒体转发] {message}")) if logs else None
+
+    async def serve():
+        relay = MediaRelay(host, port, control_host, control_port, log)
+        await relay.start()
+        relay.log(f"媒体转发服务器已启动，UDP 端口 {relay.port}，"
+                  f"控制端口 {relay.control_host}:{relay.control_port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await relay.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if logs is not None:
+            logs.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多人视频 UDP 媒体转发服务器")
+    parser.add_argument("--host", default="0.0.0.0", help="UDP 监听地址")
+    parser.add_argument("--port", type=int, default=8890, help="UDP 端口")
+    parser.add_argument("--control-host", default="127.0.0.1", help="控制连接监听地址")
+    parser.add_argument("--control-port", type=int, default=DEFAULT_CONTROL_PORT,
+                        help="控制连接端口（聊天服务器连接这里）")
+    args = parser.parse_args()
+    run(args.host, args.port, args.control_host, args.control_port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # 合成画面模式需要 OpenCV，未安装时只能逐路转发
+    cv2 = np = None
+
+MOSAIC_SIZE = (640, 480)  # 合成画面的固定分辨率（宽, 高）
+MOSAIC_FPS = 10  # 与客户端的发送帧率一致
+MOSAIC_QUALITY = 50
+
+
+def available():
+    return cv2 is not None
+
+
+def grid_shape(count):
+    """按参与者人数返回 (列数, 行数)，与客户端的视频网格布局一致"""
+    if count <= 1:
+        return 1, 1
+    if count <= 2:
+        return 2, 1
+    if count <= 4:
+        return 2, 2
+    if count <= 6:
+        return 3, 2
+    if count <= 9:
+        return 3, 3
+    return 4, (count + 3) // 4
+
+
+class MosaicMixer:
+    """把一个房间各成员的视频合成为一路固定分辨率的网格画面（MCU）
+
+    submit() 在事件循环中调用，只保存每个成员最新的 JPEG；compose() 在线程池中执行，
+    每个周期只解码这期间更新过的成员，没有新画面的成员沿用上一次解码的结果。
+    同一个房间同一时间只有一个 compose() 在运行。
+    """
+
+    def __init__(self, size=MOSAIC_SIZE, fps=MOSAIC_FPS, quality=MOSAIC_QUALITY):
+        self.size = size
+        self.interval = 1.0 / fps
+        self.quality = quality
+        self.pending = {}  # 用户ID -> 上次合成后收到的最新 JPEG
+        self.frames = {}  # 用户ID -> 最近一次解码的画面（只在 compose() 中访问）
+        self.frame_seq = 0
+
+    def submit(self, user_id, jpeg_data):
+        self.pending[user_id] = jpeg_data
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def compose(self, pending, members):
+        """解码更新过的画面，按 members 的顺序排成网格并编码为 JPEG，没有任何画面时返回 None"""
+        for user_id, jpeg_data in pending.items():
+            frame = cv2.imdecode(np.frombuffer(jpeg_data, np.uint8), cv2.IMREAD_COLOR)
+            if frame is not None:
+                self.frames[user_id] = frame
+        for user_id in list(self.frames):
+            if user_id not in members:
+                del self.frames[user_id]
+        if not self.frames:
+            return None
+
+        width, height = self.size
+        cols, rows = grid_shape(len(members))
+        cell_w, cell_h = width // cols, height // rows
+        canvas = np.zeros((height, width, 3), np.uint8)
+        for idx, user_id in enumerate(members):
+            frame = self.frames.get(user_id)
+            if frame is None:
+                continue  # 还没有画面（或关闭了摄像头）的成员留黑
+            # 保持宽高比缩放到格子内并居中
+            h, w = frame.shape[:2]
+            scale = min(cell_w / w, cell_h / h)
+            tile_w, tile_h = max(1, int(w * scale)), max(1, int(h * scale))
+            tile = cv2.resize(frame, (tile_w, tile_h), interpolation=cv2.INTER_AREA)
+            x = (idx % cols) * cell_w + (cell_w - tile_w) // 2
+            y = (idx // cols) * cell_h + (cell_h - tile_h) // 2
+            canvas[y:y + tile_h, x:x + tile_w] = tile
+        result, encoded = cv2.imencode(
+            '.jpg', canvas, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        return encoded.tobytes() if result else None
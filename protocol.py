@@ -0,0 +1,621 @@
+import asyncio
+import base64
+import json
+import re
+import struct
+import zlib
+
+# 帧格式：4 字节大端长度前缀 + 消息内容
+LENGTH_PREFIX = struct.Struct('!I')
+
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024  # 单帧最大 64MB，防止伪造的长度前缀导致无限分配
+DEFAULT_BUFFER_SIZE = 256 * 1024  # 接收缓冲区初始大小
+MIN_READ_SIZE = 16 * 1024  # 剩余空间小于该值时先整理缓冲区再读
+MAX_CONTROL_FRAME = 1024 * 1024  # 本机控制连接和管理连接上的单帧上限
+
+
+class FrameTooLargeError(Exception):
+    """帧长度超过允许的最大值（通常是损坏或恶意的长度前缀）"""
+
+
+def encode_frame(message):
+    """把消息（str 或 bytes）编码为带长度前缀的帧"""
+    if isinstance(message, str):
+        message = message.encode()
+    return LENGTH_PREFIX.pack(len(message)) + message
+
+
+def encode_frame_parts(parts):
+    """把多段内容（bytes / memoryview）拼成一帧，整帧只拷贝一次"""
+    return b''.join([LENGTH_PREFIX.pack(sum(map(len, parts)))] + list(parts))
+
+
+def send_message(sock, message):
+    """通过阻塞 socket 发送一条消息"""
+    sock.sendall(encode_frame(message))
+
+
+class FrameBuffer:
+    """可复用的接收缓冲区 + 分帧器
+
+    数据通过 get_buffer()/buffer_updated() 直接写入内部的 bytearray
+    （配合 socket.recv_into 或 asyncio.BufferedProtocol 使用），
+    next_frame() 返回完整帧内容的 memoryview 切片，不做额外拷贝。
+
+    注意：返回的 memoryview 指向内部缓冲区，只在下一次 get_buffer() 之前有效，
+    需要保留数据时请自行 bytes() 拷贝。
+    """
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 buffer_size=DEFAULT_BUFFER_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # 未消费数据的起点
+        self._end = 0  # 已写入数据的终点
+
+    def _frame_length(self):
+        """当前未完成帧的总长度（含长度前缀），长度前缀还不完整时返回 None"""
+        if self._end - self._start < LENGTH_PREFIX.size:
+            return None
+        length = LENGTH_PREFIX.unpack_from(self._buffer, self._start)[0]
+        if length > self.max_frame_size:
+            raise FrameTooLargeError(
+                f"帧长度 {length} 超过上限 {self.max_frame_size}")
+        return LENGTH_PREFIX.size + length
+
+    def get_buffer(self):
+        """返回可写入的空闲区域"""
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self.buffer_size:
+                # 大帧处理完后缩回初始大小，避免每个连接长期占用大块内存
+                self._buffer = bytearray(self.buffer_size)
+                self._view = memoryview(self._buffer)
+
+        needed = self._frame_length() or LENGTH_PREFIX.size
+        size = len(self._buffer)
+        if size - self._start < needed or size - self._end < MIN_READ_SIZE:
+            pending = self._end - self._start
+            if needed > size:
+                # 放不下当前这一帧，换一个足够大的缓冲区
+                new_buffer = bytearray(max(needed, size * 2))
+                new_buffer[:pending] = self._view[self._start:self._end]
+                self._buffer = new_buffer
+                self._view = memoryview(new_buffer)
+            elif self._start:
+                # 把未消费的数据搬到缓冲区开头（区间重叠时先拷贝）
+                if self._start < pending:
+                    self._buffer[:pending] = bytes(
+                        self._view[self._start:self._end])
+                else:
+                    self._buffer[:pending] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """通知缓冲区新写入了 nbytes 字节"""
+        self._end += nbytes
+
+    def next_frame(self):
+        """取出下一个完整帧的内容，数据不足时返回 None"""
+        total = self._frame_length()
+        if total is None or self._end - self._start < total:
+            return None
+        begin = self._start + LENGTH_PREFIX.size
+        self._start += total
+        return self._view[begin:self._start]
+
+
+class FrameReader:
+    """阻塞 socket 的缓冲读取器
+
+    每次 recv_into 尽量读满缓冲区，一次读取中包含的多个完整帧依次返回，
+    不再为每条消息分别 recv 长度和内容。
+    """
+
+    def __init__(self, sock, max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = FrameBuffer(max_frame_size, buffer_size)
+
+    def read_frame(self):
+        """读取一帧，返回 memoryview（下一次读取前有效），连接关闭时返回 None"""
+        while True:
+            frame = self.buffer.next_frame()
+            if frame is not None:
+                return frame
+            nbytes = self.sock.recv_into(self.buffer.get_buffer())
+            if not nbytes:
+                return None
+            self.buffer.buffer_updated(nbytes)
+
+    def read_message(self):
+        """读取一条文本消息，连接关闭时返回 None"""
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return str(frame, 'utf-8')
+
+
+async def read_control_frame(reader, on_oversized=None):
+    """从 asyncio StreamReader 读取一个 v2 帧（本机控制连接和管理连接），连接关闭时返回 None
+
+    帧长度超过 MAX_CONTROL_FRAME 时抛出 MessageFormatError；给出 on_oversized 时改为读掉并丢弃
+    这一帧，调用 on_oversized(长度) 后继续读下一帧。
+    """
+    try:
+        while True:
+            header = await reader.readexactly(LENGTH_PREFIX.size)
+            length = LENGTH_PREFIX.unpack(header)[0]
+            if length <= MAX_CONTROL_FRAME:
+                return Frame.decode(await reader.readexactly(length))
+            if on_oversized is None:
+                raise MessageFormatError(f"控制帧长度 {length} 超过上限")
+            while length:
+                length -= len(await reader.readexactly(min(length, MAX_CONTROL_FRAME)))
+            on_oversized(LENGTH_PREFIX.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+
+# ==================== 协议 v2：二进制类型帧 ====================
+#
+# 握手：客户端的第一帧为 HELLO_MAGIC + JSON（版本、用户名、能力列表），取代旧版的裸用户名；
+#       服务器回复 MSG_WELCOME（user 字段为分配给该会话的用户ID，消息体为协商后的能力 JSON）。
+# 之后每一帧（长度前缀之后）都是：类型(1) 标志(1) 房间ID(4) 用户ID(4) 序号(4) + 原始二进制消息体。
+# 用户ID 在上行帧中表示目标用户，在下行帧中表示发送者；序号由发送方递增，服务器转发时保持不变。
+
+PROTOCOL_VERSION = 2
+HELLO_MAGIC = b'\x00CR2'  # 旧版客户端的用户名不会以 NUL 开头
+FRAME_HEADER = struct.Struct('!BBIII')
+
+# 能力列表（握手时协商，取双方交集）
+CAP_BINARY_MEDIA = "binary_media"  # 视频帧和文件以原始二进制传输，不做 base64
+CAP_FILE_DOWNLOAD = "file_download"  # 点击下载的文件通过单独的下载连接获取
+CAP_MEDIA_RELAY = "media_relay"  # 多人视频帧通过 UDP 媒体转发服务器收发
+CAP_BULK_CHANNEL = "bulk_channel"  # 视频和文件数据走第二条（数据）连接，不阻塞聊天
+CAP_FRAGMENTS = "fragments"  # 服务器能拼接客户端拆开发送的大帧（FLAG_MORE）
+
+# 消息类型
+MSG_HELLO = 0x01
+MSG_WELCOME = 0x02
+MSG_QUIT = 0x03
+MSG_CHAT = 0x10
+MSG_PRIVATE = 0x11
+MSG_SYSTEM = 0x12
+MSG_USERLIST = 0x13
+MSG_REQUEST_USERLIST = 0x14
+MSG_FILE = 0x20
+MSG_FILE_OFFER = 0x21
+MSG_FILE_CHUNK = 0x22
+MSG_FILE_COMPLETE = 0x23
+MSG_FILE_CANCEL = 0x24
+MSG_FILE_ACK = 0x25
+MSG_FILE_HAVE = 0x26
+MSG_FILE_ANNOUNCE = 0x27
+MSG_FILE_FETCH = 0x28
+MSG_FILE_TICKET = 0x29
+MSG_VIDEO_CALL_REQUEST = 0x30
+MSG_VIDEO_CALL_INVITE = 0x31
+MSG_VIDEO_CALL_ACCEPT = 0x32
+MSG_VIDEO_CALL_START = 0x33
+MSG_VIDEO_CALL_REJECT = 0x34
+MSG_VIDEO_CALL_REJECTED = 0x35
+MSG_VIDEO_CALL_END = 0x36
+MSG_VIDEO_CALL_ENDED = 0x37
+MSG_VIDEO_DATA = 0x38
+MSG_UDP_PORT = 0x39
+MSG_MULTI_VIDEO_INVITE = 0x40
+MSG_MULTI_VIDEO_JOIN = 0x41
+MSG_MULTI_VIDEO_LEAVE = 0x42
+MSG_MULTI_VIDEO_DATA = 0x43
+MSG_MULTI_VIDEO_REFRESH = 0x44
+MSG_CAMERA_STATUS = 0x45
+MSG_MULTI_VIDEO_ROSTER = 0x46  # 房间当前成员 JSON [[用户ID, 用户名], ...]（服务器 -> 加入者）
+MSG_MEDIA_RELAY = 0x47  # 媒体转发服务器的 UDP 端口和令牌 JSON（服务器 -> 加入者）
+MSG_MULTI_VIDEO_MODE = 0x48  # 房间的视频模式（VIDEO_MODE_*），任一成员可以切换，服务器通知全体成员
+
+# 数据连接：协商了 CAP_BULK_CHANNEL 的客户端用 WELCOME 中的 bulk_token 再连接一次服务器，
+# 握手中只带令牌（一次性）。之后这些类型的帧在两个方向上都走数据连接，其余消息仍走聊天连接；
+# 大文件和视频帧排在数据连接的队列里，不会让后面的聊天消息等待。任一连接断开时服务器关闭两条连接。
+BULK_MESSAGE_TYPES = frozenset([MSG_FILE, MSG_FILE_CHUNK, MSG_FILE_COMPLETE,
+                                MSG_VIDEO_DATA, MSG_MULTI_VIDEO_DATA])
+
+# 多人视频模式：forward 把每个人的视频分别转发给其他成员；mosaic 由服务器合成一路网格画面
+# 发给每个成员（帧头用户ID为 0），客户端只需下载和解码一路视频
+VIDEO_MODE_FORWARD = "forward"
+VIDEO_MODE_MOSAIC = "mosaic"
+
+# 标志位
+FLAG_PRIVATE = 0x01  # 私聊（用于文件）
+FLAG_OFFLINE = 0x02  # 视频通话因对方离线而结束
+# 大帧的分片：除最后一片外都带 FLAG_MORE，各分片的类型、房间ID、用户ID和序号与原帧相同，
+# 同一类型的分片连续发送（中间可以插入其他类型的帧），服务器拼接后再按一帧处理
+FLAG_MORE = 0x80
+
+FILE_NAME_LENGTH = struct.Struct('!H')
+
+# 分块文件传输：发送者为每次传输分配传输ID，(发送者用户ID, 传输ID) 唯一确定一次传输；
+# 文件内容的 SHA-256 在断线重连、客户端重启后仍然不变，接收方据此找到未完成的数据续传
+FILE_TRANSFER_ID = struct.Struct('!I')
+FILE_CHUNK_HEADER = struct.Struct('!IQI')  # 传输ID + 偏移 + 数据块的 CRC32
+FILE_ACK = struct.Struct('!IQ')  # 传输ID + 字节数
+FILE_DIGEST_SIZE = 32  # SHA-256
+FILE_CHUNK_SIZE = 64 * 1024
+MAX_FILE_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_THUMBNAIL_SIZE = 16 * 1024  # 图片文件缩略图（JPEG）的大小上限
+
+# 下载连接：客户端凭 TICKET 中的票据连接服务器的下载端口，每个请求取文件的一段，
+# 服务器回复状态和长度后直接发送文件内容（sendfile），同一连接可以依次发多个请求
+DOWNLOAD_TICKET_SIZE = 16
+DOWNLOAD_REQUEST = struct.Struct('!16sQQ')  # 票据 + 偏移 + 长度（0 表示到文件末尾）
+DOWNLOAD_RESPONSE = struct.Struct('!BQ')  # 状态 + 随后发送的字节数
+DOWNLOAD_OK = 0
+DOWNLOAD_BAD_TICKET = 1  # 票据无效或已过期，或文件已不在服务器上
+DOWNLOAD_BAD_RANGE = 2
+_SHA256_HEX = re.compile(r'[0-9a-f]{64}')
+
+# 媒体转发（UDP）：加入多人视频房间后，客户端凭 MEDIA_RELAY 中的令牌向媒体转发服务器发送 UDP 包，
+# 转发服务器再发给同一房间的其他成员。视频帧拆成不超过 MEDIA_FRAGMENT_SIZE 的分片，避免 IP 分片；
+# 分片数为 0 的包是保活包，转发服务器据此记录客户端的地址（经过 NAT 后的地址）并回复一个保活包，
+# 客户端收到回复后才改用 UDP 发送视频，长时间收不到回复则退回聊天连接。
+MEDIA_TOKEN_SIZE = 8
+MEDIA_UPLINK_HEADER = struct.Struct('!8sIBB')  # 令牌 + 帧序号 + 分片序号 + 分片数
+MEDIA_DOWNLINK_HEADER = struct.Struct('!IIIBB')  # 房间ID + 发送者用户ID + 帧序号 + 分片序号 + 分片数
+MEDIA_FRAGMENT_SIZE = 1200
+MAX_MEDIA_FRAGMENTS = 255
+
+# 一对一视频的点对点 UDP：通话建立后双方各发一次 UDP_PORT（本机 UDP 端口和本机 IP），
+# 服务器把对方的候选地址（服务器看到的 IP 和本机 IP，端口相同）发给双方。双方向对方的每个候选地址
+# 发送探测包，收到对方的确认后直接经 UDP 互发视频；打洞失败或中途收不到确认时仍经服务器中转。
+# 点对点的包沿用 MEDIA_DOWNLINK_HEADER（房间ID为 0，用户ID为发送者），分片数为 0 的是探测包，
+# 分片序号区分探测和确认。
+PEER_PROBE = 0
+PEER_PROBE_ACK = 1
+
+
+class MessageFormatError(Exception):
+    """消息格式不正确"""
+
+
+class Frame:
+    """一条 v2 类型帧"""
+
+    __slots__ = ('msg_type', 'flags', 'room', 'user', 'seq', 'body')
+
+    def __init__(self, msg_type, body=b'', flags=0, room=0, user=0, seq=0):
+        self.msg_type = msg_type
+        self.flags = flags
+        self.room = room
+        self.user = user
+        self.seq = seq
+        self.body = body
+
+    @classmethod
+    def decode(cls, payload):
+        """从一帧的内容（不含长度前缀）解析，body 是 payload 的 memoryview 切片"""
+        if len(payload) < FRAME_HEADER.size:
+            raise MessageFormatError("帧头不完整")
+        msg_type, flags, room, user, seq = FRAME_HEADER.unpack_from(payload)
+        body = memoryview(payload)[FRAME_HEADER.size:]
+        return cls(msg_type, body, flags, room, user, seq)
+
+    def encode(self):
+        """编码为带长度前缀的完整帧"""
+        return b''.join((
+            LENGTH_PREFIX.pack(FRAME_HEADER.size + len(self.body)),
+            FRAME_HEADER.pack(self.msg_type, self.flags,
+                              self.room, self.user, self.seq),
+            self.body))
+
+    def text(self):
+        return str(self.body, 'utf-8')
+
+
+def encode_hello(username, caps, video_fps=None, bulk_token=None):
+    """握手帧内容，video_fps 为希望收到的每路视频的最高帧率（不超过服务器的上限）；
+    bulk_token 不为 None 时是数据连接的握手"""
+    hello = {"version": PROTOCOL_VERSION, "username": username, "caps": list(caps)}
+    if video_fps is not None:
+        hello["video_fps"] = video_fps
+    if bulk_token is not None:
+        hello["bulk_token"] = bulk_token
+    return HELLO_MAGIC + json.dumps(hello).encode()
+
+
+def decode_hello(payload):
+    """解析握手帧，不是 v2 握手时返回 None"""
+    if bytes(payload[:len(HELLO_MAGIC)]) != HELLO_MAGIC:
+        return None
+    try:
+        hello = json.loads(str(payload[len(HELLO_MAGIC):], 'utf-8'))
+    except ValueError:
+        raise MessageFormatError("握手消息格式不正确")
+    if not isinstance(hello, dict):
+        raise MessageFormatError("握手消息格式不正确")
+    return hello
+
+
+def pack_file_body(filename, data):
+    """文件消息体：文件名长度(2) + 文件名 + 文件内容"""
+    name = filename.encode()
+    return b''.join((FILE_NAME_LENGTH.pack(len(name)), name, data))
+
+
+def unpack_file_body(body):
+    """解析文件消息体，返回 (文件名, 文件内容的 memoryview)"""
+    body = memoryview(body)
+    if len(body) < FILE_NAME_LENGTH.size:
+        raise MessageFormatError("文件格式不正确")
+    name_len = FILE_NAME_LENGTH.unpack_from(body)[0]
+    name_end = FILE_NAME_LENGTH.size + name_len
+    if len(body) < name_end:
+        raise MessageFormatError("文件格式不正确")
+    return str(body[FILE_NAME_LENGTH.size:name_end], 'utf-8'), body[name_end:]
+
+
+# 分块文件传输的消息体（均以传输ID开头）：
+#   OFFER    传输ID + JSON {"name": 文件名, "size": 字节数, "sha256": 十六进制摘要, "chunk_size": 块大小}
+#            图片文件可以带 "thumbnail": base64 编码的 JPEG 缩略图（不超过 MAX_THUMBNAIL_SIZE）
+#   CHUNK    传输ID + 偏移 + CRC32 + 数据（偏移是块大小的整数倍，可以乱序、重传）
+#   COMPLETE 传输ID + 整个文件的 SHA-256
+#   CANCEL   传输ID + 原因（UTF-8）
+#   ACK      传输ID + 服务器已收到的字节数（服务器 -> 发送者，用于流量控制）
+#   HAVE     传输ID + 已收到的块的位图（第 i 位为 1 表示第 i 块已收到并校验通过）
+#            收到 OFFER 和 COMPLETE 后各回复一次，发送方只重发位图中缺少的块，位图全为 1 表示已完整收到
+# 文件先上传到服务器的文件仓库（服务器回复 HAVE），再由服务器以同样的流程分别发给每个接收方，
+# 下行帧的用户ID为上传者；服务器已有相同 SHA-256 的文件时对 OFFER 直接回复全满的位图。
+# 群发的文件上传完成后服务器不直接发送内容，只向其他客户端发 ANNOUNCE，用户点击后再下载：
+#   ANNOUNCE 与 OFFER 的消息体相同（服务器 -> 客户端，用户ID为上传者）
+#   FETCH    传输ID（客户端 -> 服务器，用户ID为上传者），服务器随后发 OFFER，按上面的流程下载
+#   TICKET   传输ID + JSON {"port": 下载端口, "ticket": 十六进制票据}（服务器 -> 客户端，用户ID为上传者）
+#            双方都支持 CAP_FILE_DOWNLOAD 时代替 OFFER，客户端从下载端口获取文件内容
+
+def file_transfer_id(body):
+    """取出分块传输消息体开头的传输ID"""
+    if len(body) < FILE_TRANSFER_ID.size:
+        raise MessageFormatError("文件传输消息格式不正确")
+    return FILE_TRANSFER_ID.unpack_from(body)[0]
+
+
+def pack_file_offer(transfer_id, filename, size, sha256, chunk_size=FILE_CHUNK_SIZE,
+                    thumbnail=None):
+    offer = {"name": filename, "size": size, "sha256": sha256,
+             "chunk_size": chunk_size}
+    if thumbnail:
+        offer["thumbnail"] = base64.b64encode(thumbnail).decode('ascii')
+    return FILE_TRANSFER_ID.pack(transfer_id) + json.dumps(offer).encode()
+
+
+def unpack_file_offer(body):
+    """返回 (传输ID, 文件名, 文件大小, SHA-256 十六进制摘要, 块大小)"""
+    transfer_id = file_transfer_id(body)
+    try:
+        offer = json.loads(str(body[FILE_TRANSFER_ID.size:], 'utf-8'))
+        filename = offer["name"]
+        size = offer["size"]
+        sha256 = offer["sha256"]
+        chunk_size = offer["chunk_size"]
+    except (ValueError, TypeError, KeyError):
+        raise MessageFormatError("文件传输请求格式不正确")
+    if (not isinstance(filename, str) or not isinstance(size, int) or size < 0
+            or not isinstance(chunk_size, int)
+            or not 0 < chunk_size <= MAX_FILE_CHUNK_SIZE
+            or not isinstance(sha256, str) or not _SHA256_HEX.fullmatch(sha256)):
+        raise MessageFormatError("文件传输请求格式不正确")
+    return transfer_id, filename, size, sha256, chunk_size
+
+
+def file_offer_thumbnail(body):
+    """取出 OFFER/ANNOUNCE 中的缩略图，没有或格式不正确时返回 None"""
+    try:
+        thumbnail = json.loads(str(body[FILE_TRANSFER_ID.size:], 'utf-8')).get("thumbnail")
+        if not isinstance(thumbnail, str) or len(thumbnail) > MAX_THUMBNAIL_SIZE * 4 // 3 + 4:
+            return None
+        return base64.b64decode(thumbnail, validate=True)
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def pack_file_fetch(transfer_id):
+    return FILE_TRANSFER_ID.pack(transfer_id)
+
+
+def pack_file_ticket(transfer_id, port, ticket):
+    return FILE_TRANSFER_ID.pack(transfer_id) + json.dumps(
+        {"port": port, "ticket": ticket.hex()}).encode()
+
+
+def unpack_file_ticket(body):
+    """返回 (传输ID, 下载端口, 票据)"""
+    transfer_id = file_transfer_id(body)
+    try:
+        meta = json.loads(str(body[FILE_TRANSFER_ID.size:], 'utf-8'))
+        port = meta["port"]
+        ticket = bytes.fromhex(meta["ticket"])
+    except (ValueError, TypeError, KeyError):
+        raise MessageFormatError("下载票据格式不正确")
+    if (not isinstance(port, int) or not 0 < port < 65536
+            or len(ticket) != DOWNLOAD_TICKET_SIZE):
+        raise MessageFormatError("下载票据格式不正确")
+    return transfer_id, port, ticket
+
+
+def pack_media_relay(port, token):
+    return json.dumps({"port": port, "token": token.hex()}).encode()
+
+
+def unpack_media_relay(body):
+    """返回 (媒体转发服务器的 UDP 端口, 令牌)"""
+    try:
+        meta = json.loads(str(body, 'utf-8'))
+        port = meta["port"]
+        token = bytes.fromhex(meta["token"])
+    except (ValueError, TypeError, KeyError):
+        raise MessageFormatError("媒体转发信息格式不正确")
+    if (not isinstance(port, int) or not 0 < port < 65536
+            or len(token) != MEDIA_TOKEN_SIZE):
+        raise MessageFormatError("媒体转发信息格式不正确")
+    return port, token
+
+
+def pack_udp_endpoint(port, local_ip):
+    return json.dumps({"port": port, "ip": local_ip}).encode()
+
+
+def unpack_udp_endpoint(body):
+    """返回 (UDP 端口, 本机 IP 或 None)；兼容旧版文本协议的 /UDP_PORT|端口"""
+    try:
+        text = str(body, 'utf-8')
+        if text.isdigit():
+            port, local_ip = int(text), None
+        else:
+            meta = json.loads(text)
+            port, local_ip = meta["port"], meta.get("ip")
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise MessageFormatError("UDP 端口信息格式不正确")
+    if (not isinstance(port, int) or not 0 < port < 65536
+            or not (local_ip is None or isinstance(local_ip, str))):
+        raise MessageFormatError("UDP 端口信息格式不正确")
+    return port, local_ip
+
+
+def pack_udp_candidates(candidates):
+    """对方的候选地址 [(IP, 端口), ...]（服务器 -> 通话双方）"""
+    return json.dumps({"candidates": [list(address) for address in candidates]}).encode()
+
+
+def unpack_udp_candidates(body):
+    try:
+        candidates = [(str(ip), int(port))
+                      for ip, port in json.loads(str(body, 'utf-8'))["candidates"]]
+    except (ValueError, TypeError, KeyError):
+        raise MessageFormatError("UDP 候选地址格式不正确")
+    return candidates
+
+
+def split_media_frame(data, fragment_size=MEDIA_FRAGMENT_SIZE):
+    """把一帧视频拆成分片（memoryview 列表），分片过多时抛出 MessageFormatError"""
+    view = memoryview(data)
+    fragments = [view[i:i + fragment_size] for i in range(0, len(view), fragment_size)]
+    if not fragments or len(fragments) > MAX_MEDIA_FRAGMENTS:
+        raise MessageFormatError(f"视频帧大小 {len(view)} 超出 UDP 分片范围")
+    return fragments
+
+
+class MediaAssembler:
+    """把 UDP 分片重组为完整的视频帧
+
+    每个发送者只保留最新一帧的分片：新一帧的分片到达时丢弃旧帧，迟到的旧分片直接忽略，
+    丢了分片的帧不会等待重传。
+    """
+
+    def __init__(self):
+        self._frames = {}  # 发送者 -> [帧序号, 分片数, {分片序号: 数据}]
+
+    def add(self, sender, frame_seq, index, count, data):
+        """加入一个分片，凑齐一帧时返回完整数据，否则返回 None"""
+        if not 0 <= index < count:
+            return None
+        entry = self._frames.get(sender)
+        if entry is None or entry[0] != frame_seq:
+            if entry is not None and (frame_seq - entry[0]) & 0xFFFFFFFF >= 0x80000000:
+                return None  # 比正在重组的帧更旧
+            entry = self._frames[sender] = [frame_seq, count, {}]
+        elif entry[1] != count:
+            return None
+        entry[2][index] = bytes(data)
+        if len(entry[2]) < count:
+            return None
+        del self._frames[sender]
+        return b''.join(entry[2][i] for i in range(count))
+
+    def discard(self, sender):
+        self._frames.pop(sender, None)
+
+
+def pack_file_chunk(transfer_id, offset, data):
+    return b''.join((FILE_CHUNK_HEADER.pack(transfer_id, offset, zlib.crc32(data)),
+                     data))
+
+
+def unpack_file_chunk(body):
+    """返回 (传输ID, 偏移, CRC32, 数据的 memoryview)，CRC 由接收方校验"""
+    if len(body) < FILE_CHUNK_HEADER.size:
+        raise MessageFormatError("文件数据块格式不正确")
+    transfer_id, offset, crc = FILE_CHUNK_HEADER.unpack_from(body)
+    return transfer_id, offset, crc, memoryview(body)[FILE_CHUNK_HEADER.size:]
+
+
+def pack_file_complete(transfer_id, digest):
+    return FILE_TRANSFER_ID.pack(transfer_id) + digest
+
+
+def unpack_file_complete(body):
+    """返回 (传输ID, SHA-256 摘要)"""
+    if len(body) != FILE_TRANSFER_ID.size + FILE_DIGEST_SIZE:
+        raise MessageFormatError("文件传输完成消息格式不正确")
+    return file_transfer_id(body), bytes(body[FILE_TRANSFER_ID.size:])
+
+
+def pack_file_cancel(transfer_id, reason=""):
+    return FILE_TRANSFER_ID.pack(transfer_id) + reason.encode()
+
+
+def unpack_file_cancel(body):
+    """返回 (传输ID, 原因)"""
+    transfer_id = file_transfer_id(body)
+    return transfer_id, str(body[FILE_TRANSFER_ID.size:], 'utf-8', 'replace')
+
+
+def pack_file_ack(transfer_id, offset):
+    return FILE_ACK.pack(transfer_id, offset)
+
+
+def unpack_file_ack(body):
+    """返回 (传输ID, 已确认的字节数)"""
+    if len(body) != FILE_ACK.size:
+        raise MessageFormatError("文件传输确认消息格式不正确")
+    return FILE_ACK.unpack_from(body)
+
+
+def pack_file_have(transfer_id, bitmap):
+    return FILE_TRANSFER_ID.pack(transfer_id) + bytes(bitmap)
+
+
+def unpack_file_have(body):
+    """返回 (传输ID, 位图)"""
+    return file_transfer_id(body), bytes(body[FILE_TRANSFER_ID.size:])
+
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+
+def empty_chunk_bitmap(count):
+    return bytes((count + 7) // 8)
+
+
+def full_chunk_bitmap(count):
+    """前 count 位为 1 的位图"""
+    full, rest = divmod(count, 8)
+    return b'\xff' * full + (bytes([0xFF << (8 - rest) & 0xFF]) if rest else b'')
+
+
+def bitmap_has(bitmap, index):
+    return bool(bitmap[index >> 3] & (0x80 >> (index & 7)))
+
+
+def room_id_from_name(room_name):
+    """把房间名（如 multi_1234）转换为帧头中的房间ID"""
+    prefix, _, number = room_name.rpartition('_')
+    if number.isdigit() and int(number) <= 0xFFFFFFFF:
+        return int(number)
+    return zlib.crc32(room_name.encode())
+
+
+def room_name_from_id(room_id):
+    return f"multi_{room_id}"
@@ -0,0 +1,158 @@
+import collections
+import threading
+
+from protocol import (Frame, FLAG_MORE, MSG_CHAT, MSG_PRIVATE, MSG_FILE, MSG_FILE_CHUNK,
+                      MSG_FILE_COMPLETE, MSG_VIDEO_DATA, MSG_MULTI_VIDEO_DATA)
+
+# 发送优先级：信令 > 聊天 > 文件数据 > 视频，数字越小越先发送
+PRIORITY_CONTROL = 0
+PRIORITY_CHAT = 1
+PRIORITY_FILE = 2
+PRIORITY_VIDEO = 3
+
+_PRIORITIES = {
+    MSG_CHAT: PRIORITY_CHAT,
+    MSG_PRIVATE: PRIORITY_CHAT,
+    # 文件的完成消息必须排在它的数据块之后，所以和数据块同一优先级
+    MSG_FILE: PRIORITY_FILE,
+    MSG_FILE_CHUNK: PRIORITY_FILE,
+    MSG_FILE_COMPLETE: PRIORITY_FILE,
+    MSG_VIDEO_DATA: PRIORITY_VIDEO,
+    MSG_MULTI_VIDEO_DATA: PRIORITY_VIDEO,
+}
+
+# 服务器支持分片时，文件和视频帧按这个大小拆开发送，两片之间可以插入更高优先级的帧
+FRAGMENT_SIZE = 16 * 1024
+# 排队的文件数据超过该值时文件发送线程等待，避免把整个文件读进内存
+MAX_QUEUED_FILE_BYTES = 512 * 1024
+
+
+def frame_priority(msg_type):
+    return _PRIORITIES.get(msg_type, PRIORITY_CONTROL)
+
+
+class SendScheduler:
+    """一条连接的发送线程：各线程只把帧放进优先级队列，由发送线程独占 socket 写出
+
+    每次写出当前最高优先级的一帧（或一片），大帧拆成分片后，高优先级的帧可以在两片之间插队，
+    一个大视频帧或文件块不会挡住聊天消息。视频队列每路（类型、房间、目标）只保留最新一帧，
+    发送跟不上时丢弃旧帧。序号在写出时分配，与发送顺序一致。
+    """
+
+    def __init__(self, sock, fragment_size=None):
+        self.sock = sock
+        self.fragment_size = fragment_size  # 为 None 时不分片（服务器不支持）
+        self.queues = [collections.deque() for _ in range(PRIORITY_VIDEO)]
+        self.video = collections.OrderedDict()  # (类型, 房间ID, 用户ID) -> 最新的一帧
+        # 各优先级发送到一半的大帧：[类型, 消息体, 标志, 房间ID, 用户ID, 序号, 已发送的偏移]
+        self.partial = [None] * (PRIORITY_VIDEO + 1)
+        self.file_bytes = 0
+        self.sending = False
+        self.closed = False
+        self.error = None
+        self.seq = 0
+        self.dropped_video = 0
+        self._condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, msg_type, body=b'', flags=0, room=0, user=0):
+        """把一帧放进队列（不等待写出），连接已关闭时抛出 OSError"""
+        priority = frame_priority(msg_type)
+        item = (msg_type, body, flags, room, user)
+        with self._condition:
+            if priority == PRIORITY_FILE:
+                while self.file_bytes > MAX_QUEUED_FILE_BYTES and not self.closed:
+                    self._condition.wait()
+            if self.closed:
+                raise OSError(self.error or "连接已关闭")
+            if priority == PRIORITY_VIDEO:
+                key = (msg_type, room, user)
+                if self.video.pop(key, None) is not None:
+                    self.dropped_video += 1
+                self.video[key] = item
+            else:
+                self.queues[priority].append(item)
+                if priority == PRIORITY_FILE:
+                    self.file_bytes += len(body)
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """等待已排队的帧全部写出，返回是否写完"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.closed or (not self.sending and self._idle()), timeout)
+
+    def close(self, error=None):
+        """停止发送，丢弃还没写出的帧；之后的 send() 抛出 OSError"""
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = error
+            for queue in self.queues:
+                queue.clear()
+            self.video.clear()
+            self.partial = [None] * len(self.partial)
+            self.file_bytes = 0
+            self._condition.notify_all()
+
+    def run(self):
+        while True:
+            with self._condition:
+                self.sending = False
+                self._condition.notify_all()
+                data = self._next()
+                while data is None:
+                    if self.closed:
+                        return
+                    self._condition.wait()
+                    data = self._next()
+                self.sending = True
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                self.close(str(e))
+                return
+
+    def _idle(self):
+        return (not any(self.queues) and not self.video
+                and not any(self.partial))
+
+    def _next(self):
+        """取出下一段要写出的数据：同一优先级先发完拆开的大帧，再取新帧"""
+        for priority in range(PRIORITY_VIDEO + 1):
+            if self.partial[priority] is not None:
+                return self._next_fragment(priority)
+            if priority == PRIORITY_VIDEO:
+                if not self.video:
+                    return None
+                item = self.video.popitem(last=False)[1]
+            else:
+                queue = self.queues[priority]
+                if not queue:
+                    continue
+                item = queue.popleft()
+                if priority == PRIORITY_FILE:
+                    self.file_bytes -= len(item[1])
+                    self._condition.notify_all()
+            msg_type, body, flags, room, user = item
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            if (priority < PRIORITY_FILE or self.fragment_size is None
+                    or len(body) <= self.fragment_size):
+                return Frame(msg_type, body, flags, room, user, self.seq).encode()
+            self.partial[priority] = [msg_type, memoryview(body), flags, room, user, self.seq, 0]
+            return self._next_fragment(priority)
+        return None
+
+    def _next_fragment(self, priority):
+        """大帧的下一片，除最后一片外带 FLAG_MORE"""
+        partial = self.partial[priority]
+        msg_type, body, flags, room, user, seq, offset = partial
+        end = offset + self.fragment_size
+        if end < len(body):
+            partial[6] = end
+            flags |= FLAG_MORE
+        else:
+            self.partial[priority] = None
+        return Frame(msg_type, body[offset:end], flags, room, user, seq).encode()
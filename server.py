@@ -1,98 +1,22 @@
-import socket
+import multiprocessing
+import sys
 import threading
-import struct
-
-# 保存在线客户端：socket -> username
-clients = {}
-
-
-def recv_all(sock, size):
-    data = b''
-    while len(data) < size:
-        packet = sock.recv(size - len(data))
-        if not packet:
-            return None
-        data += packet
-    return data
-
-
-def recv_message(sock):
-    raw_len = recv_all(sock, 4)
-    if not raw_len:
-        return None
-    msg_len = struct.unpack('!I', raw_len)[0]
-    return recv_all(sock, msg_len).decode()
-
-
-def send_message(sock, message):
-    data = message.encode()
-    length = struct.pack('!I', len(data))
-    sock.sendall(length + data)
-
-
-def send_to_user(target_username, message):
-    """发送消息给指定用户"""
-    for client_socket, username in clients.items():
-        if username == target_username:
-            try:
-                data = message.encode()
-                length = struct.pack('!I', len(data))
-                client_socket.send(length + data)
-                return True
-            except:
-                return False
-    return False
-
-
-def broadcast(message, exclude_socket=None):
-    for client in clients:
-        if client != exclude_socket:
-            try:
-                data = message.encode()
-                length = struct.pack('!I', len(data))
-                client.send(length + data)
-            except:
-                pass
-
-
-def handle_client(client_socket, client_address):
-    try:
-        # 1. 接收用户名
-        username = recv_message(client_socket)   # 接收用户名
-        clients[client_socket] = username   # 保存客户端和用户名的映射
-        print(f"{username} 上线了！")
-
-        # 通知其他人
-        broadcast(f"【系统】{username} 进入了聊天室", client_socket)
-
-        while True:
-            msg = recv_message(client_socket)   # ★关键
-            if not msg:
-                break
-
-            if msg == "/quit":
-                break
-
-            print(f"{username}：{msg}")
-            broadcast(f"{username}：{msg}", client_socket)
-
-    except:
-        pass
-    finally:
-        # 客户端下线
-        if client_socket in clients:
-            name = clients[client_socket]
-            print(f"{name} 下线了")
-            broadcast(f"【系统】{name} 离开了聊天室", client_socket)
-            del clients[client_socket]
 
-        client_socket.close()
+import media_relay
+import server_config
+import sharding
+from backplane import BrokerBackplane
+from chat_engine import ChatEngine
+from log_pipeline import LogPipeline
 
 
-def server_console():
+def server_console(engine):
     """处理服务器控制台输入的函数"""
     while True:
-        command = input("")  # 空提示符，直接等待输入
+        try:
+            command = input("")  # 空提示符，直接等待输入
+        except EOFError:
+            return  # 没有控制台（后台运行、标准输入已关闭）时服务器照常运行
 
         # 分割命令和参数
         parts = command.strip().split()
@@ -100,7 +24,7 @@ def server_console():
         args = parts[1:] if len(parts) > 1 else []
 
         if cmd == "list" or cmd == "online":
-            online_users = list(clients.values())
+            online_users = engine.online_users()
             print(
                 f"在线用户 ({len(online_users)}人): {', '.join(online_users) if online_users else '无'}")
         elif cmd == "help":
@@ -110,13 +34,14 @@ def server_console():
             print("  status - 查看服务器详细状态")
             print("  kick <用户名> - 踢出指定用户")
             print("  broadcast <消息> - 发送系统广播消息")
+            print("  stats - 查看各命令的调用次数和耗时，以及文件仓库的使用情况")
             print("  help - 显示此帮助信息")
         elif cmd == "count":
-            print(f"当前在线人数: {len(clients)}")
+            print(f"当前在线人数: {len(engine.online_users())}")
         elif cmd == "status":
             print("服务器状态信息:")
-            print(f"  在线人数: {len(clients)}")
-            online_users = list(clients.values())
+            online_users = engine.online_users()
+            print(f"  在线人数: {len(online_users)}")
             if online_users:
                 print(f"  在线用户: {', '.join(online_users)}")
             else:
@@ -125,57 +50,113 @@ def server_console():
             if args:
                 target_user = args[0]  # 目标用户名
 
-                kicked = False  # 标记是否成功踢出用户
-                # 使用 list(clients.items()) 创建快照以避免在迭代时修改字典
-                for client_socket, username in list(clients.items()):  # 遍历客户端连接
-                    # 调试信息
-                    if username == target_user:
-                        try:
-                            # 先向被踢出的用户发送通知
-                            try:
-                                send_message(client_socket, "【系统】您已被管理员踢出聊天室")
-                            except:
-                                pass  # 如果发送失败也继续执行
-                            # 通知其他用户该用户被踢出
-                            broadcast(
-                                f"【系统】{username} 被管理员踢出聊天室", client_socket)
-                            client_socket.close()  # 关闭客户端连接
-                            print(f"已踢出用户: {target_user}")
-                            kicked = True
-                            break
-                        except Exception as e:
-                            print(f"踢出用户 {target_user} 时出错: {e}")
-                            break
-                if not kicked:
+                if engine.kick_user(target_user):
+                    print(f"已踢出用户: {target_user}")
+                else:
                     print(f"用户 {target_user} 不在线或不存在")
             else:
                 print("用法: kick <用户名>")
         elif cmd == "broadcast":
             if args:
                 message = " ".join(args)
-                broadcast(f"【系统广播】{message}")
+                engine.system_broadcast(message)
                 print(f"已发送系统广播: {message}")
             else:
                 print("用法: broadcast <消息>")
+        elif cmd == "stats":
+            print("命令统计:")
+            for item in engine.command_stats():
+                if item["count"]:
+                    print(f"  {item['name']}: {item['count']} 次, 错误 {item['errors']} 次, "
+                          f"平均 {item['avg_ms']:.3f}ms, 最长 {item['max_ms']:.3f}ms")
+            blobs = engine.blob_stats()
+            print(f"文件仓库: {blobs['count']} 个文件, {blobs['bytes']} / {blobs['max_bytes']} 字节, "
+                  f"重复内容省去上传 {blobs['hits']} 次")
+            downloads = engine.download_stats()
+            if downloads is not None:
+                print(f"下载端口 {downloads['port']}: {downloads['requests']} 次请求, "
+                      f"发送 {downloads['bytes']} 字节")
+            video = engine.video_stats()
+            print(f"视频帧: 写出 {video['sent']} 帧, 被更新的帧覆盖 {video['replaced']} 帧")
+            media = engine.media_stats()
+            if media is not None:
+                state = f"UDP 端口 {media['udp_port']}" if media["connected"] else "未连接"
+                print(f"媒体转发服务器: {state}, 经 UDP 收发视频 {media['attached']} 人次, "
+                      f"合成画面的房间 {media['mosaic_rooms']} 个")
         else:
             print(f"未知命令: {command}。输入 'help' 查看可用命令。")
 
 
-# =============== 服务器启动 ===============
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind(("0.0.0.0", 8888))
-server_socket.listen(5)
+def run_sharded(options):
+    """多进程分片：分片进程没有控制台，按 Ctrl+C 结束所有进程"""
+    processes = sharding.launch(options.host, options.port, options.workers, options.broker,
+                                options.node_base, options.quiet,
+                                server_config.engine_kwargs(options),
+                                server_config.log_kwargs(options), options.broker_secret)
+    last = options.node_base + options.workers - 1
+    print(f"聊天室服务器启动：{options.workers} 个分片进程（节点 {options.node_base}-{last}）"
+          f"监听 {options.host}:{options.port}")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+def main():
+    options = server_config.load_options("聊天室服务器（命令行版，不需要图形界面）")
+    if options.workers > 1:
+        if not sharding.supported():
+            sys.exit("当前系统不支持 SO_REUSEPORT，只能使用 --workers 1")
+        run_sharded(options)
+        return
+
+    # 多人视频的 UDP 转发在单独的进程中运行，不占用聊天服务器的 CPU
+    media = None
+    if options.media_port is not None:
+        relay = multiprocessing.Process(
+            target=media_relay.run,
+            args=(options.host, options.media_port, "127.0.0.1", media_relay.DEFAULT_CONTROL_PORT,
+                  options.quiet, server_config.log_kwargs(options)),
+            daemon=True)
+        relay.start()
+        media = ("127.0.0.1", media_relay.DEFAULT_CONTROL_PORT)
+
+    # 日志由后台线程成批写到控制台和日志文件，引擎只把日志追加到队列
+    logs = None
+    if options.log_file is not None or not options.quiet:
+        logs = LogPipeline(stream=None if options.quiet else sys.stdout,
+                           **server_config.log_kwargs(options)).start()
+    log = logs.emit if logs is not None else None
+
+    # 网络部分全部由引擎负责，这里只提供命令行控制台；指定了消息代理时作为集群中的一个节点
+    backplane = (BrokerBackplane(options.broker, on_log=log, secret=options.broker_secret)
+                 if options.broker else None)
+    engine = ChatEngine(options.host, options.port, media_relay=media,
+                        node_id=options.node_base, backplane=backplane, on_log=log,
+                        **server_config.engine_kwargs(options))
+
+    print(f"聊天室服务器启动，监听 {options.host}:{options.port}，等待客户端连接...")
+    if options.admin_port is not None:
+        print(f"管理端口 127.0.0.1:{options.admin_port}（python gui_server.py 可连接）")
+    print("输入 'list', 'count', 'online', 'status', 'kick', 'broadcast', 'stats' 或 'help' 查看和管理服务器状态")
+
+    # 启动服务器控制台线程
+    console_thread = threading.Thread(
+        target=server_console, args=(engine,), daemon=True)
+    console_thread.start()
 
-print("聊天室服务器启动，等待客户端连接...")
-print("输入 'list', 'count', 'online', 'status', 'kick', 'broadcast' 或 'help' 查看和管理服务器状态")
+    try:
+        engine.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if logs is not None:
+            logs.close()
 
-# 启动服务器控制台线程
-console_thread = threading.Thread(target=server_console, daemon=True)
-console_thread.start()
 
-while True:
-    client_socket, client_address = server_socket.accept()
-    threading.Thread(
-        target=handle_client,
-        args=(client_socket, client_address)
-    ).start()
+if __name__ == "__main__":
+    main()
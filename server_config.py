@@ -0,0 +1,130 @@
+import argparse
+import json
+
+from protocol import DEFAULT_MAX_FRAME_SIZE
+from blob_store import DEFAULT_MAX_BYTES
+from chat_engine import (DEFAULT_OUTBOUND_HIGH_WATERMARK, DEFAULT_OUTBOUND_LOW_WATERMARK,
+                         DEFAULT_VIDEO_FPS, POLICY_DEGRADE, SLOW_CONSUMER_POLICIES)
+from backplane import MAX_NODES, parse_address, read_secret
+from admin_control import DEFAULT_ADMIN_PORT
+from log_pipeline import DEFAULT_MAX_BYTES as DEFAULT_LOG_MAX_BYTES, DEFAULT_BACKUPS
+
+# 服务器选项的默认值；配置文件（JSON 对象）使用同样的键，命令行参数优先于配置文件
+DEFAULTS = {
+    "host": "0.0.0.0",
+    "port": 8888,
+    "workers": 1,  # 本机的分片进程数，多于 1 个时经 sharding.py 启动
+    "broker": None,  # 集群模式的消息代理地址 "host:port"
+    "broker_secret_file": None,  # 与消息代理约定的共享密钥文件
+    "node_base": 0,  # 本机第一个分片的节点号
+    "backlog": 1024,
+    "max_frame_size": DEFAULT_MAX_FRAME_SIZE,
+    "outbound_high_watermark": DEFAULT_OUTBOUND_HIGH_WATERMARK,
+    "outbound_low_watermark": DEFAULT_OUTBOUND_LOW_WATERMARK,
+    "slow_consumer_policy": POLICY_DEGRADE,
+    "video_max_fps": DEFAULT_VIDEO_FPS,
+    "blob_dir": None,  # 为 None 时使用程序目录下的 server_files/
+    "blob_max_bytes": DEFAULT_MAX_BYTES,
+    "download_port": 8889,  # 为 None 时不开启下载端口
+    "media_port": 8890,  # 媒体转发服务器的 UDP 端口，为 None 时不启动
+    "admin_port": DEFAULT_ADMIN_PORT,  # 本机管理端口（供 gui_server.py 连接），为 None 时不开启
+    "log_file": None,  # 日志文件，为 None 时不写文件
+    "log_max_bytes": DEFAULT_LOG_MAX_BYTES,  # 日志文件超过该大小时轮转
+    "log_backups": DEFAULT_BACKUPS,  # 保留的旧日志文件数
+    "quiet": False,  # 不在控制台输出服务器日志
+}
+
+# 直接传给 ChatEngine 的选项
+ENGINE_OPTIONS = ("backlog", "max_frame_size", "outbound_high_watermark",
+                  "outbound_low_watermark", "slow_consumer_policy", "video_max_fps",
+                  "blob_dir", "blob_max_bytes", "download_port", "admin_port")
+
+
+def build_parser(description):
+    """服务器的命令行参数（命令行版和 GUI 版共用），未给出的参数不出现在结果中"""
+    parser = argparse.ArgumentParser(description=description,
+                                     argument_default=argparse.SUPPRESS)
+    parser.add_argument("--config", help="配置文件（JSON 对象，键与下列选项相同，用下划线）")
+    parser.add_argument("--host", help=f"监听地址（默认 {DEFAULTS['host']}）")
+    parser.add_argument("--port", type=int, help=f"监听端口（默认 {DEFAULTS['port']}）")
+    parser.add_argument("--workers", type=int,
+                        help="分片进程数（默认 1，多于 1 个时需要 SO_REUSEPORT）")
+    parser.add_argument("--broker", help="集群模式：消息代理的地址 host:port")
+    parser.add_argument("--broker-secret-file", help="集群模式：与消息代理约定的共享密钥文件")
+    parser.add_argument("--node-base", type=int, help="本机第一个分片的节点号（集群中不能重叠）")
+    parser.add_argument("--backlog", type=int, help="监听队列长度")
+    parser.add_argument("--max-frame-size", type=int, help="单帧最大字节数")
+    parser.add_argument("--outbound-high-watermark", type=int, help="每个连接出站积压的高水位（字节）")
+    parser.add_argument("--outbound-low-watermark", type=int, help="每个连接出站积压的低水位（字节）")
+    parser.add_argument("--slow-consumer-policy", choices=SLOW_CONSUMER_POLICIES,
+                        help="出站积压超过高水位时的处理策略")
+    parser.add_argument("--video-max-fps", type=float, help="每个接收者每路视频的最高帧率")
+    parser.add_argument("--blob-dir", help="文件仓库目录")
+    parser.add_argument("--blob-max-bytes", type=int, help="文件仓库上限（字节）")
+    parser.add_argument("--download-port", type=int, help="下载端口（0 表示由系统分配）")
+    parser.add_argument("--no-download", dest="download_port", action="store_const", const=None,
+                        help="不开启下载端口")
+    parser.add_argument("--media-port", type=int, help="媒体转发服务器的 UDP 端口")
+    parser.add_argument("--no-media-relay", dest="media_port", action="store_const", const=None,
+                        help="不启动媒体转发服务器")
+    parser.add_argument("--admin-port", type=int,
+                        help="本机管理端口，管理界面经它查看日志和状态（0 表示由系统分配）")
+    parser.add_argument("--no-admin", dest="admin_port", action="store_const", const=None,
+                        help="不开启管理端口")
+    parser.add_argument("--log-file", help="日志文件（按大小轮转，分片模式下每个节点一个文件）")
+    parser.add_argument("--log-max-bytes", type=int, help="日志文件轮转的大小（字节）")
+    parser.add_argument("--log-backups", type=int, help="保留的旧日志文件数")
+    parser.add_argument("--quiet", action="store_true", help="不在控制台输出服务器日志")
+    return parser
+
+
+def load_options(description, argv=None):
+    """合并默认值、配置文件和命令行参数，返回 argparse.Namespace；选项不正确时退出"""
+    parser = build_parser(description)
+    args = vars(parser.parse_args(argv))
+    options = dict(DEFAULTS)
+    config = args.pop("config", None)
+    if config is not None:
+        try:
+            with open(config, encoding="utf-8") as f:
+                values = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f"无法读取配置文件 {config}: {e}")
+        if not isinstance(values, dict):
+            parser.error(f"配置文件 {config} 应为 JSON 对象")
+        unknown = sorted(set(values) - set(DEFAULTS))
+        if unknown:
+            parser.error(f"配置文件中有未知的选项: {', '.join(unknown)}")
+        options.update(values)
+    options.update(args)
+
+    if options["workers"] < 1:
+        parser.error("分片进程数至少为 1")
+    if options["node_base"] < 0 or options["node_base"] + options["workers"] > MAX_NODES:
+        parser.error(f"节点号必须在 0 到 {MAX_NODES - 1} 之间")
+    if options["slow_consumer_policy"] not in SLOW_CONSUMER_POLICIES:
+        parser.error(f"未知的慢客户端策略: {options['slow_consumer_policy']}")
+    if options["outbound_low_watermark"] > options["outbound_high_watermark"]:
+        parser.error("出站低水位不能高于高水位")
+    if options["log_max_bytes"] <= 0 or options["log_backups"] < 0:
+        parser.error("日志文件大小必须为正数，旧日志文件数不能为负数")
+    if options["broker"] is not None:
+        options["broker"] = parse_address(options["broker"])
+    options["broker_secret"] = None
+    if options["broker_secret_file"] is not None:
+        try:
+            options["broker_secret"] = read_secret(options["broker_secret_file"])
+        except (OSError, ValueError) as e:
+            parser.error(f"无法读取共享密钥: {e}")
+    return argparse.Namespace(**options)
+
+
+def engine_kwargs(options):
+    """ChatEngine 的关键字参数（不含监听地址和端口）"""
+    return {name: getattr(options, name) for name in ENGINE_OPTIONS}
+
+
+def log_kwargs(options):
+    """LogPipeline 的关键字参数（不含控制台）"""
+    return {"path": options.log_file, "max_bytes": options.log_max_bytes,
+            "backup_count": options.log_backups}
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from backplane import run_broker
+
+BROKER_STARTUP_TIMEOUT = 5  # 启动分片前等待本机消息代理开始监听的时间（秒）
+
+
+def run_worker(host, port, node, broker, reuse_port=True, quiet=False, engine_options=None,
+               log_options=None, broker_secret=None):
+    """运行一个节点（分片）的聊天服务器直到进程结束（multiprocessing.Process 的入口）
+
+    broker 为消息代理的地址：(host, port) 或 Unix 域套接字路径；engine_options 为 ChatEngine 的其他参数；
+    log_options 为 LogPipeline 的参数，日志文件 server.log 在各节点为 server-node{N}.log；
+    broker_secret 为与消息代理约定的共享密钥。
+    """
+    from chat_engine import ChatEngine, DEFAULT_BLOB_DIR
+    from backplane import BrokerBackplane
+    from log_pipeline import LogPipeline
+
+    log_options = dict(log_options or {})
+    if log_options.get("path"):
+        root, ext = os.path.splitext(log_options["path"])
+        log_options["path"] = f"{root}-node{node}{ext}"
+    logs = None
+    if log_options.get("path") or not quiet:
+        logs = LogPipeline(stream=None if quiet else sys.stdout, **log_options).start()
+    log = (lambda message: logs.emit(f"[节点 {node}] {message}")) if logs else None
+
+    # 各节点的文件仓库分开存放，互不影响淘汰；下载端口的票据只在签发的节点有效，分片模式下不开启；
+    # 管理端口只能由一个进程监听，分片模式下也不开启
+    options = dict(engine_options or {})
+    options["blob_dir"] = os.path.join(options.get("blob_dir") or DEFAULT_BLOB_DIR, f"node{node}")
+    options["download_port"] = None
+    options["admin_port"] = None
+    engine = ChatEngine(host, port, reuse_port=reuse_port, node_id=node,
+                        backplane=BrokerBackplane(broker, on_log=log, secret=broker_secret),
+                        on_log=log, **options)
+    try:
+        engine.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if logs is not None:
+            logs.close()
+
+
+def supported():
+    """当前系统是否支持多进程分片（需要 SO_REUSEPORT 和 Unix 域套接字）"""
+    return hasattr(socket, "SO_REUSEPORT") and hasattr(socket, "AF_UNIX")
+
+
+def default_broker_path(port):
+    return os.path.join(tempfile.gettempdir(), f"chatroom-broker-{port}.sock")
+
+
+def launch(host, port, workers, broker=None, node_base=0, quiet=False, engine_options=None,
+           log_options=None, broker_secret=None):
+    """启动 workers 个分片进程（节点号从 node_base 起），返回进程列表
+
+    各分片用 SO_REUSEPORT 监听同一端口，由内核把新连接分给各分片。broker 为 None 时
+    先在本机启动一个消息代理进程（Unix 域套接字，放在列表最前），否则连接给定的代理
+    （集群模式：多台机器上的分片连同一个代理，node_base 在集群内不能重叠，broker_secret 为
+    与代理约定的共享密钥）。本机代理的套接字文件权限为 0600，不需要密钥。
+    """
+    processes = []
+    if broker is None:
+        broker = default_broker_path(port)
+        if os.path.exists(broker):
+            os.unlink(broker)
+        process = multiprocessing.Process(
+            target=run_broker, args=(broker, None if quiet else print), daemon=True)
+        process.start()
+        processes.append(process)
+        deadline = time.monotonic() + BROKER_STARTUP_TIMEOUT
+        while not os.path.exists(broker) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    for node in range(node_base, node_base + workers):
+        worker = multiprocessing.Process(
+            target=run_worker,
+            args=(host, port, node, broker, workers > 1, quiet, engine_options, log_options,
+                  broker_secret),
+            daemon=True)
+        worker.start()
+        processes.append(worker)
+    return processes
@@ -0,0 +1,302 @@
+"""旧版文本协议兼容层
+
+旧客户端（client.py 以及早期的图形客户端）仍然发送 "/命令|参数" 形式的文本消息，
+视频和文件以 base64 嵌在文本中。服务器内部统一使用 v2 帧处理，这里负责在两者之间转换：
+parse_text_message 把收到的文本解析为 v2 帧，render_text_message 把要发出的 v2 帧渲染回文本。
+
+文件和视频消息只解析开头的路由字段，base64 数据保持为接收缓冲区的 memoryview 原样转发，
+不解码成 str、不重新拼接字符串；只有 v2 接收方需要原始数据时才解码一次。
+"""
+import base64
+import binascii
+import json
+
+from protocol import (
+    Frame, MessageFormatError, pack_file_body, unpack_file_body,
+    room_id_from_name, room_name_from_id,
+    FLAG_PRIVATE, FLAG_OFFLINE,
+    MSG_QUIT, MSG_CHAT, MSG_PRIVATE, MSG_SYSTEM, MSG_REQUEST_USERLIST, MSG_FILE,
+    MSG_VIDEO_CALL_REQUEST, MSG_VIDEO_CALL_INVITE, MSG_VIDEO_CALL_ACCEPT,
+    MSG_VIDEO_CALL_START, MSG_VIDEO_CALL_REJECT, MSG_VIDEO_CALL_REJECTED,
+    MSG_VIDEO_CALL_END, MSG_VIDEO_CALL_ENDED, MSG_VIDEO_DATA, MSG_UDP_PORT,
+    MSG_MULTI_VIDEO_INVITE, MSG_MULTI_VIDEO_JOIN, MSG_MULTI_VIDEO_LEAVE,
+    MSG_MULTI_VIDEO_DATA, MSG_MULTI_VIDEO_REFRESH, MSG_CAMERA_STATUS,
+    MSG_MULTI_VIDEO_ROSTER, MSG_MULTI_VIDEO_MODE)
+
+HEAD_SIZE = 4096  # 路由字段（命令、目标用户、房间、文件名）都在消息开头，只解码这一段
+
+
+# 不是 multi_<数字> 形式的房间名在帧头中是它的 CRC32，这里记住原名，渲染回文本时还原
+_room_names = {}
+_MAX_ROOM_NAMES = 4096
+
+
+def _room_id(room_name):
+    room = room_id_from_name(room_name)
+    if room_name_from_id(room) != room_name:
+        if len(_room_names) >= _MAX_ROOM_NAMES:
+            _room_names.clear()
+        _room_names[room] = room_name
+    return room
+
+
+def _room_name(room):
+    return _room_names.get(room) or room_name_from_id(room)
+
+
+class Base64Body:
+    """旧版客户端发来的 base64 数据（接收缓冲区的 memoryview，只在本次处理内有效）
+
+    转发给旧版客户端时原样使用；v2 接收方需要原始数据时调用 raw() 解码，只解码一次。
+    """
+
+    __slots__ = ('encoded', 'filename', '_raw')
+
+    def __init__(self, encoded, filename=None):
+        self.encoded = encoded
+        self.filename = filename  # 文件消息的文件名，其他消息为 None
+        self._raw = None
+
+    def decoded_size(self):
+        """不解码，直接由 base64 长度算出原始数据大小"""
+        size = len(self.encoded)
+        padding = bytes(self.encoded[-2:]).count(b'=') if size else 0
+        return size // 4 * 3 - padding
+
+    def raw(self):
+        """v2 消息体：原始数据（文件消息带文件名头），格式错误时抛出 MessageFormatError"""
+        if self._raw is None:
+            try:
+                data = base64.b64decode(self.encoded, validate=True)
+            except (binascii.Error, ValueError):
+                raise MessageFormatError("base64 数据格式不正确")
+            if self.filename is not None:
+                data = pack_file_body(self.filename, data)
+            self._raw = data
+        return self._raw
+
+
+# ==================== 文本 -> 帧 ====================
+
+def _split_fields(data, count, error):
+    """从 data 开头切出 count 个以 '|' 分隔的字段，返回 (字段列表, 剩余部分的 memoryview)"""
+    fields = bytes(data[:HEAD_SIZE]).split(b'|', count)
+    if len(fields) <= count:
+        raise MessageFormatError(error)
+    offset = sum(len(field) + 1 for field in fields[:count])
+    try:
+        return [field.decode() for field in fields[:count]], data[offset:]
+    except UnicodeDecodeError:
+        raise MessageFormatError(error)
+
+
+def _relay_file(data, flags=0):
+    # 格式：/FILE|filename|filesize|base64data
+    (filename, _), encoded = _split_fields(data, 2, "文件格式不正确")
+    return Frame(MSG_FILE, Base64Body(encoded, filename), flags=flags)
+
+
+def _relay_video_data(data):
+    # 格式：/VIDEO_DATA|target_user|video_data
+    (target,), encoded = _split_fields(data, 1, "视频数据格式不正确")
+    return Frame(MSG_VIDEO_DATA, Base64Body(encoded)), target
+
+
+def _relay_multi_video_data(data):
+    # 格式：/MULTI_VIDEO_DATA|room_id|sender|video_data
+    (room, _), encoded = _split_fields(data, 2, "多人视频数据格式不正确")
+    return Frame(MSG_MULTI_VIDEO_DATA, Base64Body(encoded), room=_room_id(room)), None
+
+
+def _parse_call_signal(msg_type):
+    # 格式：/VIDEO_CALL_xxx|target_user
+    def parse(args):
+        return Frame(msg_type), args.split('|')[0]
+    return parse
+
+
+def _parse_room_signal(msg_type):
+    # 格式：/MULTI_VIDEO_xxx|room_id|username（用户名以连接的登录名为准）
+    def parse(args):
+        room, sep, _ = args.partition('|')
+        if not sep:
+            raise MessageFormatError("多人视频消息格式不正确")
+        return Frame(msg_type, room=_room_id(room)), None
+    return parse
+
+
+def _parse_camera_status(args):
+    # 格式：/CAMERA_STATUS|room_id|username|status
+    parts = args.split('|', 2)
+    if len(parts) != 3:
+        raise MessageFormatError("摄像头状态格式不正确")
+    return Frame(MSG_CAMERA_STATUS, parts[2].encode(),
+                 room=_room_id(parts[0])), None
+
+
+def _parse_video_mode(args):
+    # 格式：/MULTI_VIDEO_MODE|room_id|mode
+    room, sep, mode = args.partition('|')
+    if not sep:
+        raise MessageFormatError("多人视频模式格式不正确")
+    return Frame(MSG_MULTI_VIDEO_MODE, mode.encode(), room=_room_id(room)), None
+
+
+# 携带大块 base64 数据的命令：只解析开头的路由字段，数据部分不解码
+_RELAY_COMMANDS = {
+    b'/FILE': lambda data: (_relay_file(data), None),
+    b'/VIDEO_DATA': _relay_video_data,
+    b'/MULTI_VIDEO_DATA': _relay_multi_video_data,
+}
+
+# 不带参数的命令（整条消息就是命令本身）
+_BARE_COMMANDS = {
+    '/quit': lambda args: (Frame(MSG_QUIT), None),
+    '/REQUEST_USERLIST': lambda args: (Frame(MSG_REQUEST_USERLIST), None),
+}
+
+# 带参数的命令：/命令|参数
+_COMMANDS = {
+    '/VIDEO_CALL_REQUEST': _parse_call_signal(MSG_VIDEO_CALL_REQUEST),
+    '/VIDEO_CALL_ACCEPT': _parse_call_signal(MSG_VIDEO_CALL_ACCEPT),
+    '/VIDEO_CALL_REJECT': _parse_call_signal(MSG_VIDEO_CALL_REJECT),
+    '/VIDEO_CALL_END': _parse_call_signal(MSG_VIDEO_CALL_END),
+    '/UDP_PORT': lambda args: (Frame(MSG_UDP_PORT, args.encode()), None),
+    '/MULTI_VIDEO_INVITE': _parse_room_signal(MSG_MULTI_VIDEO_INVITE),
+    '/MULTI_VIDEO_JOIN': _parse_room_signal(MSG_MULTI_VIDEO_JOIN),
+    '/MULTI_VIDEO_LEAVE': _parse_room_signal(MSG_MULTI_VIDEO_LEAVE),
+    '/MULTI_VIDEO_REFRESH': _parse_room_signal(MSG_MULTI_VIDEO_REFRESH),
+    '/CAMERA_STATUS': _parse_camera_status,
+    '/MULTI_VIDEO_MODE': _parse_video_mode,
+}
+
+
+def parse_text_message(payload):
+    """把一条旧版文本消息（接收缓冲区的 memoryview）解析为 (v2 帧, 目标用户名)
+
+    旧协议按用户名寻址，目标用户名由调用者解析为会话；没有目标时为 None。
+    格式错误时抛出 MessageFormatError。
+    """
+    payload = memoryview(payload)
+    head = bytes(payload[:HEAD_SIZE])
+    if head.startswith(b'/'):
+        # 文件和视频数据只看开头的命令名
+        command, sep, _ = head.partition(b'|')
+        relay = _RELAY_COMMANDS.get(command) if sep else None
+        if relay is not None:
+            return relay(payload[len(command) + 1:])
+    elif head.startswith(b'@'):
+        # 私聊文件：@用户名 /FILE|filename|filesize|base64data
+        target, sep, content = head.partition(b' ')
+        if sep and content.startswith(b'/FILE|'):
+            offset = len(target) + 1 + len(b'/FILE|')
+            return (_relay_file(payload[offset:], FLAG_PRIVATE),
+                    target[1:].decode().strip())
+
+    msg = str(payload, 'utf-8')
+    if msg.startswith('/'):
+        # 命令只切分一次，按命令名查表
+        command, sep, args = msg.partition('|')
+        parser = (_COMMANDS if sep else _BARE_COMMANDS).get(command)
+        if parser is not None:
+            return parser(args)
+    elif msg.startswith('@'):
+        # 私聊消息（格式：@用户名 消息内容），格式不正确时当作普通消息处理
+        parts = msg.split(' ', 1)
+        if len(parts) == 2:
+            return Frame(MSG_PRIVATE, parts[1].encode()), parts[0][1:].strip()
+
+    return Frame(MSG_CHAT, msg.encode()), None
+
+
+# ==================== 帧 -> 文本 ====================
+#
+# 渲染结果是若干段 bytes / memoryview，由调用者加上长度前缀后一次拼接成帧。
+
+def _text(text):
+    return (text.encode(),)
+
+
+def _base64_part(body):
+    """旧版客户端发来的 base64 数据原样使用，v2 的原始数据才需要编码"""
+    if isinstance(body, Base64Body):
+        return body.encoded
+    return base64.b64encode(body)
+
+
+def _render_file(frame, name):
+    body = frame.body
+    if isinstance(body, Base64Body):
+        filename, size, encoded = body.filename, body.decoded_size(), body.encoded
+    else:
+        filename, data = unpack_file_body(body)
+        size, encoded = len(data), base64.b64encode(data)
+    file_msg = f"/FILE|{filename}|{size}|"
+    if frame.flags & FLAG_PRIVATE:
+        return (f"[私聊来自{name}] {name}：{file_msg}".encode(), encoded)
+    return (f"{name}：{file_msg}".encode(), encoded)
+
+
+def _render_call_ended(frame, name):
+    if frame.flags & FLAG_OFFLINE:
+        return _text(f"/VIDEO_CALL_ENDED|{name} (已离线)")
+    return _text(f"/VIDEO_CALL_ENDED|{name}")
+
+
+def _render_room_signal(command):
+    def render(frame, name):
+        return _text(f"/{command}|{_room_name(frame.room)}|{name}")
+    return render
+
+
+def _render_roster(frame, name):
+    # 格式：/MULTI_VIDEO_ROSTER|room_id|user1|user2...
+    names = [member for _, member in json.loads(frame.text())]
+    return _text("|".join([f"/MULTI_VIDEO_ROSTER|{_room_name(frame.room)}"] + names))
+
+
+_RENDERERS = {
+    MSG_CHAT: lambda frame, name: _text(f"{name}：{frame.text()}"),
+    MSG_PRIVATE: lambda frame, name:
+        _text(f"[私聊来自{name}] {name}：{frame.text()}"),
+    MSG_SYSTEM: lambda frame, name: (frame.body,),
+    MSG_FILE: _render_file,
+    MSG_VIDEO_CALL_INVITE: lambda frame, name: _text(f"/VIDEO_CALL_INVITE|{name}"),
+    MSG_VIDEO_CALL_START: lambda frame, name: _text(f"/VIDEO_CALL_START|{name}"),
+    MSG_VIDEO_CALL_REJECTED: lambda frame, name:
+        _text(f"/VIDEO_CALL_REJECTED|{name}"),
+    MSG_VIDEO_CALL_ENDED: _render_call_ended,
+    MSG_VIDEO_DATA: lambda frame, name:
+        (f"/VIDEO_DATA|{name}|".encode(), _base64_part(frame.body)),
+    MSG_MULTI_VIDEO_INVITE: _render_room_signal("MULTI_VIDEO_INVITE"),
+    MSG_MULTI_VIDEO_JOIN: _render_room_signal("MULTI_VIDEO_JOIN"),
+    MSG_MULTI_VIDEO_LEAVE: _render_room_signal("MULTI_VIDEO_LEAVE"),
+    MSG_MULTI_VIDEO_REFRESH: _render_room_signal("MULTI_VIDEO_REFRESH"),
+    MSG_MULTI_VIDEO_DATA: lambda frame, name:
+        (f"/MULTI_VIDEO_DATA|{_room_name(frame.room)}|{name}|".encode(),
+         _base64_part(frame.body)),
+    MSG_CAMERA_STATUS: lambda frame, name:
+        _text(f"/CAMERA_STATUS|{_room_name(frame.room)}|{name}|{frame.text()}"),
+    MSG_MULTI_VIDEO_ROSTER: _render_roster,
+    MSG_MULTI_VIDEO_MODE: lambda frame, name:
+        _text(f"/MULTI_VIDEO_MODE|{_room_name(frame.room)}|{frame.text()}"),
+}
+
+
+def render_text_message(frame, name):
+    """把一条下行 v2 帧渲染为旧版文本消息的各段内容，name 为帧中发送者的用户名
+
+    旧协议中没有对应的消息时返回 None。
+    """
+    renderer = _RENDERERS.get(frame.msg_type)
+    if renderer is None:
+        return None
+    return renderer(frame, name)
+
+
+def binary_body(frame):
+    """v2 接收方需要的原始消息体（旧版客户端发来的 base64 数据在这里解码）"""
+    body = frame.body
+    if isinstance(body, Base64Body):
+        return body.raw()
+    return body